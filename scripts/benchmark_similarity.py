@@ -0,0 +1,399 @@
+#!/usr/bin/env -S python3 -O
+# -*- coding: utf-8 -*-
+
+"""
+使用随机生成的方言数据测试方言相似度计算的性能.
+"""
+
+__author__ = '黄艺华 <lernanto@foxmail.com>'
+
+
+import logging
+import argparse
+import time
+import tempfile
+import os
+import tracemalloc
+import numpy
+import scipy.sparse
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.impute import SimpleImputer
+
+import sincomp.similarity
+
+
+def make_data(dialect_num, char_num, feature_num=3, category=10, seed=0):
+    """
+    生成随机的方言读音数据
+
+    Parameters:
+        dialect_num: 方言数
+        char_num: 字数
+        feature_num: 每个方言的特征数，如声母、韵母、声调
+        category: 每个特征取值的最大数量
+        seed: 随机数种子
+
+    Returns:
+        data: char_num x (dialect_num * feature_num) 的字符串矩阵，空字符串代表缺失值
+    """
+
+    rand = numpy.random.default_rng(seed)
+    # 各方言共享同一个基础读音，再加上随机扰动，使方言之间存在相关性
+    base = rand.integers(category, size=(char_num, 1, feature_num))
+    noise = rand.integers(
+        category // 2,
+        size=(char_num, dialect_num, feature_num)
+    )
+    codes = (base + noise * (rand.random(noise.shape) < 0.3)) % category
+    data = numpy.char.add(
+        numpy.asarray(['i', 'f', 't', 'x'])[numpy.arange(feature_num) % 4],
+        codes.astype(str)
+    ).reshape(char_num, -1).astype(object)
+    data[rand.random(data.shape) < 0.05] = ''
+    return data
+
+def chi2_block_loop(
+    features,
+    feature_categories,
+    feature_probs,
+    targets,
+    target_categories,
+    target_probs
+):
+    """逐组循环归并的分块卡方，用作性能对比的基准"""
+
+    freq = features.T * targets
+    chisq = scipy.sparse.csr_matrix(freq)
+    chisq.data = numpy.square(chisq.data) / target_probs[chisq.indices]
+
+    target_limits = numpy.concatenate([[0], numpy.cumsum(target_categories)])
+    freq = numpy.column_stack([numpy.sum(
+        freq[:, target_limits[i]:target_limits[i + 1]],
+        axis=1
+    ) for i in range(target_limits.shape[0] - 1)]).A
+    chisq = numpy.column_stack([numpy.sum(
+        chisq[:, target_limits[i]:target_limits[i + 1]],
+        axis=1
+    ) for i in range(target_limits.shape[0] - 1)]).A
+
+    chisq /= feature_probs[:, None]
+
+    feature_limits = numpy.concatenate([[0], numpy.cumsum(feature_categories)])
+    freq = numpy.stack([numpy.sum(
+        freq[feature_limits[i]:feature_limits[i + 1]],
+        axis=0
+    ) for i in range(feature_limits.shape[0] - 1)])
+    chisq = numpy.stack([numpy.sum(
+        chisq[feature_limits[i]:feature_limits[i + 1]],
+        axis=0
+    ) for i in range(feature_limits.shape[0] - 1)])
+
+    chisq = chisq / freq - freq
+    dof = numpy.outer(feature_categories - 1, target_categories - 1) \
+        .astype(numpy.float32)
+    return (chisq - dof) / numpy.sqrt(2 * dof)
+
+def entropy_loop(features, feature_limits, targets, target_limits):
+    """逐组循环归并的条件熵，用作性能对比的基准"""
+
+    freq = features.T @ targets
+    entropy = scipy.sparse.csc_matrix(freq)
+    entropy.data = numpy.where(
+        entropy.data == 0,
+        0,
+        entropy.data * numpy.log(entropy.data)
+    )
+
+    freq = numpy.asarray(numpy.column_stack([numpy.sum(
+        freq[:, target_limits[i]:target_limits[i + 1]],
+        axis=1
+    ) for i in range(target_limits.shape[0] - 1)]))
+    entropy = numpy.asarray(numpy.column_stack([numpy.sum(
+        entropy[:, target_limits[i]:target_limits[i + 1]],
+        axis=1
+    ) for i in range(target_limits.shape[0] - 1)]))
+
+    feature_entropy = numpy.where(freq == 0, 0, freq * numpy.log(freq))
+    entropy = feature_entropy - entropy
+
+    freq = numpy.stack([numpy.sum(
+        freq[feature_limits[i]:feature_limits[i + 1]],
+        axis=0
+    ) for i in range(feature_limits.shape[0] - 1)])
+    entropy = numpy.stack([numpy.sum(
+        entropy[feature_limits[i]:feature_limits[i + 1]],
+        axis=0
+    ) for i in range(feature_limits.shape[0] - 1)])
+
+    return entropy / freq
+
+def encode_features_sklearn(features):
+    """先补全缺失值再使用 OneHotEncoder 的特征编码，用作性能对比的基准"""
+
+    encoder = OneHotEncoder(
+        sparse_output=True,
+        dtype=numpy.float32,
+        handle_unknown='ignore'
+    )
+    features = encoder.fit(
+        SimpleImputer(
+            missing_values='',
+            strategy='most_frequent'
+        ).fit_transform(features)
+    ).transform(features)
+    return features, numpy.asarray([len(c) for c in encoder.categories_])
+
+def timeit(func, *args, repeat=3):
+    """多次运行函数，返回最短耗时及最后一次的结果"""
+
+    best = numpy.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+def cross_strings(data):
+    """以字符串拼接构造交叉特征并编码"""
+
+    return sincomp.similarity.encode_features(
+        sincomp.similarity.cross_features(data).reshape(data.shape[0], -1)
+    )
+
+def cross_integers(data):
+    """以整数编码构造交叉特征并编码"""
+
+    codes, uniques = sincomp.similarity.factorize_features(data)
+    return sincomp.similarity.encode_codes(
+        sincomp.similarity.cross_codes(codes, uniques.shape[0]) \
+            .reshape(data.shape[0], -1)
+    )
+
+def benchmark_encode(data, repeat=3):
+    """对比 OneHotEncoder 和基于 factorize 的特征编码耗时，以及字符串和整数的特征交叉耗时"""
+
+    features = sincomp.similarity.cross_features(data) \
+        .reshape(data.shape[0], -1)
+
+    old_time, (old_result, old_categories) \
+        = timeit(encode_features_sklearn, features, repeat=repeat)
+    new_time, (new_result, new_categories) \
+        = timeit(sincomp.similarity.encode_features, features, repeat=repeat)
+    same = numpy.array_equal(old_categories, new_categories) \
+        and (old_result != new_result).nnz == 0
+    print(
+        f'encode_features: {features.shape[0]} x {features.shape[1]} features, '
+        f'sklearn {old_time * 1000:.1f} ms, factorize {new_time * 1000:.1f} ms, '
+        f'speedup {old_time / new_time:.1f}x, same result {same}'
+    )
+
+    old_time, (_, old_categories) = timeit(cross_strings, data, repeat=repeat)
+    new_time, (_, new_categories) = timeit(cross_integers, data, repeat=repeat)
+    print(
+        f'cross features: {data.shape[0]} x {data.shape[1]} data, '
+        f'string {old_time * 1000:.1f} ms, integer {new_time * 1000:.1f} ms, '
+        f'speedup {old_time / new_time:.1f}x, '
+        f'same categories {numpy.array_equal(old_categories, new_categories)}'
+    )
+
+def benchmark_block(data, blocksize, repeat=3):
+    """对比逐组循环和分组指示矩阵两种分块实现的吞吐量"""
+
+    features, categories = sincomp.similarity.encode_features(data)
+    limits = numpy.concatenate([[0], numpy.cumsum(categories)])
+    probs = sincomp.similarity.freq2prob(
+        features.sum(axis=0).A.flatten(),
+        limits
+    )
+
+    # 取第一块数据测试
+    block = features[:, :limits[blocksize]]
+    block_categories = categories[:blocksize]
+    block_limits = limits[:blocksize + 1]
+    block_probs = probs[:limits[blocksize]]
+
+    for name, old, new in (
+        (
+            'chi2_block',
+            lambda: chi2_block_loop(
+                block, block_categories, block_probs,
+                block, block_categories, block_probs
+            ),
+            lambda: sincomp.similarity.chi2_block(
+                block, block_categories, block_probs,
+                block, block_categories, block_probs
+            )
+        ),
+        (
+            '_entropy',
+            lambda: entropy_loop(block, block_limits, block, block_limits),
+            lambda: sincomp.similarity._entropy(
+                block,
+                block_limits,
+                block,
+                block_limits
+            )
+        )
+    ):
+        old_time, old_result = timeit(old, repeat=repeat)
+        new_time, new_result = timeit(new, repeat=repeat)
+        diff = numpy.nanmax(numpy.abs(old_result - new_result))
+        print(
+            f'{name}: {blocksize} x {blocksize} block, '
+            f'loop {old_time * 1000:.1f} ms ({1 / old_time:.1f} blocks/s), '
+            f'indicator {new_time * 1000:.1f} ms ({1 / new_time:.1f} blocks/s), '
+            f'speedup {old_time / new_time:.1f}x, max diff {diff:.3g}'
+        )
+
+def benchmark_parallel(data, blocksize, parallels, repeat=1):
+    """对比不同并行数下逐任务传递数据块和内存映射共享数据的耗时"""
+
+    for method in 'chi2', 'entropy':
+        func = getattr(sincomp.similarity, method)
+        for mmap in False, True:
+            for parallel in parallels:
+                elapsed, _ = timeit(
+                    lambda: func(
+                        data,
+                        feature_num=3,
+                        blocksize=(blocksize, blocksize),
+                        parallel=parallel,
+                        mmap=mmap
+                    ),
+                    repeat=repeat
+                )
+                print(
+                    f'{method}: parallel = {parallel}, mmap = {mmap}, '
+                    f'{elapsed:.2f} s'
+                )
+
+def sparse_bytes(matrix):
+    """稀疏矩阵占用的字节数"""
+
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+def benchmark_dtype(data, blocksize, repeat=1):
+    """对比不同编码数据类型的内存占用、耗时及相对于 float64 的误差"""
+
+    reference = {}
+    for dtype in numpy.float64, numpy.float32, numpy.int32:
+        prepared = sincomp.similarity.PreparedFeatures(data, dtype=dtype)
+        size = sparse_bytes(prepared.features) + sparse_bytes(prepared.targets)
+
+        for method in 'chi2', 'entropy':
+            func = getattr(sincomp.similarity, method)
+            elapsed, result = timeit(
+                lambda: func(prepared, blocksize=(blocksize, blocksize)),
+                repeat=repeat
+            )
+            reference.setdefault(method, result)
+            error = numpy.nanmax(numpy.abs(result - reference[method]))
+            print(
+                f'{method}: dtype = {numpy.dtype(dtype).name}, '
+                f'encoded {size / 2 ** 20:.1f} MiB, '
+                f'result {result.dtype} {result.nbytes / 2 ** 20:.1f} MiB, '
+                f'{elapsed:.2f} s, max diff to float64 {error:.3g}'
+            )
+
+def benchmark_normalize(size, blocksize=1000, seed=0):
+    """
+    在内存映射的大相似度矩阵上原地正则化并转换为距离，报告耗时及额外内存峰值
+
+    Parameters:
+        size: 相似度矩阵的行列数
+        blocksize: 分块大小
+        seed: 随机数种子
+    """
+
+    rand = numpy.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sim.npy')
+        sim = numpy.lib.format.open_memmap(
+            path,
+            mode='w+',
+            dtype=numpy.float32,
+            shape=(size, size)
+        )
+        for i in range(0, size, blocksize):
+            sim[i:i + blocksize] = rand.random(
+                (min(blocksize, size - i), size),
+                dtype=numpy.float32
+            )
+        sim[numpy.arange(size), numpy.arange(size)] = 1
+        sample = numpy.array(sim[:blocksize, :blocksize], dtype=numpy.float64)
+
+        for name, func in (
+            ('normalize_sim', sincomp.similarity.normalize_sim),
+            ('sim2dist', sincomp.similarity.sim2dist)
+        ):
+            tracemalloc.start()
+            start = time.perf_counter()
+            func(sim, out=sim, blocksize=blocksize)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            # 左上角的分块自成一个方阵，用内存中的结果校验
+            sample = func(sample, blocksize=blocksize)
+            diff = numpy.max(numpy.abs(sim[:blocksize, :blocksize] - sample))
+            print(
+                f'{name}: {size} x {size} float32 memmap in place, '
+                f'{elapsed:.2f} s, peak extra memory {peak / 2 ** 20:.1f} MiB '
+                f'(matrix {sim.nbytes / 2 ** 20:.1f} MiB), '
+                f'corner block max diff {diff:.3g}'
+            )
+
+        del sim
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(globals().get('__doc__'))
+    parser.add_argument('-d', '--dialects', type=int, default=200, help='方言数')
+    parser.add_argument('-c', '--characters', type=int, default=1000, help='字数')
+    parser.add_argument('-b', '--blocksize', type=int, default=100, help='分块大小')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='重复测试次数')
+    parser.add_argument(
+        '-p',
+        '--parallel',
+        type=lambda s: [int(i) for i in s.split(',')],
+        help='测试整体计算在不同并行数下的耗时，为半角逗号分隔的并行数列表'
+    )
+    parser.add_argument(
+        '-t',
+        '--dtype',
+        action='store_true',
+        help='测试不同编码数据类型的内存占用、耗时及精度'
+    )
+    parser.add_argument(
+        '-n',
+        '--normalize',
+        type=int,
+        help='测试在指定大小的内存映射相似度矩阵上原地正则化及转换距离的耗时和内存'
+    )
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.normalize is not None:
+        benchmark_normalize(args.normalize, blocksize=args.blocksize)
+    elif args.dtype:
+        benchmark_dtype(
+            make_data(args.dialects, args.characters),
+            args.blocksize,
+            repeat=args.repeat
+        )
+    elif args.parallel is None:
+        benchmark_encode(
+            make_data(args.dialects, args.characters),
+            repeat=args.repeat
+        )
+        data = make_data(args.dialects, args.characters, feature_num=1)
+        benchmark_block(
+            data,
+            min(args.blocksize, args.dialects),
+            repeat=args.repeat
+        )
+    else:
+        data = make_data(args.dialects, args.characters)
+        benchmark_parallel(data, args.blocksize, args.parallel, repeat=args.repeat)
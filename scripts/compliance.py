@@ -16,11 +16,22 @@ import sincomp.preprocess
 import sincomp.compare
 
 
+def drop_literary(data):
+    """去掉文读音"""
+
+    return data[~data['note'].str.contains('文', na=False)]
+
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.INFO)
 
     parser = argparse.ArgumentParser(globals().get('__doc__'))
-    parser.add_argument('-r', '--rule', help='语音规则文件')
+    parser.add_argument(
+        '-r',
+        '--rule',
+        help='语音规则文件，为 CSV 或 `sincomp.compare.RuleSet` 保存的编译后规则集'
+    )
+    parser.add_argument('-c', '--compile', help='把编译后的规则集保存到该文件')
     parser.add_argument(
         '-n',
         '--norm',
@@ -29,6 +40,26 @@ if __name__ == '__main__':
         help='计算规则符合度的正则化方法'
     )
     parser.add_argument('-o', '--output', help='输出文件名')
+    parser.add_argument(
+        '-s',
+        '--stream',
+        action='store_true',
+        help='逐批加载方言并计算，结果逐批追加到输出文件，不构造完整的宽表'
+    )
+    parser.add_argument(
+        '-b',
+        '--batch',
+        type=int,
+        default=10,
+        help='流式计算时每批的方言数'
+    )
+    parser.add_argument(
+        '-j',
+        '--parallel',
+        type=int,
+        default=1,
+        help='流式计算时的并行数'
+    )
     parser.add_argument('dataset', default='zhongguoyuyan', help='指定输入方言数据集')
     args = parser.parse_args()
 
@@ -40,16 +71,34 @@ if __name__ == '__main__':
         f'output = {output}'
     )
 
-    rule = sincomp.compare.load_rule(args.rule)
-    logging.info(f'{rule.shape[0]} rules loaded.')
+    rule = sincomp.compare.load_rule_set(args.rule)
+    logging.info(f'{len(rule)} rules loaded.')
+    if args.compile is not None:
+        rule.save(args.compile)
+        logging.info(f'compiled rules saved to {args.compile}')
 
-    data = getattr(sincomp.datasets, args.dataset).data
-    data = sincomp.preprocess.transform(
-        data[~data['note'].str.contains('文', na=False)],
-        index='cid',
-        values=['initial', 'final', 'tone'],
-        aggfunc='first'
-    )
+    dataset = getattr(sincomp.datasets, args.dataset)
+
+    if args.stream:
+        with open(output, 'w', encoding='utf-8', newline='') as f:
+            for i, comp in enumerate(sincomp.compare.iter_compliance(
+                dataset,
+                rule,
+                norm=norm,
+                batch=args.batch,
+                parallel=args.parallel,
+                transform=drop_literary
+            )):
+                comp.to_csv(f, header=i == 0, lineterminator='\n')
+                logging.info(f'{comp.shape[0]} dialects written.')
+
+    else:
+        data = sincomp.preprocess.transform(
+            drop_literary(dataset.data),
+            index='cid',
+            values=['initial', 'final', 'tone'],
+            aggfunc='first'
+        )
 
-    comp = sincomp.compare.compliance(data, rule, norm=norm)
-    comp.to_csv(output, lineterminator='\n')
+        comp = sincomp.compare.compliance(data, rule, norm=norm)
+        comp.to_csv(output, lineterminator='\n')
@@ -142,7 +142,11 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output-prefix', help='输出路径前缀')
     parser.add_argument('-f', '--format', default='png', help='保存的图片格式')
     parser.add_argument('data', help='规则符合度数据文件')
-    parser.add_argument('rule', nargs='?', help='语音规则文件')
+    parser.add_argument(
+        'rule',
+        nargs='?',
+        help='语音规则文件，为 CSV 或编译后的规则集'
+    )
     parser.add_argument(
         'dataset',
         nargs='?',
@@ -169,8 +173,11 @@ if __name__ == '__main__':
 
     if args.rule is not None:
         char = getattr(sincomp.datasets, args.dataset).metadata['char_info']
-        rule = sincomp.compare.load_rule(args.rule, characters=char['character'])
-        data.columns = rule.loc[data.columns.astype(int), 'name']
+        rule = sincomp.compare.load_rule_set(
+            args.rule,
+            characters=char['character']
+        )
+        data.columns = rule.rules.loc[data.columns.astype(int), 'name']
 
     columns = data.columns
     data[['latitude', 'longitude']] = dialect[['latitude', 'longitude']]
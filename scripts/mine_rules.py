@@ -0,0 +1,116 @@
+#!/usr/bin/env -S python3 -O
+# -*- coding: utf-8 -*-
+
+"""
+从方言字音数据中自动挖掘在部分方言合并、部分方言区分的语音规则.
+"""
+
+__author__ = '黄艺华 <lernanto@foxmail.com>'
+
+
+import logging
+import argparse
+import pandas as pd
+
+import sincomp.datasets
+import sincomp.preprocess
+import sincomp.compare
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(globals().get('__doc__'))
+    parser.add_argument(
+        '-g',
+        '--groups',
+        help='字类文件，为包含 cid 列的 CSV，与 --column 一起指定字类，如中古音的声母或韵摄'
+    )
+    parser.add_argument(
+        '-c',
+        '--column',
+        action='append',
+        help='字类文件中用作字类的列，可以多次指定，多列组合为一个字类'
+    )
+    parser.add_argument(
+        '-r',
+        '--reference',
+        help='不指定字类文件时，以该参考方言中读音相同的字为一类'
+    )
+    parser.add_argument(
+        '-e',
+        '--element',
+        action='append',
+        choices=('initial', 'final', 'tone'),
+        help='挖掘规则的语音要素，可以多次指定，默认为全部'
+    )
+    parser.add_argument(
+        '-m',
+        '--merge',
+        type=float,
+        default=0.9,
+        help='读音分布的相似度不小于该值视为合并'
+    )
+    parser.add_argument(
+        '-s',
+        '--split',
+        type=float,
+        default=0.5,
+        help='读音分布的相似度不大于该值视为区分'
+    )
+    parser.add_argument(
+        '-p',
+        '--min-support',
+        type=lambda s: float(s) if '.' in s else int(s),
+        default=0.1,
+        help='合并及区分的最少方言数，为小数时指定占方言数的比例'
+    )
+    parser.add_argument('-o', '--output', help='输出规则文件名')
+    parser.add_argument('dataset', default='ccr', help='指定输入方言数据集')
+    args = parser.parse_args()
+
+    if args.groups is None and args.reference is None:
+        parser.error('either --groups or --reference is required')
+    if args.groups is not None and args.column is None:
+        parser.error('--column is required with --groups')
+
+    elements = ['initial', 'final', 'tone'] if args.element is None \
+        else args.element
+    output = f'{args.dataset}_rules.csv' if args.output is None else args.output
+
+    data = getattr(sincomp.datasets, args.dataset).data
+    data = sincomp.preprocess.transform(
+        data[~data['note'].str.contains('文', na=False)].fillna(
+            {'initial': '', 'final': '', 'tone': ''}
+        ),
+        index='cid',
+        values=['initial', 'final', 'tone'],
+        aggfunc='first'
+    )
+
+    if args.groups is not None:
+        groups = pd.read_csv(args.groups, dtype=str).set_index('cid')[args.column]
+        groups = groups.apply(
+            lambda r: None if r.isna().any() else ':'.join(r),
+            axis=1
+        )
+
+    rules = []
+    for element in elements:
+        if args.groups is None:
+            # 以参考方言的同音字为字类
+            groups = data.loc[:, (args.reference, element)]
+            groups = groups.mask(groups == '')
+
+        rules.append(sincomp.compare.mine_rules(
+            data,
+            groups,
+            element,
+            merge=args.merge,
+            split=args.split,
+            min_support=args.min_support
+        ))
+
+    rules = pd.concat(rules, ignore_index=True)
+    sincomp.compare.save_rule(rules, output)
+    logging.info(f'{rules.shape[0]} rules saved to {output}')
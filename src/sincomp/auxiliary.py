@@ -11,9 +11,11 @@ import logging
 import pandas
 import numpy
 import scipy.sparse
+import sklearn.base
 import sklearn.preprocessing
 import sklearn.impute
 import sklearn.feature_extraction.text
+import joblib
 
 
 def make_dict(data, minfreq=None, sort=None):
@@ -144,7 +146,118 @@ def encode(data, dtype=numpy.int32, missing_values='', unknown_value=-1):
 
     return encoder.transform(data), encoder.categories_
 
-def vectorize(data, sep=' ', binary=False, dtype=numpy.int32, norm=None):
+def _tokenize(data, sep=' '):
+    """
+    把字符串矩阵的每格按分隔符切分，展开为 (行, 列, 音) 三元组.
+
+    Parameters:
+        data (`numpy.ndarray`): M x N 字符串矩阵
+        sep (str): 分隔多音字的多个音的分隔符
+
+    Returns:
+        rows, cols (`numpy.ndarray`): 每个音所在的行和列，按列、行的顺序排列
+        tokens (`numpy.ndarray`): 音，已去掉空串及空值
+
+    方言读音的取值很少，因此先对整个矩阵去重，只切分不同的取值，再按编号展开回每一格。
+    """
+
+    # 按列展开，使同一列的音连续排列
+    cells, uniques = pandas.factorize(data.ravel(order='F'))
+
+    # 只切分不同的取值，得到每个取值包含的音在 tokens 中的起始位置及个数
+    tokens = pandas.Series(uniques, dtype=object).str.split(sep).explode()
+    mask = pandas.notna(tokens.values) & (tokens.values != '')
+    owners = tokens.index.values[mask]
+    tokens = tokens.values[mask]
+    counts = numpy.bincount(owners, minlength=uniques.shape[0])
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+
+    # 按每格取值包含的音数展开
+    idx = numpy.nonzero(cells >= 0)[0]
+    cells = cells[idx]
+    repeats = counts[cells]
+    idx = numpy.repeat(idx, repeats)
+    within = numpy.arange(idx.shape[0]) \
+        - numpy.repeat(numpy.cumsum(repeats) - repeats, repeats)
+    tokens = tokens[numpy.repeat(offsets[cells], repeats) + within]
+
+    return idx % data.shape[0], idx // data.shape[0], tokens
+
+def group_indicator(limits, dtype=numpy.float32):
+    """
+    构造把编码列按分组归并的指示矩阵.
+
+    Parameters:
+        limits (`numpy.ndarray`): 编码分组的边界，第 i 组为 [limits[i], limits[i + 1])，
+            如 `vectorize` 返回的编码边界
+        dtype: 指示矩阵的数据类型
+
+    Returns:
+        indicator (`scipy.sparse.csr_matrix`): limits[-1] x (len(limits) - 1) 的稀疏矩阵，
+            第 j 列在第 j 组所属的行为1，其余为0。矩阵右乘指示矩阵即按列分组求和，
+            指示矩阵的转置左乘矩阵即按行分组求和
+    """
+
+    sizes = numpy.diff(limits)
+    return scipy.sparse.csr_matrix(
+        (
+            numpy.ones(limits[-1], dtype=dtype),
+            (
+                numpy.arange(limits[-1]),
+                numpy.repeat(numpy.arange(sizes.shape[0]), sizes)
+            )
+        ),
+        shape=(limits[-1], sizes.shape[0])
+    )
+
+def _normalize_blocks(code, limits, norm):
+    """
+    对稀疏编码的每行在每个列块内分别归一化.
+
+    Parameters:
+        code (`scipy.sparse.csr_matrix`): 稀疏编码，原地修改
+        limits (`numpy.ndarray`): 列块的边界
+        norm (str): 'l1' 或 'l2'
+
+    Returns:
+        code (`scipy.sparse.csr_matrix`): 归一化后的编码
+    """
+
+    rows = numpy.repeat(numpy.arange(code.shape[0]), numpy.diff(code.indptr))
+    blocks = numpy.searchsorted(limits, code.indices, side='right') - 1
+    groups = rows * (limits.shape[0] - 1) + blocks
+
+    values = numpy.abs(code.data) if norm == 'l1' else numpy.square(code.data)
+    norms = numpy.bincount(groups, weights=values)
+    if norm == 'l2':
+        norms = numpy.sqrt(norms)
+
+    dtype = code.dtype if numpy.issubdtype(code.dtype, numpy.floating) \
+        else numpy.float64
+    code.data = (code.data / norms[groups]).astype(dtype, copy=False)
+    return code
+
+def _vectorize_column(column, tokenizer, binary, dtype):
+    """使用自定义分词函数编码一列，用于并行任务"""
+
+    return sklearn.feature_extraction.text.CountVectorizer(
+        lowercase=False,
+        tokenizer=tokenizer,
+        token_pattern=None,
+        stop_words=[''],
+        binary=binary,
+        dtype=dtype
+    ).fit_transform(column)
+
+def vectorize(
+    data,
+    sep=' ',
+    binary=False,
+    dtype=numpy.int32,
+    norm=None,
+    tokenizer=None,
+    parallel=1
+):
     """
     对一个方言读音的数组或包含多个方言读音的矩阵进行稀疏编码.
 
@@ -158,53 +271,234 @@ def vectorize(data, sep=' ', binary=False, dtype=numpy.int32, norm=None):
             - None: 不归一化
             - 'l1': 返回的编码除以向量的1范数
             - 'l2': 返回的编码除以向量的2范数
+        tokenizer (callable): 自定义的分词函数，为 None 时按 `sep` 切分
+        parallel (int): 使用自定义分词函数时逐列编码的并行数
 
     Returns:
         code (`scipy.sparse.csr_matrix`): 稀疏编码得到的稀疏矩阵，行数为 M，列数为所有列读音数之和
         limits (`numpy.ndarray`): 仅当 data 为矩阵时返回，表示编码边界的数组，
             长度为 N + 1，data[:, i] 的编码为 code[:, limits[i]:limits[i + 1]]
+
+    每列的读音按字典序编号，和 `sklearn.feature_extraction.text.CountVectorizer` 相同。
+    默认使用 `Vectorizer` 一次性切分所有列的读音，把列号和读音合并为一个键统一编号，
+    直接构造稀疏矩阵，不需要逐列拟合编码器。需要保留词表编码新数据时直接使用 `Vectorizer`。
+    只有指定自定义分词函数时才逐列使用 CountVectorizer 编码。
     """
 
     if isinstance(data, pandas.DataFrame) or isinstance(data, pandas.Series):
         data = data.values
 
-    if data.ndim == 1:
-        # 一维数组，直接编码返回
-        code = sklearn.feature_extraction.text.CountVectorizer(
-            lowercase=False,
-            tokenizer=lambda s: s.split(sep),
-            token_pattern=None,
-            stop_words=[''],
-            binary=binary,
-            dtype=dtype
-        ).fit_transform(data)
-
-        return code if norm is None else sklearn.preprocessing.normalize(code, norm=norm)
+    matrix = data.ndim > 1
+    if not matrix:
+        data = data[:, None]
 
-    # 矩阵，分别编码每列然后拼接
-    categories = []
-    codes = []
-    columns = []
+    if tokenizer is None:
+        vectorizer = Vectorizer(sep=sep, binary=binary, dtype=dtype, norm=norm)
+        code = vectorizer.fit_transform(data)
+        return (code, vectorizer.limits_) if matrix else code
 
-    for i in range(data.shape[1]):
-        c = sklearn.feature_extraction.text.CountVectorizer(
-            lowercase=False,
-            tokenizer=lambda s: s.split(sep),
-            token_pattern=None,
-            stop_words=[''],
-            binary=binary,
-            dtype=dtype
-        ).fit_transform(data[:, i])
-
-        codes.append(c if norm is None else sklearn.preprocessing.normalize(c, norm=norm))
-        columns.append(c.shape[1])
+    # 自定义分词函数无法批量处理，逐列并行编码后拼接
+    codes = joblib.Parallel(n_jobs=parallel)(
+        joblib.delayed(_vectorize_column)(data[:, i], tokenizer, binary, dtype) \
+            for i in range(data.shape[1])
+    )
+    code = scipy.sparse.csr_matrix(scipy.sparse.hstack(codes))
+    columns = [c.shape[1] for c in codes]
 
-    code = scipy.sparse.hstack(codes)
     # 计算稀疏编码的边界
     limits = numpy.empty(len(columns) + 1, dtype=int)
     limits[0] = 0
     numpy.cumsum(columns, out=limits[1:])
-    return code, limits
+
+    if norm is not None:
+        code = _normalize_blocks(code, limits, norm)
+
+    return (code, limits) if matrix else code
+
+class Vectorizer(sklearn.base.TransformerMixin, sklearn.base.BaseEstimator):
+    """
+    保留词表的方言读音稀疏编码器.
+
+    和 `vectorize` 的编码相同，但拟合后保留每列的读音词表，可以用同一词表编码新的字，
+    或把编码映射回读音，不需要重新编码全部数据。可以用 joblib 或 pickle 保存。
+
+    Attributes:
+        tokens_ (`numpy.ndarray`): 每个编码列对应的读音，按列、列内按字典序排列
+        limits_ (`numpy.ndarray`): 编码边界，第 i 列的编码为 [limits_[i], limits_[i + 1])
+        columns_ (`pandas.Index`): 拟合数据为 pandas.DataFrame 时的列名，否则为 None
+    """
+
+    def __init__(
+        self,
+        sep=' ',
+        binary=False,
+        dtype=numpy.int32,
+        norm=None
+    ):
+        """
+        Parameters:
+            sep, binary, dtype, norm: 同 `vectorize`
+        """
+
+        self.sep = sep
+        self.binary = binary
+        self.dtype = dtype
+        self.norm = norm
+
+    def _validate(self, data):
+        """把输入统一为二维字符串矩阵，pandas.DataFrame 按拟合时的列名对齐"""
+
+        if isinstance(data, pandas.DataFrame):
+            columns = getattr(self, 'columns_', None)
+            if columns is not None:
+                # 拟合时不存在的列忽略，缺少的列视为空值
+                data = data.reindex(columns=columns, fill_value='')
+            data = data.values
+        elif isinstance(data, pandas.Series):
+            data = data.values
+
+        data = numpy.asarray(data, dtype=object)
+        return data[:, None] if data.ndim == 1 else data
+
+    def fit(self, data, y=None):
+        """
+        根据方言读音拟合每列的词表.
+
+        Parameters:
+            data (array): M x N 字符串矩阵或 pandas.DataFrame，也可以为长度为 M 的数组
+
+        Returns:
+            self
+        """
+
+        self.columns_ = data.columns if isinstance(data, pandas.DataFrame) \
+            else None
+        data = self._validate(data)
+        self._fit(data.shape[1], *_tokenize(data, self.sep)[1:])
+        return self
+
+    def _fit(self, column_num, cols, tokens):
+        """根据切分后的读音构造词表"""
+
+        # 先对所有读音排序编号，再和列号合并为键，键的顺序即按列、列内按读音字典序
+        codes, uniques = pandas.factorize(tokens, sort=True)
+        self._uniques = pandas.Index(uniques, dtype=object)
+        self._keys = numpy.unique(
+            cols.astype(numpy.int64) * self._uniques.shape[0] + codes
+        )
+        self.tokens_ = numpy.asarray(
+            self._uniques[self._keys % max(self._uniques.shape[0], 1)],
+            dtype=object
+        )
+
+        columns = numpy.bincount(
+            self._keys // max(self._uniques.shape[0], 1),
+            minlength=column_num
+        )
+        self.limits_ = numpy.empty(column_num + 1, dtype=int)
+        self.limits_[0] = 0
+        numpy.cumsum(columns, out=self.limits_[1:])
+
+    def fit_transform(self, data, y=None):
+        """拟合词表并编码，只切分一次读音"""
+
+        self.columns_ = data.columns if isinstance(data, pandas.DataFrame) \
+            else None
+        data = self._validate(data)
+        rows, cols, tokens = _tokenize(data, self.sep)
+        self._fit(data.shape[1], cols, tokens)
+        return self._encode(data.shape[0], rows, cols, tokens)
+
+    @property
+    def vocabularies_(self):
+        """每列的读音词表"""
+
+        return [self.tokens_[self.limits_[i]:self.limits_[i + 1]] \
+            for i in range(self.limits_.shape[0] - 1)]
+
+    def transform(self, data):
+        """
+        使用拟合的词表编码方言读音.
+
+        Parameters:
+            data (array): 和拟合数据列数相同的字符串矩阵，或列名可以对齐的 pandas.DataFrame
+
+        Returns:
+            code (`scipy.sparse.csr_matrix`): 稀疏编码，列和拟合时相同，词表中没有的读音忽略
+        """
+
+        data = self._validate(data)
+        if data.shape[1] != self.limits_.shape[0] - 1:
+            raise ValueError(
+                f'data has {data.shape[1]} columns, '
+                f'expected {self.limits_.shape[0] - 1}'
+            )
+
+        return self._encode(data.shape[0], *_tokenize(data, self.sep))
+
+    def _encode(self, row_num, rows, cols, tokens):
+        """把切分后的读音按词表编码为稀疏矩阵"""
+
+        # 把 (列, 读音) 映射为拟合时的键，再在有序的键中查找编码列
+        codes = self._uniques.get_indexer(tokens)
+        keys = cols.astype(numpy.int64) * self._uniques.shape[0] + codes
+        idx = numpy.minimum(
+            numpy.searchsorted(self._keys, keys),
+            max(self._keys.shape[0] - 1, 0)
+        )
+        mask = (codes >= 0) & (self._keys.shape[0] > 0)
+        mask[mask] = self._keys[idx[mask]] == keys[mask]
+
+        code = scipy.sparse.csr_matrix(
+            (
+                numpy.ones(numpy.count_nonzero(mask), dtype=self.dtype),
+                (rows[mask], idx[mask])
+            ),
+            shape=(row_num, self.tokens_.shape[0])
+        )
+        code.sum_duplicates()
+        if self.binary:
+            code.data[:] = 1
+
+        if self.norm is not None:
+            code = _normalize_blocks(code, self.limits_, self.norm)
+
+        return code
+
+    def inverse_transform(self, code):
+        """
+        把稀疏编码映射回读音.
+
+        Parameters:
+            code (`scipy.sparse.spmatrix`): 和 `transform` 输出同样列的稀疏编码
+
+        Returns:
+            data (`numpy.ndarray`): M x N 字符串矩阵，每格为编码非零的读音以分隔符连接，
+                没有读音的为空字符串
+        """
+
+        code = scipy.sparse.csr_matrix(code)
+        code.eliminate_zeros()
+        code.sort_indices()
+
+        rows = numpy.repeat(numpy.arange(code.shape[0]), numpy.diff(code.indptr))
+        cols = numpy.searchsorted(self.limits_, code.indices, side='right') - 1
+
+        data = numpy.full(
+            (code.shape[0], self.limits_.shape[0] - 1),
+            '',
+            dtype=object
+        )
+        if rows.shape[0] > 0:
+            joined = pandas.Series(self.tokens_[code.indices]) \
+                .groupby([rows, cols], sort=False) \
+                .agg(self.sep.join)
+            data[
+                joined.index.get_level_values(0),
+                joined.index.get_level_values(1)
+            ] = joined.values
+
+        return data
 
 class OrdinalEncoder(sklearn.preprocessing.OrdinalEncoder):
     """
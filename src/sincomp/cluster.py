@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+"""
+根据方言相似度层级聚类，并导出聚类树.
+
+聚类只计算一次，结果连同叶子顺序可以缓存到文件，供绘图等后续步骤重复使用。
+"""
+
+__author__ = '黄艺华 <lernanto@foxmail.com>'
+
+
+import os
+import logging
+import json
+import pandas
+import numpy
+import scipy.cluster.hierarchy
+
+
+def condensed_distance(
+    sim: numpy.ndarray[float] | pandas.DataFrame,
+    normalize: bool = True,
+    blocksize: int = 1000
+) -> numpy.ndarray[float]:
+    """
+    分块把相似度矩阵转换成压缩形式的距离矩阵
+
+    Parameters:
+        sim: 方阵形式的相似度矩阵，可以为内存映射
+        normalize: 为真时先把相似度正则化到 [-1, 1] 区间，见 `similarity.normalize_sim`
+        blocksize: 每次读取的行数
+
+    Returns:
+        dist: 压缩形式的距离矩阵，即上三角阵按行展开的一维数组，
+            可以直接传给 `scipy.cluster.hierarchy.linkage`
+
+    和 `similarity.sim2dist` 相同，假设相似度是向量的内积，则距离的平方
+    dij^2 = sii + sjj - 2sij。每次只读取若干行及相应的列，不生成完整的中间矩阵，
+    内存占用只有结果的压缩距离矩阵。
+    """
+
+    sim = numpy.asarray(sim)
+    num = sim.shape[0]
+    diag = numpy.diagonal(sim).astype(numpy.float64)
+
+    dist = numpy.empty(num * (num - 1) // 2, dtype=numpy.float64)
+    overflow = 0
+    minus = 0
+
+    for start in range(0, num, blocksize):
+        end = min(start + blocksize, num)
+
+        # 和转置取平均构造对称阵
+        block = (numpy.asarray(sim[start:end], dtype=numpy.float64) \
+            + numpy.asarray(sim[:, start:end], dtype=numpy.float64).T) / 2
+
+        if normalize:
+            # 除以对角线元素的平方根缩放到 [-1, 1] 区间，此时对角线元素为1
+            block /= numpy.sqrt(diag[start:end, None] * diag[None, :])
+            overflow += numpy.count_nonzero((block < -1) | (block > 1))
+            block = numpy.clip(block, -1, 1)
+            d2 = 2 - 2 * block
+        else:
+            d2 = diag[start:end, None] + diag[None, :] - 2 * block
+
+        # 有少量元素 < 0 是由于计算相似度的时候取近似导致的，强制为0
+        minus += numpy.count_nonzero(d2 < 0)
+        d = numpy.sqrt(numpy.maximum(d2, 0))
+
+        for i in range(start, end):
+            offset = i * num - i * (i + 1) // 2
+            dist[offset:offset + num - i - 1] = d[i - start, i + 1:]
+
+    if overflow > 0:
+        logging.warning(f'{overflow}/{sim.size} similarity out of [-1, 1], clip')
+    if minus > 0:
+        logging.warning(f'{minus}/{sim.size} distance square < 0, clip to 0')
+
+    return dist
+
+class Clustering:
+    """
+    层级聚类结果
+
+    Attributes:
+        linkage: `scipy.cluster.hierarchy.linkage` 格式的聚类结果
+        labels: 叶子节点的名称，为 None 时以下标代替
+        leaves: 叶子节点在聚类树中从左到右的顺序
+        params: 生成聚类结果的参数，用于判断缓存是否可用
+    """
+
+    def __init__(
+        self,
+        linkage: numpy.ndarray[float],
+        labels: pandas.Index | numpy.ndarray[str] | None = None,
+        leaves: numpy.ndarray[int] | None = None,
+        params: dict | None = None
+    ):
+        """
+        Parameters:
+            linkage: 聚类结果
+            labels: 叶子节点的名称
+            leaves: 叶子节点的顺序，为 None 时根据 `linkage` 计算
+            params: 生成聚类结果的参数，必须可以序列化为 JSON
+        """
+
+        self.linkage = linkage
+        self.labels = None if labels is None else pandas.Index(labels)
+        self.leaves = scipy.cluster.hierarchy.leaves_list(linkage) \
+            if leaves is None else numpy.asarray(leaves)
+        self.params = {} if params is None else dict(params)
+
+    @property
+    def size(self) -> int:
+        """叶子节点数"""
+
+        return self.linkage.shape[0] + 1
+
+    def _names(self) -> list[str]:
+        return [str(i) for i in range(self.size)] if self.labels is None \
+            else [str(l) for l in self.labels]
+
+    def reorder(
+        self,
+        matrix: numpy.ndarray | pandas.DataFrame
+    ) -> numpy.ndarray | pandas.DataFrame:
+        """按叶子顺序重新排列方阵的行列"""
+
+        if isinstance(matrix, pandas.DataFrame):
+            return matrix.iloc[self.leaves, self.leaves]
+
+        return numpy.asarray(matrix)[self.leaves][:, self.leaves]
+
+    def cut(self, n: int) -> pandas.Series | numpy.ndarray[int]:
+        """
+        把聚类树切分为指定数量的类
+
+        Parameters:
+            n: 类的数量
+
+        Returns:
+            clusters: 每个叶子节点所属的类，从1开始编号
+        """
+
+        clusters = scipy.cluster.hierarchy.fcluster(
+            self.linkage,
+            n,
+            criterion='maxclust'
+        )
+        return clusters if self.labels is None \
+            else pandas.Series(clusters, index=self.labels)
+
+    def to_newick(self) -> str:
+        """
+        导出 Newick 格式的聚类树
+
+        Returns:
+            newick: Newick 格式字符串，分支长度为父子节点的高度差
+
+        使用显式的栈遍历聚类树，避免方言数量很多时递归深度超出限制。
+        """
+
+        names = []
+        for name in self._names():
+            # 包含特殊字符的名称需要加引号，引号本身重复一次
+            if any(c in name for c in ' ()[]\':;,'):
+                name = "'" + name.replace("'", "''") + "'"
+            names.append(name)
+
+        num = self.size
+        heights = numpy.concatenate([numpy.zeros(num), self.linkage[:, 2]])
+        parts = []
+        # 栈元素为 (节点, 父节点高度)，为字符串时直接输出
+        stack = [(2 * num - 2, None)]
+        while stack:
+            node, parent = stack.pop()
+            if isinstance(node, str):
+                parts.append(node)
+                continue
+
+            length = '' if parent is None else f':{parent - heights[node]:g}'
+            if node < num:
+                parts.append(names[node] + length)
+            else:
+                left, right = self.linkage[node - num, :2].astype(int)
+                height = heights[node]
+                parts.append('(')
+                stack.extend([
+                    (')' + length, None),
+                    (right, height),
+                    (',', None),
+                    (left, height)
+                ])
+
+        return ''.join(parts) + ';'
+
+    def to_dict(self) -> dict:
+        """
+        导出扁平结构的聚类树
+
+        Returns:
+            tree: 包含 labels、leaves 及 nodes 的字典，nodes 的每个元素为一个内部节点，
+                包含节点编号 id、2个子节点编号 children、高度 height 及叶子数 count。
+                编号小于叶子数的为叶子节点，对应 labels 中的下标
+        """
+
+        num = self.size
+        return {
+            'labels': self._names(),
+            'leaves': self.leaves.tolist(),
+            'nodes': [{
+                'id': num + i,
+                'children': [int(left), int(right)],
+                'height': float(height),
+                'count': int(count)
+            } for i, (left, right, height, count) in enumerate(self.linkage)]
+        }
+
+    def to_json(self, path: str | os.PathLike | None = None) -> str | None:
+        """导出 JSON 格式的聚类树，指定 `path` 时写入文件，否则返回字符串"""
+
+        if path is None:
+            return json.dumps(self.to_dict(), ensure_ascii=False)
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    def save(self, path: str | os.PathLike) -> None:
+        """保存聚类结果、叶子顺序及参数到 .npz 文件"""
+
+        data = {
+            'linkage': self.linkage,
+            'leaves': self.leaves,
+            'params': numpy.asarray(json.dumps(self.params, sort_keys=True))
+        }
+        if self.labels is not None:
+            data['labels'] = numpy.asarray(self.labels, dtype=str)
+
+        with open(path, 'wb') as f:
+            numpy.savez(f, **data)
+
+    @classmethod
+    def load(cls, path: str | os.PathLike) -> 'Clustering':
+        """从 .npz 文件加载聚类结果"""
+
+        with numpy.load(path) as data:
+            return cls(
+                data['linkage'],
+                labels=data['labels'] if 'labels' in data else None,
+                leaves=data['leaves'],
+                params=json.loads(data['params'].item()) \
+                    if 'params' in data else None
+            )
+
+    def match(
+        self,
+        size: int,
+        labels: pandas.Index | numpy.ndarray[str] | None = None,
+        **params
+    ) -> bool:
+        """
+        检查聚类结果是否和指定的方言及参数一致
+
+        Parameters:
+            size: 方言数
+            labels: 方言名称，为 None 时不检查
+            params: 聚类参数
+
+        Returns:
+            matched: 方言数、方言名称及参数都一致时为真
+        """
+
+        if self.size != size or self.params != params:
+            return False
+
+        if labels is not None:
+            return self.labels is not None \
+                and self.labels.astype(str).equals(pandas.Index(labels).astype(str))
+
+        return True
+
+def cluster(
+    sim: numpy.ndarray[float] | pandas.DataFrame,
+    labels: pandas.Index | numpy.ndarray[str] | None = None,
+    method: str = 'average',
+    optimal_ordering: bool = True,
+    normalize: bool = True,
+    blocksize: int = 1000,
+    cache: str | os.PathLike | None = None
+) -> Clustering:
+    """
+    根据相似度矩阵层级聚类
+
+    Parameters:
+        sim: 方阵形式的相似度矩阵，可以为内存映射
+        labels: 方言名称，为 None 且 `sim` 为 pandas.DataFrame 时取 `sim` 的行名
+        method: 聚类方法，见 `scipy.cluster.hierarchy.linkage`
+        optimal_ordering: 是否调整叶子顺序使相邻叶子的距离之和最小，方言数量多时较慢
+        normalize: 是否先把相似度正则化到 [-1, 1] 区间
+        blocksize: 转换距离矩阵时每次读取的行数
+        cache: 缓存文件路径，文件存在且其中的方言及参数和本次一致时直接加载，
+            否则重新聚类并保存到该文件
+
+    Returns:
+        clustering: 聚类结果
+    """
+
+    if labels is None and isinstance(sim, pandas.DataFrame):
+        labels = sim.index
+
+    params = {
+        'method': method,
+        'optimal_ordering': optimal_ordering,
+        'normalize': normalize
+    }
+
+    if cache is not None and os.path.isfile(cache):
+        clustering = Clustering.load(cache)
+        if clustering.match(sim.shape[0], labels, **params):
+            logging.info(f'load clustering from {cache}')
+            return clustering
+
+        logging.warning(
+            f'{cache} does not match the dialects or parameters, recompute'
+        )
+
+    logging.info(
+        f'clustering {sim.shape[0]} dialects, method = {method}, '
+        f'optimal ordering = {optimal_ordering} ...'
+    )
+
+    linkage = scipy.cluster.hierarchy.linkage(
+        condensed_distance(sim, normalize=normalize, blocksize=blocksize),
+        method=method,
+        optimal_ordering=optimal_ordering
+    )
+    clustering = Clustering(linkage, labels=labels, params=params)
+
+    logging.info('done.')
+
+    if cache is not None:
+        clustering.save(cache)
+        logging.info(f'clustering saved to {cache}')
+
+    return clustering
@@ -5,11 +5,17 @@
 __author__ = '黄艺华 <lernanto@foxmail.com>'
 
 
+import os
+import logging
+import itertools
 import pandas
 import numpy
-from sklearn.preprocessing import normalize
+import scipy.sparse
+import joblib
 
 from . import auxiliary
+from . import datasets
+from . import preprocess
 
 
 def load_rule(fname, characters=None):
@@ -29,6 +35,20 @@ def load_rule(fname, characters=None):
         converters={'cid1': str.split, 'cid2': str.split},
         comment='#'
     )
+    return _rule_names(rules, characters)
+
+def _rule_names(rules, characters=None):
+    """
+    根据规则的字集生成规则名称.
+
+    Parameters:
+        rules (`pandas.DataFrame`): 语音规则表，须包含 element、cid1、cid2 列
+        characters (`pandas.Series`): 字 ID 到字的映射表，为 None 时以字 ID 命名
+
+    Returns:
+        rules (`pandas.DataFrame`): 增加了 name 列的语音规则表，指定 `characters` 时
+            另外增加字集对应的字 char1、char2 列
+    """
 
     if characters is None:
         rules['name'] = rules['element'] + ':' \
@@ -42,6 +62,196 @@ def load_rule(fname, characters=None):
 
     return rules
 
+def save_rule(rules, fname):
+    """
+    以 `load_rule` 能读取的 CSV 格式保存语音规则.
+
+    Parameters:
+        rules (`pandas.DataFrame`): 语音规则表，cid1、cid2 列为字 ID 列表，其他列原样保存
+        fname (str): 输出文件路径
+    """
+
+    rules.assign(
+        cid1=rules['cid1'].str.join(' '),
+        cid2=rules['cid2'].str.join(' ')
+    ).drop(columns=['name', 'char1', 'char2'], errors='ignore').to_csv(
+        fname,
+        index=False,
+        encoding='utf-8',
+        lineterminator='\n'
+    )
+
+def _rule_indicator(cids, index, dtype=numpy.float32):
+    """
+    构造规则字集的稀疏指示矩阵.
+
+    Parameters:
+        cids (`pandas.Series`): 每个元素为一条规则字集的字 ID 列表，如 `load_rule` 返回的 cid1
+        index (`pandas.Index`): 方言字音数据表的字 ID 索引
+        dtype: 指示矩阵的数据类型
+
+    Returns:
+        indicator (`scipy.sparse.csr_matrix`): 规则数 x 字数的稀疏矩阵，
+            字集中的字对应列为1，不在 index 中的字忽略，重复的字计数累加
+    """
+
+    num = len(cids)
+    # 展开所有规则的字集，一次性映射到数据表的行号
+    cids = pandas.Series(cids.values).explode()
+    cols = pandas.Index(index).get_indexer(cids.values)
+    mask = cols >= 0
+
+    return scipy.sparse.csr_matrix(
+        (
+            numpy.ones(numpy.count_nonzero(mask), dtype=dtype),
+            (cids.index.values[mask], cols[mask])
+        ),
+        shape=(num, len(index))
+    )
+
+def _group_norm(x, indicator, norm):
+    """
+    按方言分组计算读音向量的范数.
+
+    Parameters:
+        x (`scipy.sparse.csr_matrix`): 规则数 x 编码数的读音分布
+        indicator (`scipy.sparse.csr_matrix`): 编码数 x 方言数的分组指示矩阵
+        norm (str): 'l1' 或 'l2'
+
+    Returns:
+        norms (`numpy.ndarray`): 规则数 x 方言数的范数矩阵
+    """
+
+    if norm == 'l1':
+        return (abs(x) @ indicator).toarray()
+
+    return numpy.sqrt((x.multiply(x) @ indicator).toarray())
+
+class RuleSet:
+    """
+    编译后的语音规则集.
+
+    把规则的字集预先编码为规则 x 字的稀疏成员矩阵，字 ID 只解析一次，可以保存到文件，
+    计算符合度时只需把列映射到具体数据集的字索引。
+
+    Attributes:
+        rules (`pandas.DataFrame`): 规则元数据，包括 element、name 等，不含字集列
+        cids (`pandas.DataFrame`): 每条规则的2个字集 cid1、cid2，用于重新生成规则名称
+        characters (`pandas.Index`): 所有规则涉及的字 ID，为成员矩阵的列
+        membership1, membership2 (`scipy.sparse.csr_matrix`): 规则数 x 字数的成员矩阵，
+            分别对应每条规则的2个字集
+        elements (dict): 语音要素（声母、韵母、声调）到属于该要素的规则行号的映射
+    """
+
+    def __init__(self, rules, dtype=numpy.float32):
+        """
+        Parameters:
+            rules (`pandas.DataFrame`): `load_rule` 返回的语音规则表
+            dtype: 成员矩阵的数据类型
+        """
+
+        self.characters = pandas.Index(
+            pandas.concat([rules['cid1'].explode(), rules['cid2'].explode()])
+                .dropna()
+                .unique()
+        )
+        self.membership1 = _rule_indicator(rules['cid1'], self.characters, dtype)
+        self.membership2 = _rule_indicator(rules['cid2'], self.characters, dtype)
+        self.cids = rules[['cid1', 'cid2']]
+        self.rules = rules.drop(columns=['cid1', 'cid2'])
+        self.elements = dict(self.rules.groupby('element').indices)
+
+    def __len__(self):
+        return self.rules.shape[0]
+
+    @property
+    def index(self):
+        """规则的索引，即符合度表的列"""
+
+        return self.rules.index
+
+    def bind(self, index):
+        """
+        把成员矩阵的列映射到数据集的字索引.
+
+        Parameters:
+            index (`pandas.Index`): 方言字音数据表的字 ID 索引
+
+        Returns:
+            membership1, membership2 (`scipy.sparse.csr_matrix`): 规则数 x len(index)
+                的成员矩阵，不在 index 中的字忽略
+        """
+
+        # 映射矩阵只有规则涉及的字数那么多行，右乘即完成列的重排
+        cols = pandas.Index(index).get_indexer(self.characters)
+        mask = cols >= 0
+        mapping = scipy.sparse.csr_matrix(
+            (
+                numpy.ones(numpy.count_nonzero(mask), dtype=self.membership1.dtype),
+                (numpy.nonzero(mask)[0], cols[mask])
+            ),
+            shape=(self.characters.shape[0], len(index))
+        )
+        return self.membership1 @ mapping, self.membership2 @ mapping
+
+    def rename(self, characters=None):
+        """
+        根据字 ID 到字的映射表重新生成规则名称，使名称和从 CSV 加载时一致.
+
+        Parameters:
+            characters (`pandas.Series`): 字 ID 到字的映射表，为 None 时以字 ID 命名
+        """
+
+        if getattr(self, 'cids', None) is None:
+            raise ValueError(
+                'rule set was compiled without character sets, '
+                'cannot regenerate rule names, recompile it from CSV'
+            )
+
+        self.rules = _rule_names(
+            self.rules.drop(columns=['name', 'char1', 'char2'], errors='ignore')
+                .join(self.cids),
+            characters
+        ).drop(columns=['cid1', 'cid2'])
+
+    def save(self, path):
+        """保存编译后的规则集到文件"""
+
+        joblib.dump(self, path)
+
+    @classmethod
+    def load(cls, path):
+        """从文件加载编译后的规则集"""
+
+        rules = joblib.load(path)
+        if not isinstance(rules, cls):
+            raise TypeError(f'{path} does not contain {cls.__name__}')
+
+        return rules
+
+def load_rule_set(fname, characters=None):
+    """
+    加载语音规则集.
+
+    Parameters:
+        fname (str): 语音规则文件路径，扩展名为 .csv 时解析后编译，否则视为
+            `RuleSet.save` 保存的编译后规则集
+        characters (`pandas.Series`): 字 ID 到字的映射表，用于生成规则名称，
+            加载编译后的规则集时据此重新生成，使名称和规则来源无关
+
+    Returns:
+        rules (`RuleSet`): 编译后的语音规则集
+    """
+
+    if os.path.splitext(fname)[1].lower() == '.csv':
+        return RuleSet(load_rule(fname, characters=characters))
+
+    rules = RuleSet.load(fname)
+    if characters is not None:
+        rules.rename(characters)
+
+    return rules
+
 def compliance(data, rules, dtype=numpy.float32, norm='l2'):
     """
     计算方言字音对语音规则的符合度.
@@ -52,7 +262,7 @@ def compliance(data, rules, dtype=numpy.float32, norm='l2'):
 
     Parameters:
         data (`pandas.DataFrame`): 方言字音数据表
-        rules (`pandas.DataFrame`): 语音规则数据表
+        rules (`pandas.DataFrame` or `RuleSet`): 语音规则数据表或编译后的规则集
         norm (str): 计算相似度时是否归一化
             - None: 不归一化
             - 'l1': 相似度除以向量的1范数
@@ -60,38 +270,296 @@ def compliance(data, rules, dtype=numpy.float32, norm='l2'):
 
     Returns:
         similarities (`pandas.DataFrame`): 读音相似度数据表，每行为一个方言，每列为一条规则
+
+    所有规则的字集先构造成规则 x 字的稀疏指示矩阵，和读音的 one-hot 编码相乘即得到所有规则在
+    所有方言的读音分布。再通过编码列到方言的分组指示矩阵，一次计算所有方言的范数及内积，
+    不需要逐条规则或逐个方言循环。
     """
 
+    if not isinstance(rules, RuleSet):
+        rules = RuleSet(rules, dtype=dtype)
+
+    indicator1, indicator2 = rules.bind(data.index)
+
     comp = []
-    for element, rule in rules.groupby('element'):
+    for element, idx in rules.elements.items():
         element_data = data.loc[:, pandas.IndexSlice[:, element]]
 
         # 先对方言读音 one-hot 编码
         code, lim = auxiliary.vectorize(element_data, dtype=dtype)
+        code = scipy.sparse.csr_matrix(code)
 
         # 计算字集的读音向量
-        code1 = numpy.empty((rule.shape[0], code.shape[1]), dtype=dtype)
-        code2 = numpy.empty((rule.shape[0], code.shape[1]), dtype=dtype)
-        for i, (_, r) in enumerate(rule.iterrows()):
-            code1[i] = code[data.index.get_indexer(r['cid1'])].sum(axis=0).A[0]
-            code2[i] = code[data.index.get_indexer(r['cid2'])].sum(axis=0).A[0]
-
-        # 计算读音分布相似度，对读音向量分别归一化后内积
-        sim = numpy.empty((element_data.shape[1], rule.shape[0]), dtype=dtype)
-        for i in range(element_data.shape[1]):
-            x1 = code1[:, lim[i]:lim[i + 1]]
-            x2 = code2[:, lim[i]:lim[i + 1]]
-            if norm is not None:
-                x1 = normalize(x1, norm=norm)
-                x2 = normalize(x2, norm=norm)
-
-            numpy.sum(x1 * x2, axis=1, out=sim[i])
+        code1 = indicator1[idx] @ code
+        code2 = indicator2[idx] @ code
+
+        # 编码列到方言的分组指示矩阵，右乘即按方言分组求和
+        group = auxiliary.group_indicator(lim, dtype=dtype)
+
+        # 计算读音分布相似度，即读音向量的内积除以各自的范数
+        sim = (code1.multiply(code2) @ group).toarray()
+        if norm is not None:
+            denom = _group_norm(code1, group, norm) * _group_norm(code2, group, norm)
+            # 范数为0的读音向量保持为0，相似度也为0
+            numpy.divide(sim, denom, out=sim, where=denom > 0)
 
         comp.append(pandas.DataFrame(
-            sim,
+            sim.T.astype(dtype, copy=False),
             index=element_data.columns.get_level_values(0),
-            columns=rule.index
+            columns=rules.index[idx]
         ))
 
     # 结果数据按输入规则的顺序重新排序
     return pandas.concat(comp, axis=1).reindex(rules.index, axis=1)
+
+def _dialect_chunks(data, batch):
+    """
+    把方言数据按方言切分为若干长表，每次只加载一部分方言.
+
+    Parameters:
+        data (`datasets.FileDataset` or `pandas.DataFrame` or iterable):
+            基于文件的数据集，逐个方言从文件加载；或包含 did 列的长表；
+            或产出长表的可迭代对象，每个长表原样作为一块
+        batch (int): 每块包含的方言数
+
+    Returns:
+        chunks (iterator of `pandas.DataFrame`): 逐块产出的方言读音长表
+    """
+
+    if isinstance(data, datasets.FileDataset):
+        dids = data.dids
+        for i in range(0, len(dids), batch):
+            yield pandas.concat(
+                [data.load(did) for did in dids[i:i + batch]],
+                axis=0,
+                ignore_index=True
+            )
+
+    elif isinstance(data, pandas.DataFrame):
+        # 只排序一次，把同一方言的行排在一起，之后按偏移切片，不必每块重新扫描全表
+        codes, dids = pandas.factorize(data['did'])
+        order = numpy.argsort(codes, kind='stable')
+        # did 缺失的行编码为 -1，排在最前，跳过
+        order = order[codes[order] >= 0]
+        counts = numpy.bincount(codes[codes >= 0], minlength=len(dids))
+        limits = numpy.concatenate([[0], numpy.cumsum(counts)])
+        for i in range(0, len(dids), batch):
+            yield data.iloc[order[limits[i]:limits[min(i + batch, len(dids))]]]
+
+    else:
+        yield from data
+
+def _chunk_compliance(data, rules, transform, dtype, norm):
+    """把一块方言长表转换为宽表后计算规则符合度，用于并行任务"""
+
+    if transform is not None:
+        data = transform(data)
+
+    data = preprocess.transform(
+        data.fillna({e: '' for e in rules.elements}),
+        index='cid',
+        values=list(rules.elements),
+        aggfunc='first'
+    )
+    return compliance(data, rules, dtype=dtype, norm=norm)
+
+def iter_compliance(
+    data,
+    rules,
+    dtype=numpy.float32,
+    norm='l2',
+    batch=1,
+    parallel=1,
+    transform=None
+):
+    """
+    流式地逐批计算方言对语音规则的符合度.
+
+    每个方言的符合度只依赖自身的读音，因此可以每次只加载若干方言，转换成宽表后计算，
+    不需要在内存中构造所有方言的完整宽表。各批次分发到进程池并行计算，
+    同时提交的批次数有上限，结果按输入顺序逐批产出。
+
+    Parameters:
+        data (`datasets.FileDataset` or `pandas.DataFrame` or iterable): 方言读音数据，
+            见 `_dialect_chunks`
+        rules (`pandas.DataFrame` or `RuleSet`): 语音规则数据表或编译后的规则集
+        dtype: 编码的数据类型
+        norm (str): 计算相似度时是否归一化，见 `compliance`
+        batch (int): 每批包含的方言数
+        parallel (int): 并行计算的进程数
+        transform (callable): 在转换宽表之前对每批长表的预处理，如过滤文读
+
+    Returns:
+        comp (iterator of `pandas.DataFrame`): 逐批产出的符合度表，每行为一个方言，每列为一条规则
+    """
+
+    if not isinstance(rules, RuleSet):
+        rules = RuleSet(rules, dtype=dtype)
+
+    tasks = (joblib.delayed(_chunk_compliance)(c, rules, transform, dtype, norm) \
+        for c in _dialect_chunks(data, batch))
+    # 每次只提交有限个批次，使同时驻留内存的方言数据有上限
+    size = joblib.effective_n_jobs(parallel) * 2
+    with joblib.Parallel(n_jobs=parallel) as pool:
+        while True:
+            results = pool(itertools.islice(tasks, size))
+            if len(results) == 0:
+                break
+
+            for comp in results:
+                logging.debug(f'{comp.shape[0]} dialects done.')
+                yield comp
+
+def _class_distributions(code, limits, classes):
+    """
+    计算每个字类在每个方言的读音分布，并在每个方言内做 L2 归一化.
+
+    Parameters:
+        code (`scipy.sparse.csr_matrix`): 字数 x 编码数的读音编码
+        limits (`numpy.ndarray`): 每个方言的编码边界
+        classes (`scipy.sparse.csr_matrix`): 字类数 x 字数的指示矩阵
+
+    Returns:
+        dist (`scipy.sparse.csr_matrix`): 字类数 x 编码数的归一化读音分布，
+            任意2个字类的行在一个方言的编码列上的内积即为该方言中2个字类读音分布的余弦相似度
+        present (`numpy.ndarray`): 字类数 x 方言数的布尔矩阵，表示字类在方言中是否有读音
+    """
+
+    group = auxiliary.group_indicator(limits, dtype=code.dtype)
+    dist = scipy.sparse.csr_matrix(classes @ code)
+    norms = _group_norm(dist, group, 'l2')
+
+    # 每个非零元素除以所在行在所属方言的范数
+    rows = numpy.repeat(numpy.arange(dist.shape[0]), numpy.diff(dist.indptr))
+    dialects = numpy.repeat(numpy.arange(limits.shape[0] - 1), numpy.diff(limits))
+    dist.data = dist.data / norms[rows, dialects[dist.indices]]
+    return dist, norms > 0
+
+def mine_rules(
+    data,
+    groups,
+    element,
+    merge=0.9,
+    split=0.5,
+    min_support=0.1,
+    min_size=2,
+    blocksize=10000,
+    dtype=numpy.float32
+):
+    """
+    从方言读音中自动挖掘合并型语音规则.
+
+    候选规则为一对字类，如中古音的2个声母或韵摄。如果2个字类在一部分方言中读音分布几乎相同，
+    即已经合并，而在另一部分方言中读音分布明显不同，即仍然区分，则该字类对是区分方言的合并规则。
+    2个字类在一个方言中的相似度为读音分布的余弦相似度，和 `compliance` 取 L2 归一化时相同。
+
+    Parameters:
+        data (`pandas.DataFrame`): 方言字音数据宽表，同 `compliance`
+        groups (`pandas.Series`): 字 ID 到字类的映射，空值的字不参与
+        element (str): 挖掘规则的语音要素，如 initial、final、tone
+        merge (float): 相似度不小于该值视为在该方言中合并
+        split (float): 相似度不大于该值视为在该方言中区分
+        min_support (float or int): 合并及区分的方言数均不少于该值才作为规则输出，
+            为实数时指定占方言数的比例
+        min_size (int): 字数少于该值的字类不参与
+        blocksize (int): 精确计数时每批计算的字类对数
+        dtype: 编码的数据类型
+
+    Returns:
+        rules (`pandas.DataFrame`): 挖掘出的规则，包含 `load_rule` 格式的 element、cid1、cid2 列，
+            以及字类名称 group1、group2，有效方言数 dialects，合并方言数 merged，区分方言数 split，
+            按合并及区分方言数的较小值从大到小排列，可以用 `save_rule` 保存
+
+    字类对的数量为字类数的平方，逐对逐方言计算代价很高，因此先用上界剪枝：
+    余弦相似度在 [0, 1] 区间，所有方言的相似度之和 S 可以通过一次稀疏矩阵乘法得到，
+    合并方言数不超过 S / merge，区分方言数不超过 (V - S) / (1 - split)，其中 V 为2个字类都有读音的方言数。
+    上界不满足支持度的字类对直接剪除，只有剩余的候选对才分批精确计数。
+    """
+
+    element_data = data.loc[:, pandas.IndexSlice[:, element]]
+    dialect_num = element_data.shape[1]
+    if isinstance(min_support, float):
+        min_support = int(numpy.ceil(min_support * dialect_num))
+    min_support = max(min_support, 1)
+
+    # 构造字类 x 字的指示矩阵，过滤字数太少的字类
+    groups = groups.reindex(data.index)
+    codes, names = pandas.factorize(groups)
+    sizes = numpy.bincount(codes[codes >= 0], minlength=names.shape[0])
+    keep = numpy.nonzero(sizes >= min_size)[0]
+    remap = numpy.full(names.shape[0], -1)
+    remap[keep] = numpy.arange(keep.shape[0])
+    codes = numpy.where(codes >= 0, remap[codes], -1)
+    names = names[keep]
+    mask = codes >= 0
+    classes = scipy.sparse.csr_matrix(
+        (
+            numpy.ones(numpy.count_nonzero(mask), dtype=dtype),
+            (codes[mask], numpy.nonzero(mask)[0])
+        ),
+        shape=(names.shape[0], data.shape[0])
+    )
+
+    logging.info(
+        f'mining {element} rules from {names.shape[0]} classes x '
+        f'{dialect_num} dialects, merge >= {merge}, split <= {split}, '
+        f'min support = {min_support} ...'
+    )
+
+    code, lim = auxiliary.vectorize(element_data, dtype=dtype)
+    dist, present = _class_distributions(scipy.sparse.csr_matrix(code), lim, classes)
+
+    # 上界剪枝，相似度之和为稀疏矩阵，只有共享读音的字类对才可能合并
+    total = scipy.sparse.triu(dist @ dist.T, k=1).tocoo()
+    present = present.astype(dtype)
+    valid = numpy.asarray((present @ present.T)[total.row, total.col]).ravel()
+    # 留少量余量，避免浮点误差使恰好满足条件的字类对被剪除
+    bound = min_support * (1 - 1e-4)
+    candidate = (total.data >= merge * bound) \
+        & (valid - total.data >= (1 - split) * bound)
+    left = total.row[candidate]
+    right = total.col[candidate]
+
+    logging.info(
+        f'{left.shape[0]} candidates out of '
+        f'{names.shape[0] * (names.shape[0] - 1) // 2} pairs after pruning'
+    )
+
+    # 分批精确计算每个候选对在每个方言的相似度
+    group = auxiliary.group_indicator(lim, dtype=dtype)
+    merged = numpy.empty(left.shape[0], dtype=int)
+    splitted = numpy.empty(left.shape[0], dtype=int)
+    dialects = numpy.empty(left.shape[0], dtype=int)
+    for start in range(0, left.shape[0], blocksize):
+        end = min(start + blocksize, left.shape[0])
+        a = left[start:end]
+        b = right[start:end]
+        sim = (dist[a].multiply(dist[b]) @ group).toarray()
+        both = (present[a] > 0) & (present[b] > 0)
+        merged[start:end] = numpy.count_nonzero(both & (sim >= merge), axis=1)
+        splitted[start:end] = numpy.count_nonzero(both & (sim <= split), axis=1)
+        dialects[start:end] = numpy.count_nonzero(both, axis=1)
+
+    support = (merged >= min_support) & (splitted >= min_support)
+    left = left[support]
+    right = right[support]
+
+    # 每个字类包含的字 ID 列表
+    members = pandas.Series(data.index[mask]).groupby(codes[mask]).agg(list)
+    rules = pandas.DataFrame({
+        'element': element,
+        'cid1': members.reindex(left).values,
+        'cid2': members.reindex(right).values,
+        'group1': names[left],
+        'group2': names[right],
+        'dialects': dialects[support],
+        'merged': merged[support],
+        'split': splitted[support]
+    })
+    rules = rules.iloc[numpy.argsort(
+        -numpy.minimum(rules['merged'], rules['split']).values,
+        kind='stable'
+    )].reset_index(drop=True)
+
+    logging.info(f'done. {rules.shape[0]} rules found.')
+    return rules
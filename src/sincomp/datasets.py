@@ -134,6 +134,18 @@ class FileDataset(Dataset):
 
         return self.load_file(self._file_map[did])
 
+    @property
+    def dids(self) -> pandas.Index:
+        """数据集包含的方言 ID"""
+
+        return self._file_map.index
+
+    @property
+    def files(self) -> pandas.Series:
+        """方言 ID 到数据文件路径的映射表"""
+
+        return self._file_map
+
     @property
     def data(self) -> pandas.DataFrame:
         """
@@ -602,6 +614,21 @@ class CCRDataset(FileCacheDataset):
     见：https://xiaoxue.iis.sinica.edu.tw/ccrdata/。
     """
 
+    # 数据集特有错误的改写规则，键为方言原始 ID，值为列名到改写器的映射
+    _fix_rules = {
+        '118': {'韻母': preprocess.Rewriter(({
+            0x003f: 0x028f, # QUESTION MARK -> LATIN LETTER SMALL CAPITAL Y
+        },))},
+        '178': {'聲母': preprocess.Rewriter(({
+            0x0237: 0x0255, # LATIN SMALL LETTER DOTLESS J -> LATIN SMALL LETTER C WITH CURL
+        },))},
+    }
+
+    # 部分数据把零声调标为数字0
+    _tone_rewriter = preprocess.Rewriter(({
+        0x0030: 0x2205, # DIGIT ZERO -> EMPTY SET
+    },))
+
     def __init__(
         self,
         cache_dir: str,
@@ -854,21 +881,13 @@ class CCRDataset(FileCacheDataset):
         )
 
         # 清洗数据集特有的错误
-        if id == '118':
-            data['韻母'] = data['韻母'].str.translate({
-                0x003f: 0x028f, # QUESTION MARK -> LATIN LETTER SMALL CAPITAL Y
-            })
-        elif id == '178':
-            data['聲母'] = data['聲母'].str.translate({
-                0x0237: 0x0255, # LATIN SMALL LETTER DOTLESS J -> LATIN SMALL LETTER C WITH CURL
-            })
+        for column, rewriter in cls._fix_rules.get(id, {}).items():
+            data[column] = rewriter(data[column])
 
         # 清洗读音 IPA
         data['聲母'] = preprocess.clean_ipa(data['聲母'])
         data['韻母'] = preprocess.clean_ipa(data['韻母'])
-        data['調值'] = data['調值'].str.translate({
-            0x0030: 0x2205, # DIGIT ZERO -> EMPTY SET
-        })
+        data['調值'] = cls._tone_rewriter(data['調值'])
 
         return data.replace('', numpy.NAN)
 
@@ -952,6 +971,24 @@ class ZhongguoyuyanDataset(FileCacheDataset):
     见：https://zhongguoyuyan.cn/。
     """
 
+    # 数据集特有错误的改写规则，键为方言原始 ID，值为列名到改写器的映射
+    _fix_rules = {
+        '02135': {'finals': preprocess.Rewriter(({
+            0xf175: 0x0303, # -> COMBINING TILDE
+            0xf179: 0x0303, # -> COMBINING TILDE
+        },))},
+    }
+
+    # 清洗 IPA 之后针对本数据集的额外映射
+    _initial_rewriter = preprocess.Rewriter(({
+        0x00a4: 0x0272, # CURRENCY SIGN -> LATIN SMALL LETTER N WITH LEFT HOOK
+        0x00f8: 0x2205, # LATIN SMALL LETTER O WITH STROKE -> EMPTY SET
+    },))
+
+    _final_rewriter = preprocess.Rewriter(({
+        0xf20d: 0x0264, # -> LATIN SMALL LETTER RAMS HORN
+    },))
+
     def __init__(
         self,
         cache_dir: str,
@@ -1327,11 +1364,8 @@ class ZhongguoyuyanDataset(FileCacheDataset):
         )
 
         # 清洗数据集特有的错误
-        if id == '02135':
-            data['finals'] = data['finals'].str.translate({
-                0xf175: 0x0303, # -> COMBINING TILDE
-                0xf179: 0x0303, # -> COMBINING TILDE
-            })
+        for column, rewriter in cls._fix_rules.get(id, {}).items():
+            data[column] = rewriter(data[column])
 
         # 部分声调被错误转为日期格式，还原成数字
         mask = data['tone'].str.fullmatch(r'\d+年\d+月\d+日', na=False)
@@ -1344,13 +1378,10 @@ class ZhongguoyuyanDataset(FileCacheDataset):
         data['tone'] = data['tone'].str.replace(r'\.0$', '', regex=True)
 
         # 清洗读音 IPA
-        data['initial'] = preprocess.clean_ipa(data['initial']).str.translate({
-            0x00a4: 0x0272, # CURRENCY SIGN -> LATIN SMALL LETTER N WITH LEFT HOOK
-            0x00f8: 0x2205, # LATIN SMALL LETTER O WITH STROKE -> EMPTY SET
-        })
-        data['finals'] = preprocess.clean_ipa(data['finals']).str.translate({
-            0xf20d: 0x0264, # -> LATIN SMALL LETTER RAMS HORN
-        })
+        data['initial'] = cls._initial_rewriter(
+            preprocess.clean_ipa(data['initial'])
+        )
+        data['finals'] = cls._final_rewriter(preprocess.clean_ipa(data['finals']))
 
         return data.replace('', numpy.NAN)
 
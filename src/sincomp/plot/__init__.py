@@ -17,18 +17,25 @@ import plotly.figure_factory
 from . import geography
 
 
-def heatmap(dist, labels, **kwargs):
-    '''绘制方言相似度矩阵热度图'''
-
-    # 根据距离矩阵层级聚类
-    linkage = scipy.cluster.hierarchy.linkage(
-        dist[numpy.triu_indices_from(dist, 1)],
-        method='average',
-        optimal_ordering=True
-    )
+def heatmap(dist, labels, clustering=None, **kwargs):
+    '''
+    绘制方言相似度矩阵热度图
+
+    如果指定了预先计算的聚类结果 `clustering`，直接使用其叶子顺序，否则根据距离矩阵重新聚类。
+    '''
 
-    # 根据聚类结果重新排列距离矩阵，距离越短的点顺序越靠近
-    leaves = scipy.cluster.hierarchy.leaves_list(linkage)
+    if clustering is None:
+        # 根据距离矩阵层级聚类
+        linkage = scipy.cluster.hierarchy.linkage(
+            dist[numpy.triu_indices_from(dist, 1)],
+            method='average',
+            optimal_ordering=True
+        )
+
+        # 根据聚类结果重新排列距离矩阵，距离越短的点顺序越靠近
+        leaves = scipy.cluster.hierarchy.leaves_list(linkage)
+    else:
+        leaves = clustering.leaves
 
     return seaborn.heatmap(
         dist[leaves][:, leaves],
@@ -43,12 +50,18 @@ def dendro_heat(
     labels,
     linkagefun=scipy.cluster.hierarchy.average,
     width=1000,
-    height=1000
+    height=1000,
+    clustering=None
 ):
     '''
     根据距离矩阵绘制带热度图的树状图
+
+    如果指定了预先计算的聚类结果 `clustering`，直接使用其聚类树，不再调用 `linkagefun`。
     '''
 
+    if clustering is not None:
+        linkagefun = lambda _: clustering.linkage
+
     # 绘制树状图
     # 由于 Plotly 不接受预计算的距离矩阵，需要使用自定义距离函数，这个函数的返回值是距离矩阵的上三角阵
     dendro = plotly.figure_factory.create_dendrogram(
@@ -11,6 +11,7 @@ __author__ = '黄艺华 <lernanto@foxmail.com>'
 
 import logging
 import collections
+import itertools
 import re
 import numpy
 import pandas
@@ -543,6 +544,156 @@ _TONE_TO_NORMAL = {
     0x2075: 0x0035, # SUPERSCRIPT FIVE -> DIGIT FIVE
 }
 
+# 声调字符对应的调值，1 最低，5 最高
+_TONE_LEVELS = {
+    0x0031: 1,  # DIGIT ONE
+    0x0032: 2,  # DIGIT TWO
+    0x0033: 3,  # DIGIT THREE
+    0x0034: 4,  # DIGIT FOUR
+    0x0035: 5,  # DIGIT FIVE
+    0x00b9: 1,  # SUPERSCRIPT ONE
+    0x00b2: 2,  # SUPERSCRIPT TWO
+    0x00b3: 3,  # SUPERSCRIPT THREE
+    0x2074: 4,  # SUPERSCRIPT FOUR
+    0x2075: 5,  # SUPERSCRIPT FIVE
+    0x02e5: 5,  # MODIFIER LETTER EXTRA-HIGH TONE BAR
+    0x02e6: 4,  # MODIFIER LETTER HIGH TONE BAR
+    0x02e7: 3,  # MODIFIER LETTER MID TONE BAR
+    0x02e8: 2,  # MODIFIER LETTER LOW TONE BAR
+    0x02e9: 1,  # MODIFIER LETTER EXTRA-LOW TONE BAR
+}
+
+# 序列标注模型切分的音节元素，依次为声母、韵母、声调
+_ELEMENTS = ('I', 'F', 'T')
+
+# BIOSE 标注列表，标注的整数编码为在本列表中的下标
+_TAGS = ('O',) + tuple(f'{p}-{e}' for e in _ELEMENTS for p in 'BIES')
+
+
+class Rewriter:
+    """
+    基于有序规则的字符串改写器
+
+    把一组有序的改写规则编译成单个函数，对列表中每个不同的取值只执行一次，
+    避免多次 `pandas.Series.str` 操作对整列数据的重复遍历。
+
+    每条规则可以是以下形式之一：
+        - dict: 字符映射表，同 `str.translate`
+        - (str, str): 普通字符串替换，同 `str.replace`
+        - (re.Pattern, str): 正则表达式替换，替换串可包含反向引用，同 `re.Pattern.sub`
+        - callable: 接受一个字符串并返回改写结果的函数
+    """
+
+    def __init__(self, rules: collections.abc.Iterable = ()):
+        """
+        Parameters:
+            rules: 改写规则列表，按顺序应用
+        """
+
+        self.rules = []
+        self._funcs = []
+        for rule in rules:
+            self.add(rule)
+
+    @staticmethod
+    def _compile(rule) -> collections.abc.Callable[[str], str]:
+        """把单条改写规则编译成函数"""
+
+        if isinstance(rule, dict):
+            return lambda s: s.translate(rule)
+
+        if callable(rule):
+            return rule
+
+        pattern, repl = rule
+        if isinstance(pattern, re.Pattern):
+            return lambda s: pattern.sub(repl, s)
+
+        return lambda s: s.replace(pattern, repl)
+
+    def add(self, rule) -> 'Rewriter':
+        """
+        在规则列表末尾添加一条规则
+
+        Parameters:
+            rule: 待添加的改写规则，形式见类说明
+
+        Returns:
+            self: 改写器自身，以便链式调用
+        """
+
+        self._funcs.append(self._compile(rule))
+        self.rules.append(rule)
+        return self
+
+    def rewrite(self, s: str) -> str:
+        """
+        按顺序应用所有规则改写单个字符串
+
+        Parameters:
+            s: 待改写的字符串
+
+        Returns:
+            output: 改写后的字符串
+        """
+
+        for func in self._funcs:
+            s = func(s)
+
+        return s
+
+    def __call__(self, origin: pandas.Series) -> pandas.Series:
+        """
+        改写字符串列表
+
+        Parameters:
+            origin: 待改写的字符串列表，非字符串的元素视为缺失值
+
+        Returns:
+            output: 改写后的字符串列表，缺失值保持为 NaN
+        """
+
+        codes, uniques = pandas.factorize(origin)
+        uniques = numpy.asarray(
+            [self.rewrite(u) if isinstance(u, str) else numpy.nan for u in uniques] \
+                + [numpy.nan],
+            dtype=object
+        )
+        # 缺失值的编码为 -1，正好取到末尾追加的 NaN
+        return pandas.Series(
+            uniques[codes],
+            index=origin.index,
+            name=origin.name
+        )
+
+
+# 清洗 IPA 的改写规则
+_IPA_REWRITER = Rewriter(
+    [str.strip, _CHAR_MAP] + [(k, v) for k, v in _STRING_MAP.items()]
+)
+
+# 规范化声母的改写规则，有些符号使用了多种写法，统一成较常用的一种
+_INITIAL_REWRITER = Rewriter((
+    {
+        0x1d50: 0x006d, # MODIFIER LETTER SMALL M -> LATIN SMALL LETTER M
+        0x1d51: 0x014b, # MODIFIER LETTER SMALL ENG -> LATIN SMALL LETTER ENG
+        0x1d5b: 0x1db9, # MODIFIER LETTER SMALL V -> MODIFIER LETTER SMALL V WITH HOOK
+        0x207f: 0x006e, # SUPERSCRIPT LATIN SMALL LETTER N -> LATIN SMALL LETTER N
+    },
+    ('\u02a3', 'dz'),
+    ('\u02a4', 'dʒ'),
+    ('\u02a5', 'dʑ'),
+    ('\u02a6', 'ts'),
+    ('\u02a7', 'tʃ'),
+    ('\u02a8', 'tɕ'),
+    (re.compile('([kɡŋhɦ].?)w'), r'\1ʷ'),
+    (re.compile('([kɡŋhɦ].?)[vʋ]'), r'\1ᶹ'),
+    (re.compile('([^ʔ∅])h'), r'\1ʰ'),
+    (re.compile('([^ʔ∅])ɦ'), r'\1ʱ'),
+    (re.compile('([bdɡvzʐʑʒɾ])ʱ'), r'\1ʰ'),
+    (re.compile('([ʰʱ])([ʷᶹ])'), r'\2\1'),
+))
+
 
 def clean_ipa(raw: pandas.Series, force: bool = False) -> str:
     """
@@ -558,9 +709,7 @@ def clean_ipa(raw: pandas.Series, force: bool = False) -> str:
         clean: 清洗后的 IPA 字符串
     """
 
-    clean = raw.str.strip().str.translate(_CHAR_MAP)
-    for k, v in _STRING_MAP.items():
-        clean = clean.str.replace(k, v, regex=False)
+    clean = _IPA_REWRITER(raw)
 
     if force:
         clean = clean.str.replace(f'[^{"".join(_IPA)}]', '', regex=True)
@@ -633,25 +782,7 @@ def normalize_initial(origin: pandas.Series) -> pandas.Series:
         output: 规范化的方言字音声母列表
     """
 
-    # 有些符号使用了多种写法，统一成较常用的一种
-    return origin.str.translate({
-        0x1d50: 0x006d, # MODIFIER LETTER SMALL M -> LATIN SMALL LETTER M
-        0x1d51: 0x014b, # MODIFIER LETTER SMALL ENG -> LATIN SMALL LETTER ENG
-        0x1d5b: 0x1db9, # MODIFIER LETTER SMALL V -> MODIFIER LETTER SMALL V WITH HOOK
-        0x207f: 0x006e, # SUPERSCRIPT LATIN SMALL LETTER N -> LATIN SMALL LETTER N
-    }) \
-        .str.replace('\u02a3', 'dz', regex=False) \
-        .str.replace('\u02a4', 'dʒ', regex=False) \
-        .str.replace('\u02a5', 'dʑ', regex=False) \
-        .str.replace('\u02a6', 'ts', regex=False) \
-        .str.replace('\u02a7', 'tʃ', regex=False) \
-        .str.replace('\u02a8', 'tɕ', regex=False) \
-        .str.replace('([kɡŋhɦ].?)w', r'\1ʷ', regex=True) \
-        .str.replace('([kɡŋhɦ].?)[vʋ]', r'\1ᶹ', regex=True) \
-        .str.replace('([^ʔ∅])h', r'\1ʰ', regex=True) \
-        .str.replace('([^ʔ∅])ɦ', r'\1ʱ', regex=True) \
-        .str.replace('([bdɡvzʐʑʒɾ])ʱ', r'\1ʰ', regex=True) \
-        .str.replace('([ʰʱ])([ʷᶹ])', r'\2\1', regex=True)
+    return _INITIAL_REWRITER(origin)
 
 def tone2super(origin: pandas.Series) -> pandas.Series:
     """
@@ -666,6 +797,86 @@ def tone2super(origin: pandas.Series) -> pandas.Series:
 
     return origin.str.translate(_TONE_TO_SUPERSCRIPT)
 
+def tone2contour(
+    origin: pandas.Series | numpy.ndarray[str],
+    width: int = 3
+) -> numpy.ndarray[numpy.uint8]:
+    """
+    把声调字符串编码为定长的调值数组
+
+    Parameters:
+        origin: 声调字符串列表，调值可以是普通数字、上标数字或五度标记的调型符号
+        width: 每个声调最多保留的调值个数
+
+    Returns:
+        contour: 行数和 `origin` 相同、列数为 `width` 的调值矩阵，每个元素为 1-5 的调值，
+            不足 `width` 的部分及缺失值、零声调等不包含调值的声调均补0
+
+    声调中的非调值字符被忽略，超过 `width` 的调值被截断。
+    """
+
+    origin = numpy.asarray(pandas.Series(origin).fillna(''), dtype=str)
+    chars, offsets = str2codes(origin)
+
+    # 通过查表把码位映射成调值，非调值字符映射为0
+    keys = numpy.fromiter(_TONE_LEVELS.keys(), dtype=numpy.uint32)
+    values = numpy.fromiter(_TONE_LEVELS.values(), dtype=numpy.uint8)
+    order = numpy.argsort(keys)
+    keys = keys[order]
+    values = values[order]
+    idx = numpy.minimum(numpy.searchsorted(keys, chars), keys.shape[0] - 1)
+    levels = numpy.where(keys[idx] == chars, values[idx], 0)
+
+    # 计算每个调值在所属声调中的位置
+    keep = levels > 0
+    seg = numpy.repeat(numpy.arange(origin.shape[0]), numpy.diff(offsets))[keep]
+    counts = numpy.bincount(seg, minlength=origin.shape[0])
+    rank = numpy.arange(seg.shape[0]) - (numpy.cumsum(counts) - counts)[seg]
+
+    truncated = numpy.count_nonzero(counts > width)
+    if truncated > 0:
+        logging.warning(f'{truncated}/{origin.shape[0]} tones longer than {width}, truncate')
+
+    contour = numpy.zeros((origin.shape[0], width), dtype=numpy.uint8)
+    mask = rank < width
+    contour[seg[mask], rank[mask]] = levels[keep][mask]
+    return contour
+
+def contour2tone(
+    contour: numpy.ndarray[numpy.uint8],
+    superscript: bool = False
+) -> numpy.ndarray[str]:
+    """
+    把调值数组还原为声调字符串
+
+    Parameters:
+        contour: 调值矩阵，见 `tone2contour`
+        superscript: 为真时返回上标数字，否则返回普通数字
+
+    Returns:
+        tones: 声调字符串数组，不包含调值的声调为空字符串
+
+    调值只能为 1-5，0 表示补位，包含其他值时抛出 ValueError。
+    """
+
+    contour = numpy.asarray(contour)
+    invalid = (contour < 0) | (contour > 5)
+    if numpy.any(invalid):
+        raise ValueError(
+            f'tone levels must be in 0-5 (0 for padding), '
+            f'got {numpy.unique(contour[invalid]).tolist()}'
+        )
+
+    contour = contour.astype(numpy.uint8)
+    digits = range(0x0031, 0x0036)
+    table = numpy.zeros(6, dtype=numpy.uint32)
+    table[1:] = [_TONE_TO_SUPERSCRIPT[d] for d in digits] if superscript \
+        else digits
+
+    # 调值为0的位置映射成码位0，视为 Unicode 字符串时自动截断
+    chars = numpy.ascontiguousarray(table[contour])
+    return chars.view(f'<U{max(contour.shape[1], 1)}').ravel()
+
 
 def transform(
     data: pandas.DataFrame,
@@ -784,6 +995,106 @@ def segment(s: str, tags: list[str]) -> tuple[str | None, str | None, str | None
 
     return elements.get('I'), elements.get('F'), elements.get('T')
 
+def str2codes(
+    strings: collections.abc.Iterable[str]
+) -> tuple[numpy.ndarray[numpy.uint32], numpy.ndarray[int]]:
+    """
+    把字符串列表展开成扁平的 Unicode 码位数组
+
+    Parameters:
+        strings: 字符串列表
+
+    Returns:
+        chars: 所有字符串首尾相接得到的码位数组
+        offsets: 长度为字符串数 + 1 的数组，第 i 个字符串的码位为
+            chars[offsets[i]:offsets[i + 1]]
+    """
+
+    strings = numpy.asarray(strings, dtype=str)
+    lengths = numpy.char.str_len(strings)
+    offsets = numpy.zeros(strings.shape[0] + 1, dtype=int)
+    numpy.cumsum(lengths, out=offsets[1:])
+
+    # NumPy 的定长 Unicode 字符串为 UCS-4 编码，可以直接视为码位矩阵
+    width = max(strings.dtype.itemsize // 4, 1)
+    codes = numpy.ascontiguousarray(strings).view(numpy.uint32) \
+        .reshape(strings.shape[0], width)
+    chars = codes[numpy.arange(width)[None, :] < lengths[:, None]]
+    return chars, offsets
+
+def encode_tags(tags: collections.abc.Iterable[list[str]]) -> numpy.ndarray[int]:
+    """
+    把模型预测的 BIOSE 标注序列编码为整数
+
+    Parameters:
+        tags: 标注序列列表，每个元素为一个音节的标注列表
+
+    Returns:
+        codes: 所有音节的标注首尾相接编码得到的整数数组，编码为标注在 `_TAGS` 中的下标，
+            不能识别的标注视为 O
+    """
+
+    # numpy.fromiter 到 1.23 才支持 object 类型，先展开再填入对象数组
+    flat = list(itertools.chain.from_iterable(tags))
+    values = numpy.empty(len(flat), dtype=object)
+    values[:] = flat
+    codes = pandas.Index(_TAGS).get_indexer(values)
+    return numpy.maximum(codes, 0)
+
+def segment_batch(
+    chars: numpy.ndarray[numpy.uint32],
+    tags: numpy.ndarray[int],
+    offsets: numpy.ndarray[int]
+) -> numpy.ndarray[object]:
+    """
+    根据整数编码的标注序列批量切分音节
+
+    Parameters:
+        chars: 所有音节首尾相接得到的码位数组，见 `str2codes`
+        tags: 和 `chars` 等长的标注编码数组，见 `encode_tags`
+        offsets: 长度为音节数 + 1 的数组，第 i 个音节为 chars[offsets[i]:offsets[i + 1]]
+
+    Returns:
+        elements: 音节数 x 3 的数组，列依次为声母、韵母、声调，切分失败的元素为 None
+
+    切分规则同 `segment`，但全部使用数组运算实现，不需要逐字符执行 Python 代码。
+    对每个元素，取音节中最后一个 B 或 S 标注的字符，再拼接其后所有 I 或 E 标注的字符；
+    如果音节中该元素没有 B 或 S 标注，则拼接所有 I 或 E 标注的字符。
+    """
+
+    num = offsets.shape[0] - 1
+    seg = numpy.repeat(numpy.arange(num), numpy.diff(offsets))
+    pos = numpy.arange(chars.shape[0])
+    # 标注编码 0 为 O，其余每个元素依次为 B、I、E、S 共4个标注
+    element = (tags - 1) // 4
+    start = (tags > 0) & ((tags - 1) % 4 % 3 == 0)
+    cont = (tags > 0) & ~start
+
+    elements = numpy.full((num, len(_ELEMENTS)), None, dtype=object)
+    for i in range(len(_ELEMENTS)):
+        # 每个音节中该元素最后一个开始标注的位置
+        last = numpy.full(num, -1)
+        mask = start & (element == i)
+        numpy.maximum.at(last, seg[mask], pos[mask])
+
+        keep = (mask & (pos == last[seg])) \
+            | (cont & (element == i) & (pos > last[seg]))
+        keep_seg = seg[keep]
+        counts = numpy.bincount(keep_seg, minlength=num)
+
+        # 把保留的字符填入定长码位矩阵，再视为 Unicode 字符串
+        width = max(counts.max(initial=0), 1)
+        bases = numpy.cumsum(counts) - counts
+        buffer = numpy.zeros((num, width), dtype=numpy.uint32)
+        buffer[keep_seg, numpy.arange(keep_seg.shape[0]) - bases[keep_seg]] \
+            = chars[keep]
+        strings = buffer.view(f'<U{width}').ravel()
+
+        exists = counts > 0
+        elements[exists, i] = strings[exists]
+
+    return elements
+
 
 class RegexParser:
     """
@@ -886,7 +1197,8 @@ class CRFParser:
             syllables.map(str2fea) if isinstance(syllables, pandas.Series) \
                 else (str2fea(s) for s in syllables)
         )
-        elements = numpy.asarray([segment(s, t) for s, t in zip(syllables, tags)])
+        chars, offsets = str2codes(syllables)
+        elements = segment_batch(chars, encode_tags(tags), offsets)
 
         if isinstance(syllables, pandas.Series):
             elements = pandas.DataFrame(
@@ -9,19 +9,84 @@
 __author__ = '黄艺华 <lernanto@foxmail.com>'
 
 
+import os
+import sys
 import logging
+import json
+import collections
+import itertools
+import tempfile
+import hashlib
+import copy
+import contextlib
+import functools
+import time
 import pandas
 import numpy
 import scipy.sparse
 import scipy.cluster.hierarchy
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.impute import SimpleImputer
 import joblib
 
+from . import auxiliary
 from . import datasets
 from . import preprocess
 
 
+# 各阶段的累计耗时，由 `profile` 开启，为 None 时不计时
+_timings = None
+
+@contextlib.contextmanager
+def profile() -> collections.abc.Iterator[collections.Counter]:
+    """
+    统计上下文中相似度计算各阶段的累计耗时
+
+    Returns:
+        timings: 阶段名称到秒数的计数器，在上下文中持续累加，阶段包括
+            cross（整数编码及特征交叉）、encode（one-hot 编码）、compute（分块计算）
+            及 output（写入结果）
+
+    可以嵌套使用，内层的耗时同时累加到外层。
+    """
+
+    global _timings
+
+    outer = _timings
+    _timings = collections.Counter()
+    try:
+        yield _timings
+    finally:
+        if outer is not None:
+            outer.update(_timings)
+        _timings = outer
+
+@contextlib.contextmanager
+def _timed(stage: str) -> collections.abc.Iterator[None]:
+    """在开启 `profile` 时把上下文的耗时累加到 `stage` 阶段"""
+
+    if _timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings[stage] += time.perf_counter() - start
+
+def _timed_iter(stage: str, iterable: collections.abc.Iterable) \
+    -> collections.abc.Iterator:
+    """逐个产出 `iterable` 的元素，只把产生元素的耗时累加到 `stage` 阶段"""
+
+    iterator = iter(iterable)
+    while True:
+        with _timed(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+        yield item
+
 def cross_features(data, column=3):
     '''构造交叉特征'''
 
@@ -38,25 +103,123 @@ def cross_features(data, column=3):
     logging.info('done. totally {} cross features'.format(features.shape[2]))
     return features
 
-def encode_features(features):
-    '''特征 one-hot 编码'''
+def cross_codes(
+    codes: numpy.ndarray[int],
+    code_num: int,
+    column: int = 3
+) -> numpy.ndarray[int]:
+    """
+    使用整数编码构造交叉特征
 
-    logging.info('encoding features ...')
+    Parameters:
+        codes: 整数编码的特征矩阵，缺失值为 -1，见 `factorize_features`
+        code_num: 编码的取值数
+        column: 每个方言的特征数
+
+    Returns:
+        crossed: 字数 x 方言数 x `column` 的交叉特征编码，缺失值为 -1
+
+    和 `cross_features` 相同，第 i 个特征和第 i + 1 个特征交叉，但以 `code_i * n + code_j`
+    合并编码代替字符串拼接。只有一个特征缺失时，把缺失值视为一个独立的取值，
+    两个特征都缺失时交叉特征才缺失。
+
+    注意这和字符串拼接的结果并不完全相同，是有意的修正：字符串拼接会把不同的取值组合
+    合并为同一个取值，如 'a' + '' 和 '' + 'a'，或 'ab' + 'c' 和 'a' + 'bc'，
+    整数编码则使每个取值组合对应唯一的编码。因此不同特征的取值使用相同符号时，
+    交叉特征的取值数更多，卡方、条件熵等结果和基于 `cross_features` 的旧实现不同。
+    """
+
+    logging.info('constructing cross features ...')
+
+    # 缺失值编码为0，其他编码顺延
+    codes = codes.astype(numpy.int64) + 1
+    left = numpy.stack(
+        [codes[:, i::column] for i in range(column)],
+        axis=2
+    )
+    right = numpy.roll(left, -1, axis=2)
+    crossed = left * (code_num + 1) + right - 1
+
+    logging.info('done. totally {} cross features'.format(crossed.shape[2]))
+    return crossed
+
+def factorize_features(
+    features: numpy.ndarray[str]
+) -> tuple[numpy.ndarray[int], numpy.ndarray[str]]:
+    """
+    把字符串特征矩阵转换为整数编码
+
+    Parameters:
+        features: 字符串特征矩阵，空字符串、None 及 NaN 为缺失值
+
+    Returns:
+        codes: 和 `features` 形状相同的整数编码矩阵，缺失值为 -1
+        uniques: 编码对应的特征取值，按字符串顺序排列
+    """
+
+    codes, uniques = pandas.factorize(features.ravel(), sort=True)
+    codes = codes.reshape(features.shape)
+
+    # 空字符串排在最前，也视为缺失值
+    if uniques.shape[0] > 0 and uniques[0] == '':
+        codes -= 1
+        uniques = uniques[1:]
+
+    return codes, numpy.asarray(uniques)
+
+def encode_codes(
+    codes: numpy.ndarray[int],
+    dtype=numpy.float32
+) -> tuple[scipy.sparse.csr_matrix, numpy.ndarray[int]]:
+    """
+    把整数编码矩阵的每一列分别做 one-hot 编码
+
+    Parameters:
+        codes: 整数编码矩阵，负数为缺失值，不同列的编码可以共用同一套取值
+        dtype: 编码矩阵的数据类型
+
+    Returns:
+        features: one-hot 编码的稀疏矩阵，每列的取值按编码顺序排列，
+            只包含该列实际出现的取值，缺失值对应的行全为0
+        categories: 每列的取值数
+
+    把列号和编码合并为一个整数，排序去重后即得到每列实际出现的取值及其在编码矩阵中的列号，
+    再根据每行的非缺失值数直接构造 CSR 矩阵，无需逐列循环。
+    """
+
+    valid = codes >= 0
+    base = max(int(codes.max(initial=-1)) + 1, 1)
+    keys = (numpy.arange(codes.shape[1], dtype=numpy.int64) * base + codes)[valid]
+    uniques, indices = numpy.unique(keys, return_inverse=True)
+    categories = numpy.bincount(uniques // base, minlength=codes.shape[1])
 
-    # 为了让编码器正常工作，先补全缺失特征
-    encoder = OneHotEncoder(
-        sparse_output=True,
-        dtype=numpy.float32,
-        handle_unknown='ignore'
+    indptr = numpy.concatenate([[0], numpy.cumsum(numpy.count_nonzero(valid, axis=1))])
+    features = scipy.sparse.csr_matrix(
+        (numpy.ones(indices.shape[0], dtype=dtype), indices, indptr),
+        shape=(codes.shape[0], uniques.shape[0])
     )
-    features = encoder.fit(
-        SimpleImputer(
-            missing_values='',
-            strategy='most_frequent'
-        ).fit_transform(features)
-    ).transform(features)
+    return features, categories
+
+def encode_features(
+    features: numpy.ndarray[str],
+    dtype=numpy.float32
+) -> tuple[scipy.sparse.csr_matrix, numpy.ndarray[int]]:
+    """
+    特征 one-hot 编码
+
+    Parameters:
+        features: 字符串特征矩阵，空字符串、None 及 NaN 为缺失值
+        dtype: 编码矩阵的数据类型
+
+    Returns:
+        features: one-hot 编码的稀疏矩阵，缺失值对应的行全为0
+        categories: 每列特征的取值数
+    """
 
-    categories = numpy.asarray([len(c) for c in encoder.categories_])
+    logging.info('encoding features ...')
+
+    features, categories \
+        = encode_codes(factorize_features(features)[0], dtype=dtype)
 
     logging.info('done. totally {} features'.format(features.shape[1]))
     return features, categories
@@ -70,6 +233,111 @@ def freq2prob(freqs, limits):
             for i in range(limits.shape[0] - 1)]
     )
 
+def reduction_dtype(dtype) -> numpy.dtype:
+    """
+    根据编码矩阵的数据类型确定归并计算使用的浮点类型
+
+    Parameters:
+        dtype: one-hot 编码矩阵的数据类型
+
+    Returns:
+        dtype: 整数编码时共现频次为精确的整数，归并使用 float64；
+            浮点编码时沿用编码的精度，但不低于 float32
+
+    编码使用 float32 时内存占用最小，但共现频次及归并的中间结果都只有单精度；
+    使用 int32 时编码矩阵大小相同，共现频次精确，只在最后的归并中使用 float64；
+    使用 float64 时全程双精度，内存占用翻倍。
+    """
+
+    dtype = numpy.dtype(dtype)
+    if numpy.issubdtype(dtype, numpy.integer):
+        return numpy.dtype(numpy.float64)
+
+    return numpy.promote_types(dtype, numpy.float32)
+
+def _as_reduction(freq: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+    """
+    把共现频次矩阵转换为归并使用的浮点类型
+
+    直接替换数据数组，避免 `astype` 对大矩阵的额外开销。
+    """
+
+    dtype = reduction_dtype(freq.dtype)
+    if freq.dtype == dtype:
+        return freq
+
+    return scipy.sparse.csr_matrix(
+        (freq.data.astype(dtype), freq.indices, freq.indptr),
+        shape=freq.shape
+    )
+
+class _Slice:
+    """
+    延迟执行的列切片
+
+    共享内存模式下，并行任务只接收内存映射数据的引用及切片范围，在任务进程中才执行切片，
+    避免主进程为每个任务切片并序列化一份数据副本。
+    """
+
+    def __init__(self, data, start: int, end: int):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def __call__(self):
+        return _slice(self.data, self.start, self.end)
+
+def _slice(data, start: int, end: int):
+    """对矩阵按列切片，对一维数组直接切片"""
+
+    return data[:, start:end] if data.ndim > 1 else data[start:end]
+
+def _resolve(args: collections.abc.Iterable) -> tuple:
+    """执行参数中的延迟切片"""
+
+    return tuple(a() if isinstance(a, _Slice) else a for a in args)
+
+def _run_block(func, *args):
+    """在并行任务中执行延迟的切片，然后调用分块计算函数"""
+
+    return func(*_resolve(args))
+
+def _memmap(data, folder: str, name: str):
+    """
+    把数组或稀疏矩阵转储到文件，再以只读内存映射的方式加载
+
+    joblib 向并行任务传递内存映射数组时只传递文件引用，因此所有任务共享同一份数据。
+    """
+
+    path = os.path.join(folder, f'{name}.pkl')
+    joblib.dump(data, path)
+    return joblib.load(path, mmap_mode='r')
+
+@contextlib.contextmanager
+def _sharing(mmap: bool, **data):
+    """
+    准备并行任务使用的数据
+
+    Parameters:
+        mmap: 为真时把数据转储到临时目录并以内存映射方式加载，退出时删除临时目录
+        data: 待共享的数组或稀疏矩阵，稀疏矩阵转换为 CSC 格式以便按列切片
+
+    Yields:
+        data: 处理后的数据，顺序同参数
+        take: 切片函数，共享模式下为延迟切片，否则立即切片
+    """
+
+    data = {k: v.tocsc() if scipy.sparse.issparse(v) else v \
+        for k, v in data.items()}
+
+    if not mmap:
+        yield tuple(data.values()), _slice
+        return
+
+    with tempfile.TemporaryDirectory(prefix='sincomp-') as folder:
+        logging.debug(f'sharing {", ".join(data)} via memory map in {folder}')
+        yield tuple(_memmap(v, folder, k) for k, v in data.items()), _Slice
+
 def chi2_block(
     features,
     feature_categories,
@@ -96,487 +364,2117 @@ def chi2_block(
         target_probs
     ))
 
-    freq = features.T * targets
-    chisq = scipy.sparse.csr_matrix(freq)
+    # 共现频次可能为整数，之后的归并使用相应的浮点类型
+    freq = _as_reduction(scipy.sparse.csr_matrix(features.T @ targets))
+    chisq = freq.copy()
     # 利用 CSR 矩阵的内部结构，只计算非0项的期望数
     chisq.data = numpy.square(chisq.data) / target_probs[chisq.indices]
 
     # 按列归并目标取值
     target_limits = numpy.concatenate([[0], numpy.cumsum(target_categories)])
-    freq = numpy.column_stack([numpy.sum(
-        freq[:, target_limits[i]:target_limits[i + 1]],
-        axis=1
-    ) for i in range(target_limits.shape[0] - 1)]).A
-    chisq = numpy.column_stack([numpy.sum(
-        chisq[:, target_limits[i]:target_limits[i + 1]],
-        axis=1
-    ) for i in range(target_limits.shape[0] - 1)]).A
+    target_group = auxiliary.group_indicator(target_limits, freq.dtype)
+    freq = (freq @ target_group).toarray()
+    chisq = (chisq @ target_group).toarray()
 
     chisq /= feature_probs[:, None]
 
     # 按行归并特征取值
     feature_limits = numpy.concatenate([[0], numpy.cumsum(feature_categories)])
-    freq = numpy.stack([numpy.sum(
-        freq[feature_limits[i]:feature_limits[i + 1]],
-        axis=0
-    ) for i in range(feature_limits.shape[0] - 1)])
-    chisq = numpy.stack([numpy.sum(
-        chisq[feature_limits[i]:feature_limits[i + 1]],
-        axis=0
-    ) for i in range(feature_limits.shape[0] - 1)])
+    feature_group = auxiliary.group_indicator(feature_limits, freq.dtype).T
+    freq = feature_group @ freq
+    chisq = feature_group @ chisq
 
     # 得到真正的卡方值
     chisq = chisq / freq - freq
 
     # 计算自由度
     dof = numpy.outer(feature_categories - 1, target_categories - 1) \
-        .astype(numpy.float32)
+        .astype(freq.dtype)
     # 标准化卡方值使之接近标准正态分布
     return (chisq - dof) / numpy.sqrt(2 * dof)
 
-def chi2(
-    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str],
-    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | None = None,
-    feature_num: int = 3,
-    blocksize: tuple[int, int] = (100, 100),
-    parallel: int = 1
-) -> pandas.DataFrame | numpy.ndarray[float]:
+def _chi2(
+    features: scipy.sparse.spmatrix,
+    feature_limits: numpy.ndarray[int],
+    targets: scipy.sparse.spmatrix,
+    target_limits: numpy.ndarray[int]
+) -> numpy.ndarray[float]:
     """
-    使用卡方检验计算方言之间的相似度
+    以 `_METRICS` 度量函数的接口计算卡方
 
     Parameters:
-        src: 源方言数据表
-        dest: 目标方言数据表，为 None 时和 `src` 相同
-        feature_num: `src` 和 `dest` 中特征数量，当 `src` 为 pandas.DataFrame 时，
-            从 `src` 自动推导
-        blocksize: 指定并行计算时每块数据的大小
-        parallel: 并行计算的并行数
+        同 `_entropy`
 
     Returns:
-        chi2: 源方言和目标方言两两之间的条件熵矩阵，当 `src` 和 `dest` 为
-            pandas.DataFrame 包含方言名称时，指定 `chi2` 的行列为相应名称
+        chisq: 每个特征到每个目标的标准化卡方
 
-    思路为，如果 A 方言的声母 + 韵母能很大程度预测 B 方言的声母 + 韵母，说明 B 方言接近 A 方言。
-    这种预测能力通过卡方检验来衡量，卡方值越大表示越相似。
-    遍历 A 方言及 B 方言的声母、韵母、声调组合，取平均得到 A、B 方言之间的相似度评分。
+    分块总是包含完整的特征组，每组的概率只取决于组内各取值的频次，
+    因此在分块内估算概率和在完整的编码矩阵上估算相同。
+    """
 
-    理论上由于自由度不同，卡方值不能直接比较，而应该比较相应的 p-value，但由于统计得出的卡方值非常大，
-    导致计算出的 p-value 下溢为0，不能比较，另一方面由于自由度都比较大，卡方值近似于正态分布，
-    可以把卡方值正则化到标准正态分布后进行比较。
+    return chi2_block(
+        features,
+        numpy.diff(feature_limits),
+        freq2prob(numpy.asarray(features.sum(axis=0)).ravel(), feature_limits),
+        targets,
+        numpy.diff(target_limits),
+        freq2prob(numpy.asarray(targets.sum(axis=0)).ravel(), target_limits)
+    )
 
-    卡方检验对于 A、B 方言是对称的，即理论上相似度矩阵是对称阵，但由于计算精度的原因可能出现极小的误差导致不对称。
-    可以取相似度矩阵和其转置的平均来强制保证对称性。
+def _take_groups(
+    matrix: scipy.sparse.spmatrix,
+    categories: numpy.ndarray[int],
+    limits: numpy.ndarray[int],
+    groups: numpy.ndarray[int]
+) -> tuple[scipy.sparse.csc_matrix, numpy.ndarray[int], numpy.ndarray[int]]:
     """
+    按指定顺序选取 one-hot 编码矩阵中的若干组特征
 
-    if dest is None:
-        dest = src
-
-    if isinstance(src, datasets.Dataset | pandas.DataFrame):
-        index = src.columns.levels[0]
-        src_num = index.shape[0]
-        feature_num = src.columns.levels[1].shape[0]
-        src = src.values
-    else:
-        index = None
-        src_num = src.shape[1] // feature_num
+    Parameters:
+        matrix: one-hot 编码矩阵
+        categories: 每组特征的取值数
+        limits: 每组特征在 `matrix` 中的起止列
+        groups: 选取的特征组下标
 
-    if isinstance(dest, datasets.Dataset | pandas.DataFrame):
-        columns = dest.columns.levels[0]
-        dest_num = columns.shape[0]
-        dest = dest.values
-    else:
-        columns = None
-        dest_num = dest.shape[1] // feature_num
+    Returns:
+        matrix, categories, limits: 选取的特征组组成的编码矩阵及相应的取值数和起止列
+    """
 
-    logging.info(
-        f'compute X2 for {src_num} x {dest_num} dialects, '
-        f'characters = {src.shape[0]}, features = {feature_num}, '
-        f'block size = {blocksize}, parallel = {parallel}'
-    )
+    categories = categories[groups]
+    new_limits = numpy.concatenate([[0], numpy.cumsum(categories)])
+    # 每个新列对应的原始列 = 所在组的原始起始列 + 组内偏移
+    columns = numpy.repeat(limits[groups] - new_limits[:-1], categories) \
+        + numpy.arange(new_limits[-1])
+    return scipy.sparse.csc_matrix(matrix)[:, columns], categories, new_limits
 
-    # 特征交叉
-    if feature_num > 1:
-        features = cross_features(src, feature_num)
-        feature_column = features.shape[2]
-        features = numpy.swapaxes(features, 1, 2).reshape(features.shape[0], -1)
-    else:
-        features = src
-        feature_column = 1
+class PreparedFeatures:
+    """
+    预先交叉及编码的方言特征
+
+    计算卡方和条件熵都要先对方言读音做特征交叉及 one-hot 编码，同一份数据编码一次后，
+    可以在多种方法、多组参数之间重复使用，也可以保存到文件供下次使用。
+    由于每个特征单独编码，从中选取部分方言和只对这些方言编码的结果相同。
+
+    Attributes:
+        dialects: 方言名称，输入不包含方言名称时为 None
+        dialect_num: 方言数
+        feature_num: 每个方言的原始特征数，如声母、韵母、声调
+        feature_column: 每个方言的交叉特征数
+        features: 交叉特征的 one-hot 编码，按方言、交叉特征的顺序排列
+        feature_categories: 每个交叉特征的取值数
+        feature_limits: 每个交叉特征在 `features` 中的起止列
+        targets: 原始特征的 one-hot 编码，按方言、原始特征的顺序排列
+        target_categories: 每个原始特征的取值数
+        target_limits: 每个原始特征在 `targets` 中的起止列
+        fingerprint: 原始数据的指纹，用于区分断点
+    """
 
-    # 特征 one-hot 编码
-    features, feature_categories = encode_features(features)
-    feature_limits = numpy.concatenate([[0], numpy.cumsum(feature_categories)])
-    # 根据特征的出现频率估算概率
-    feature_probs = freq2prob(features.sum(axis=0).A.flatten(), feature_limits)
-
-    if dest is None:
-        targets = features
-        target_categories = feature_categories
-        target_limits = feature_limits
-        target_probs = feature_probs
-    else:
-        # 由于卡方统计的对称性，对预测目标做和特征相同处理
-        if feature_num > 1:
-            targets = cross_features(dest, feature_num)
-            targets = numpy.swapaxes(targets, 1, 2).reshape(targets.shape[0], -1)
+    def __init__(
+        self,
+        data: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str],
+        feature_num: int = 3,
+        dtype=numpy.float32
+    ):
+        """
+        Parameters:
+            data: 方言数据表
+            feature_num: `data` 中每个方言的特征数，当 `data` 为 pandas.DataFrame 时，
+                从 `data` 自动推导
+            dtype: one-hot 编码矩阵的数据类型，同时决定共现频次及结果的精度，
+                见 `reduction_dtype`
+        """
+
+        if isinstance(data, datasets.Dataset | pandas.DataFrame):
+            # 按列的实际顺序取方言名称，切片后的列可能保留了未使用的层级取值
+            self.dialects = data.columns.get_level_values(0).unique()
+            feature_num = data.columns.get_level_values(1).unique().shape[0]
+            data = data.values
         else:
-            targets = dest
+            self.dialects = None
+
+        self.dialect_num = data.shape[1] // feature_num
+        self.feature_num = feature_num
+        self.fingerprint = _fingerprint(
+            data,
+            feature_num=feature_num,
+            dtype=numpy.dtype(dtype).str
+        )
 
-        targets, target_categories = encode_features(targets)
-        target_limits = numpy.concatenate([[0], numpy.cumsum(target_categories)])
-        target_probs = freq2prob(targets.sum(axis=0).A.flatten(), target_limits)
+        logging.info('encoding features ...')
+        with _timed('cross'):
+            codes, uniques = factorize_features(data)
 
-    # 分块并行计算特征到目标的卡方
-    row_block = (src_num + blocksize[0] - 1) // blocksize[0]
-    col_block = (dest_num + blocksize[1] - 1) // blocksize[1]
+            # 以整数编码做特征交叉
+            if feature_num > 1:
+                features = cross_codes(codes, uniques.shape[0], feature_num)
+                self.feature_column = features.shape[2]
+                features = features.reshape(features.shape[0], -1)
+            else:
+                features = codes
+                self.feature_column = 1
+
+        with _timed('encode'):
+            # 特征 one-hot 编码
+            self.features, self.feature_categories \
+                = encode_codes(features, dtype=dtype)
+            # 原始特征用作条件熵的预测目标
+            self.targets, self.target_categories \
+                = encode_codes(codes, dtype=dtype)
+
+        self.feature_limits \
+            = numpy.concatenate([[0], numpy.cumsum(self.feature_categories)])
+        self.target_limits \
+            = numpy.concatenate([[0], numpy.cumsum(self.target_categories)])
+        self._chi2_features = None
+
+        logging.info(
+            f'done. totally {self.features.shape[1]} cross features, '
+            f'{self.targets.shape[1]} features'
+        )
 
-    logging.info(
-        f'computing X2 for {feature_num} x {row_block} x {col_block} blocks, '
-        f'block size = {blocksize} ...'
-    )
+    @property
+    def character_num(self) -> int:
+        return self.features.shape[0]
 
-    chisq = numpy.zeros((src_num, dest_num), dtype=numpy.float32)
-
-    count = 0
-    for i in range(feature_column):
-        feature_base = i * src_num
-        target_base = i * dest_num
-        fc = feature_categories[feature_base:feature_base + src_num]
-        fl = feature_limits[feature_base:feature_base + src_num + 1]
-        tc = target_categories[target_base:target_base + dest_num]
-        tl = target_limits[target_base:target_base + dest_num + 1]
-
-        gen = joblib.Parallel(n_jobs=parallel)(
-            joblib.delayed(chi2_block)(
-                features[:, fl[j]:fl[min(j + blocksize[0], fl.shape[0] - 1)]],
-                fc[j:j + blocksize[0]],
-                feature_probs[fl[j]:fl[min(j + blocksize[0], fl.shape[0] - 1)]],
-                targets[:, tl[k]:tl[min(k + blocksize[1], tl.shape[0] - 1)]],
-                tc[k:k + blocksize[1]],
-                target_probs[tl[k]:tl[min(k + blocksize[1], tl.shape[0] - 1)]]
-            ) for j in range(0, src_num, blocksize[0]) \
-                for k in range(0, dest_num, blocksize[1])
-        )
+    @property
+    def dtype(self) -> numpy.dtype:
+        """计算结果的浮点类型"""
 
-        for j, ch in enumerate(gen):
-            row = j // col_block * blocksize[0]
-            col = j % col_block * blocksize[1]
-            chisq[row:row + blocksize[0], col:col + blocksize[1]] += ch
+        return reduction_dtype(self.features.dtype)
 
-            count += 1
-            if count % 10 == 0:
-                logging.info(f'finished {count} blocks')
+    def select(self, dialects: collections.abc.Iterable) -> 'PreparedFeatures':
+        """
+        按原有顺序选取指定方言的特征
 
-        logging.info(f'done. finished {count} blocks')
+        Parameters:
+            dialects: 选取的方言名称
 
-    # 取多组特征卡方的均值
-    if feature_column > 1:
-        chisq /= feature_column
+        Returns:
+            prepared: 只包含选取方言的特征
+        """
 
-    return chisq if index is None and columns is None \
-        else pandas.DataFrame(chisq, index=index, columns=columns)
+        mask = self.dialects.isin(dialects)
+        idx = numpy.nonzero(mask)[0]
 
-def _entropy(
-    features: scipy.sparse.csr_matrix,
-    feature_limits: numpy.ndarray[int],
-    targets: scipy.sparse.csr_matrix,
-    target_limits: numpy.ndarray[int]
-) -> numpy.ndarray[float]:
+        prepared = copy.copy(self)
+        prepared._chi2_features = None
+        prepared.dialects = self.dialects[mask]
+        prepared.dialect_num = idx.shape[0]
+        prepared.fingerprint = _fingerprint(
+            idx,
+            fingerprint=self.fingerprint
+        )
+        prepared.features, prepared.feature_categories, prepared.feature_limits \
+            = _take_groups(
+                self.features,
+                self.feature_categories,
+                self.feature_limits,
+                (idx[:, None] * self.feature_column \
+                    + numpy.arange(self.feature_column)).ravel()
+            )
+        prepared.targets, prepared.target_categories, prepared.target_limits \
+            = _take_groups(
+                self.targets,
+                self.target_categories,
+                self.target_limits,
+                (idx[:, None] * self.feature_num \
+                    + numpy.arange(self.feature_num)).ravel()
+            )
+        return prepared
+
+    def chi2_features(self) -> tuple[
+        scipy.sparse.csc_matrix,
+        numpy.ndarray[int],
+        numpy.ndarray[int]
+    ]:
+        """
+        返回按交叉特征、方言的顺序排列的交叉特征编码，供 `chi2` 分块使用
+
+        Returns:
+            features, categories, limits: 交叉特征的编码矩阵、取值数及起止列
+
+        重排的结果在第一次调用时计算并缓存，之后复用同一份，不写入保存的文件。
+        """
+
+        if getattr(self, '_chi2_features', None) is None:
+            self._chi2_features = _take_groups(
+                self.features,
+                self.feature_categories,
+                self.feature_limits,
+                (numpy.arange(self.dialect_num)[None, :] * self.feature_column \
+                    + numpy.arange(self.feature_column)[:, None]).ravel()
+            )
+
+        return self._chi2_features
+
+    def __getstate__(self) -> dict:
+        # 重排的特征可以随时重新计算，不保存
+        state = self.__dict__.copy()
+        state.pop('_chi2_features', None)
+        return state
+
+    def save(self, path: str | os.PathLike) -> None:
+        """保存编码后的特征到文件"""
+
+        joblib.dump(self, path)
+
+    @classmethod
+    def load(cls, path: str | os.PathLike) -> 'PreparedFeatures':
+        """从文件加载编码后的特征"""
+
+        prepared = joblib.load(path)
+        if not isinstance(prepared, cls):
+            raise TypeError(f'{path} does not contain {cls.__name__}')
+
+        return prepared
+
+def _prepare(
+    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | PreparedFeatures,
+    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | PreparedFeatures | None,
+    feature_num: int
+) -> tuple[PreparedFeatures, PreparedFeatures]:
     """
-    计算稀疏特征矩阵到目标矩阵的条件熵
+    把相似度计算的输入统一为编码后的特征
 
     Parameters:
-        features: 源方言编码的特征稀疏矩阵
-        feature_limits: 表明特征矩阵中特征边界的数组
-        targets: 目标方言编码的目标稀疏矩阵
-        target_limits: 表明目标矩阵中目标边界的数组
+        src: 源方言数据表或编码后的特征
+        dest: 目标方言数据表或编码后的特征，为 None 时和 `src` 相同
+        feature_num: 输入为字符串矩阵时每个方言的特征数
 
     Returns:
-        entropy: 每个特征到每个目标的条件熵矩阵
-
-    X 到 Y 的条件熵是条件概率 P(Y|X) 的期望 H(Y|X) = E[-log P(Y|X)]。
-    本函数通过构造 X 和 Y 的共现矩阵来计算 H(Y|X)，因为
-    P(Y|X) * -log P(y|x) = f(x, y) / f(x) * -log f(x, y) / f(x)
-    = (f(x, y) * log f(x) - f(x, y) * log f(x, y)) / f(x)
-    不直接计算 P(Y|X)，而是使用稀疏矩阵计算一些中间值来减少计算量。
+        src, dest: 编码后的源方言及目标方言特征，`dest` 和 `src` 相同时为同一个对象
     """
 
-    # 计算共现频次及其对数
-    freq = features.T @ targets
-    entropy = scipy.sparse.csc_matrix(freq)
-    entropy.data = numpy.where(
-        entropy.data == 0,
-        0,
-        entropy.data * numpy.log(entropy.data)
-    )
+    same = dest is None or dest is src
+    if not isinstance(src, PreparedFeatures):
+        src = PreparedFeatures(src, feature_num)
 
-    # 对共现矩阵的列分组求和，把目标不同取值的频次归并在一起
-    freq = numpy.asarray(numpy.column_stack([numpy.sum(
-        freq[:, target_limits[i]:target_limits[i + 1]],
-        axis=1
-    ) for i in range(target_limits.shape[0] - 1)]))
-    entropy = numpy.asarray(numpy.column_stack([numpy.sum(
-        entropy[:, target_limits[i]:target_limits[i + 1]],
-        axis=1
-    ) for i in range(target_limits.shape[0] - 1)]))
+    if same:
+        dest = src
+    elif not isinstance(dest, PreparedFeatures):
+        dest = PreparedFeatures(dest, src.feature_num)
 
-    # 计算特征频次的对数，然后减去共现频次的对数
-    feature_entropy = numpy.where(freq == 0, 0, freq * numpy.log(freq))
-    entropy = feature_entropy - entropy
+    return src, dest
 
-    # 对共现矩阵的行分组求和，把特征不同取值的频次归并在一起
-    freq = numpy.stack([numpy.sum(
-        freq[feature_limits[i]:feature_limits[i + 1]],
-        axis=0
-    ) for i in range(feature_limits.shape[0] - 1)])
-    entropy = numpy.stack([numpy.sum(
-        entropy[feature_limits[i]:feature_limits[i + 1]],
-        axis=0
-    ) for i in range(feature_limits.shape[0] - 1)])
+def _imap(tasks: collections.abc.Iterable, parallel: int) \
+    -> collections.abc.Iterator:
+    """
+    分批并行执行任务，并按顺序逐个产出结果
 
-    # 频次对数除以样本总频次，得到真正的条件熵
-    entropy /= freq
-    invalid = numpy.count_nonzero(~(numpy.isfinite(entropy) & (entropy >= 0)))
-    if invalid > 0:
-        logging.warning(f'{invalid}/{entropy.size} invalid conditional entropy')
+    每批只提交有限个任务，使同时驻留内存的任务参数及结果数量有上限。
+    """
 
-    return entropy
+    tasks = iter(tasks)
+    batch = joblib.effective_n_jobs(parallel) * 4
+    with joblib.Parallel(n_jobs=parallel) as pool:
+        while True:
+            results = pool(itertools.islice(tasks, batch))
+            if len(results) == 0:
+                break
 
-def entropy(
-    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str],
-    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | None = None,
-    feature_num: int = 3,
-    blocksize: tuple[int, int] = (100, 100),
-    parallel: int = 1
-) -> pandas.DataFrame | numpy.ndarray[float]:
+            yield from results
+
+def _fingerprint(*arrays: numpy.ndarray, **params) -> str:
     """
-    计算方言之间的条件熵
+    计算输入数据及参数的指纹，用于区分不同计算任务的断点
 
     Parameters:
-        src: 源方言数据表
-        dest: 目标方言数据表，为 None 时和 `src` 相同
-        feature_num: `src` 和 `dest` 中特征数量，当 `src` 为 pandas.DataFrame 时，
-            从 `src` 自动推导
-        blocksize: 指定并行计算时每块数据的大小
-        parallel: 并行计算的并行数
+        arrays: 输入的字符串矩阵
+        params: 影响计算结果的参数，必须可以序列化为 JSON
 
     Returns:
-        entropy: 源方言和目标方言两两之间的条件熵矩阵，当 `src` 和 `dest` 为
-            pandas.DataFrame 包含方言名称时，指定 `entropy` 的行列为相应名称
+        fingerprint: 十六进制的指纹字符串
     """
 
-    if dest is None:
-        dest = src
+    digest = hashlib.sha1()
+    for a in arrays:
+        digest.update(str(a.shape).encode())
+        digest.update(pandas.util.hash_array(
+            numpy.asarray(a, dtype=object).ravel()
+        ).tobytes())
 
-    if isinstance(src, datasets.Dataset | pandas.DataFrame):
-        index = src.columns.levels[0]
-        src_num = index.shape[0]
-        feature_num = src.columns.levels[1].shape[0]
-        src = src.values
-    else:
-        index = None
-        src_num = src.shape[1] // feature_num
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
 
-    if isinstance(dest, datasets.Dataset | pandas.DataFrame):
-        columns = dest.columns.levels[0]
-        dest_num = columns.shape[0]
-        dest = dest.values
-    else:
-        columns = None
-        dest_num = dest.shape[1] // feature_num
+class _Checkpoint:
+    """
+    分块计算的断点
 
-    logging.info(
-        f'compute conditional entropy for {src_num} sources '
-        f'{dest_num} destinations, characters = {src.shape[0]}, '
-        f'features = {feature_num}, block size = {blocksize}, parallel = {parallel}'
-    )
+    每个计算完成的分块保存为运行目录下的一个 .npy 文件，以分块左上角的位置命名，
+    重新运行时跳过已完成的分块。运行目录为 None 时不保存断点。
+    """
 
-    # 特征交叉
-    if feature_num > 1:
-        features = cross_features(src, feature_num)
-        feature_column = features.shape[2]
-        features = features.reshape(features.shape[0], -1)
-    else:
-        features = src
-        feature_column = 1
+    def __init__(self, folder: str | os.PathLike | None):
+        self.folder = folder
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    def _path(self, row: int, col: int) -> str:
+        return os.path.join(self.folder, f'{row}_{col}.npy')
+
+    def __contains__(self, block: tuple[int, int]) -> bool:
+        return self.folder is not None and os.path.isfile(self._path(*block))
+
+    def load(self, row: int, col: int) -> numpy.ndarray[float]:
+        return numpy.load(self._path(row, col))
+
+    def save(self, row: int, col: int, data: numpy.ndarray[float]) -> None:
+        if self.folder is None:
+            return
+
+        # 先写入临时文件再改名，避免中断时留下不完整的分块
+        path = self._path(row, col)
+        with open(path + '.tmp', 'wb') as f:
+            numpy.save(f, data)
+        os.replace(path + '.tmp', path)
+
+def _run_dir(
+    checkpoint: str | os.PathLike | None,
+    method: str,
+    src: PreparedFeatures,
+    dest: PreparedFeatures | None,
+    **params
+) -> str | None:
+    """
+    根据输入数据及参数确定保存断点的运行目录
 
-    # 特征 one-hot 编码
-    features, feature_categories = encode_features(features)
-    feature_limits = numpy.concatenate([[0], numpy.cumsum(feature_categories)])
+    Parameters:
+        checkpoint: 保存断点的根目录，为 None 时不保存断点
+        method: 计算方法名称
+        src, dest: 源方言及目标方言的特征，`dest` 为 None 表示和 `src` 相同
+        params: 影响计算结果的其他参数
 
-    # 预测目标编码
-    targets, target_categories = encode_features(dest)
-    target_limits = numpy.concatenate([[0], numpy.cumsum(target_categories)])
+    Returns:
+        run_dir: 运行目录，为 `checkpoint` 下以方法名称和指纹命名的子目录
+    """
 
-    # 计算特征到目标的条件熵
-    row_block = (src_num + blocksize[0] - 1) // blocksize[0]
-    col_block = (dest_num + blocksize[1] - 1) // blocksize[1]
+    if checkpoint is None:
+        return None
 
-    logging.info(
-        f'computing conditional entropy for {row_block} x {col_block} blocks, '
-        f'block size = {blocksize} ...'
+    fingerprint = _fingerprint(
+        method=method,
+        src=src.fingerprint,
+        dest=None if dest is None else dest.fingerprint,
+        **params
     )
+    return os.path.join(checkpoint, f'{method}_{fingerprint}')
+
+def _block_list(
+    src_num: int,
+    dest_num: int,
+    blocksize: tuple[int, int],
+    symmetric: bool = False
+) -> list[tuple[int, int]]:
+    """
+    列出结果矩阵的所有分块
 
-    # 分块并行计算联合熵
-    feature_block = blocksize[0] * feature_column
-    target_block = blocksize[1] * feature_num
-    gen = joblib.Parallel(n_jobs=parallel)(
-        joblib.delayed(_entropy)(
-            features[:, feature_limits[i]:feature_limits[min(
-                i + feature_block,
-                feature_limits.shape[0] - 1
-            )]],
-            feature_limits[i:i + feature_block + 1] - feature_limits[i],
-            targets[:, target_limits[j]:target_limits[min(
-                j + target_block,
-                target_limits.shape[0] - 1
-            )]],
-            target_limits[j:j + target_block + 1] - target_limits[j]
-        ) for i in range(0, src.shape[1], feature_block) \
-            for j in range(0, dest.shape[1], target_block)
-    )
-
-    ent = numpy.empty((src_num, dest_num), dtype=numpy.float32)
-    for i, e in enumerate(gen):
-        row = i // col_block * blocksize[0]
-        col = i % col_block * blocksize[1]
-
-        # 归并同一组方言对多个特征和目标的条件熵
-        ent[row:row + blocksize[0], col:col + blocksize[1]] = numpy.sum(
-            numpy.min(
-                e.reshape(
-                    min(blocksize[0], ent.shape[0] - row),
-                    feature_column,
-                    min(blocksize[1], ent.shape[1] - col),
-                    feature_num
-                ),
-                axis=1
-            ),
-            axis=-1
-        )
+    Returns:
+        blocks: 每个分块左上角的位置，对称模式下只包含对角线及上三角的分块
+    """
 
-        if (i + 1) % 10 == 0:
-            logging.info(f'finished {i + 1} blocks')
+    return [(i, j) for i in range(0, src_num, blocksize[0]) \
+        for j in range(0, dest_num, blocksize[1]) if not symmetric or i <= j]
 
-    logging.info(f'done. finished {i + 1} blocks')
-    return ent if index is None and columns is None \
-        else pandas.DataFrame(ent, index=index, columns=columns)
+@contextlib.contextmanager
+def _block_inputs(
+    src: PreparedFeatures,
+    dest: PreparedFeatures,
+    metric: '_Metric',
+    mmap: bool,
+    **data
+):
+    """
+    准备分块计算的输入数据
 
-def normalize_sim(sim):
-    '''正则化相似度矩阵到取值 [-1, 1] 区间的对称阵'''
+    Parameters:
+        src, dest: 编码后的源方言及目标方言特征
+        metric: 度量，决定特征的排列方式
+        mmap: 是否以内存映射的方式共享给并行任务，见 `_sharing`
+        data: 和特征一起共享给并行任务的其他数据
+
+    Yields:
+        block_args: 根据分块位置及大小生成度量函数参数的函数
+        data: 共享后的其他数据，顺序同参数
+
+    配对的度量（卡方）以按交叉特征、方言排列的交叉特征同时作为特征和目标，
+    每个分块包含交叉特征数组参数，第 i 组只计算源方言和目标方言的第 i 个交叉特征；
+    其他度量以按方言排列的交叉特征为特征、原始特征为目标，每个分块只有一组参数。
+    """
 
-    # 和转置取平均构造对称阵
-    sim = (sim + sim.T) / 2
-    # 除以对角线元素的平方根缩放到 [-1, 1] 区间，前提是对角线元素的相似度最大
-    d = numpy.sqrt(numpy.diagonal(sim))
-    sim /= d[:, None]
-    sim /= d[None, :]
+    if metric.paired:
+        features, _, feature_limits = src.chi2_features()
+        targets, _, target_limits = dest.chi2_features()
+        parts = src.feature_column
+        # 第 i 组中第 d 个方言的特征组下标为 i * 方言数 + d
+        feature_step = (src.dialect_num, 1)
+        target_step = (dest.dialect_num, 1)
+    else:
+        features, feature_limits = src.features, src.feature_limits
+        targets, target_limits = dest.targets, dest.target_limits
+        parts = 1
+        feature_step = (0, src.feature_column)
+        target_step = (0, dest.feature_num)
+
+    # 特征和目标相同时只共享一份数据
+    same = targets is features
+    shared = {'features': features} if same \
+        else {'features': features, 'targets': targets}
+
+    with _sharing(mmap, **shared, **data) as (values, take):
+        features = values[0]
+        targets = features if same else values[1]
+
+        def block_args(row, col, blocksize):
+            """
+            分块的度量函数参数
+
+            Parameters:
+                row, col: 分块左上角的位置
+                blocksize: 分块大小
+
+            Returns:
+                shape: 归并前度量矩阵的形状，见 `_Metric`
+                args: 每组度量函数的参数 (features, feature_limits, targets, target_limits)，
+                    可以包含延迟切片
+            """
+
+            rows = min(blocksize[0], src.dialect_num - row)
+            cols = min(blocksize[1], dest.dialect_num - col)
+            args = []
+            for i in range(parts):
+                fb = i * feature_step[0] + row * feature_step[1]
+                fe = fb + rows * feature_step[1]
+                tb = i * target_step[0] + col * target_step[1]
+                te = tb + cols * target_step[1]
+                args.append((
+                    take(features, feature_limits[fb], feature_limits[fe]),
+                    feature_limits[fb:fe + 1] - feature_limits[fb],
+                    take(targets, target_limits[tb], target_limits[te]),
+                    target_limits[tb:te + 1] - target_limits[tb]
+                ))
 
-    # 如果有元素异常超出 [-1, 1] 区间，强制裁剪到 [-1, 1]
-    overflow = numpy.count_nonzero((sim < -1) | (sim > 1))
-    if overflow > 1:
-        logging.warning('{}/{} similarity out of [-1, 1], clip'.format(
-            overflow,
-            sim.size
-        ))
-        sim = numpy.clip(sim, -1, 1)
+            return (rows, parts * feature_step[1], cols, target_step[1]), args
 
-    return sim
+        yield block_args, values[len(shared):]
 
-def sim2dist(sim):
-    '''
-    相似度矩阵转换成距离矩阵.
+def _block_task(
+    kernel: collections.abc.Callable,
+    reduce: collections.abc.Callable,
+    shape: tuple[int, int, int, int],
+    args: list[tuple]
+) -> numpy.ndarray[float]:
+    """
+    在并行任务中计算一个分块的度量并归并
 
-    假设相似阵的元素是欧氏空间向量的内积 sij = xi * xj，
-    因此 dij^2 = (xi - xj)^2 = xi^2 + xj^2 - 2xi * xj = sii + sjj - 2sij
-    '''
+    Parameters:
+        kernel, reduce: 度量的计算及归并函数，见 `_METRICS`
+        shape: 归并前度量矩阵的形状
+        args: 每组度量函数的参数，可以包含延迟切片
 
-    d2 = numpy.diagonal(sim)
-    d2 = -2 * sim + d2[:, None] + d2[None, :]
+    Returns:
+        values: 源方言数 x 目标方言数的度量
+    """
 
-    # 有少量元素 < 0 是由于计算相似度的时候取近似导致的，强制为0
-    minus = numpy.count_nonzero(d2 < 0)
-    if minus > 0:
-        logging.warning('{}/{} distance square < 0, clip to 0'.format(
-            minus,
-            d2.size
-        ))
-        d2 = numpy.maximum(d2, 0)
+    values = [_run_block(kernel, *a) for a in args]
+    return reduce(numpy.stack(values, axis=1).reshape(shape))
+
+def _iter_blocks(
+    src: PreparedFeatures,
+    dest: PreparedFeatures,
+    method: str,
+    blocksize: tuple[int, int],
+    parallel: int,
+    mmap: bool,
+    symmetric: bool = False,
+    checkpoint: str | os.PathLike | None = None
+) -> collections.abc.Iterator[tuple[int, int, numpy.ndarray[float]]]:
+    """
+    分块计算源方言到目标方言的度量
 
-    return numpy.sqrt(d2)
+    Parameters:
+        src, dest: 编码后的源方言及目标方言特征
+        method: 度量名称，见 `_METRICS`
+        symmetric: 为真时只计算对角线及上三角的分块，下三角由转置得到，
+            只用于 `dest` 和 `src` 相同的配对度量，此时分块大小取 `blocksize[0]`
+        checkpoint: 保存断点的根目录，为 None 时不保存断点
+        其余参数同 `pairwise`
+
+    Yields:
+        row, col: 分块左上角在结果矩阵中的位置
+        values: 分块的度量矩阵，已归并多个特征和目标。
+            对称模式下，非对角线的分块计算一次，同时产出该分块及其转置
+
+    `chi2`、`pairwise` 及 `topk` 共用的分块调度，负责断点恢复及保存、并行计算和对称模式。
+    """
 
-def dist2sim(dist):
-    '''距离矩阵转换成相似度矩阵'''
+    metric = _METRICS[method]
+    src_num = src.dialect_num
+    dest_num = dest.dialect_num
+    if symmetric:
+        blocksize = (blocksize[0], blocksize[0])
+
+    blocks = _block_list(src_num, dest_num, blocksize, symmetric)
+    run_dir = _run_dir(
+        checkpoint,
+        method,
+        src,
+        None if dest is src else dest,
+        blocksize=blocksize,
+        symmetric=symmetric
+    )
 
-    max_sqrt = numpy.sqrt(numpy.max(dist, axis=0))
-    return 1 - dist / max_sqrt[:, None] / max_sqrt[None, :]
+    def mirror(row, col, values):
+        yield row, col, values
+        if symmetric and row != col:
+            yield col, row, values.T
 
+    # 从断点恢复已完成的分块
+    saved = _Checkpoint(run_dir)
+    finished = [b for b in blocks if b in saved]
+    blocks = [b for b in blocks if b not in saved]
+    if len(finished) > 0:
+        logging.info(f'restore {len(finished)} blocks from {run_dir}')
 
-if __name__ == '__main__':
-    import os
-    import argparse
+    for row, col in finished:
+        yield from mirror(row, col, saved.load(row, col))
 
-    parser = argparse.ArgumentParser('根据指定方言数据集计算方言之间的预测相似度')
-    parser.add_argument(
-        '-m',
-        '--method',
-        choices=('chi2', 'entropy'),
-        help='计算方言间相似度的方法，如果不指定，计算所有方法的结果'
-    )
-    parser.add_argument(
-        '-o',
-        '--output',
-        help='输出路径，如果只有一个数据集及一个方法，为输出文件名，否则为输出目录'
-    )
-    parser.add_argument(
-        'dataset',
-        nargs='*',
-        default=('ccr',),
-        help='方言数据集名称或数据文件或目录路径'
+    if len(blocks) == 0:
+        return
+
+    logging.info(
+        f'computing {method} for {len(blocks)} blocks out of '
+        f'{(src_num + blocksize[0] - 1) // blocksize[0]} x '
+        f'{(dest_num + blocksize[1] - 1) // blocksize[1]}, '
+        f'block size = {blocksize} ...'
     )
-    args = parser.parse_args()
 
-    if args.method is None:
-        methods = 'chi2', 'entropy'
-    else:
-        methods = (args.method,)
-
-    for dts in args.dataset:
-        try:
-            data = getattr(datasets, dts)
-        except AttributeError:
-            # 如果在数据集不在支持的列表中，视为数据文件或目录路径，文件为 CSV 格式
-            if os.path.isdir(dts):
-                # 目录，递归检索目录下的所有文件，视每个文件为一个方言数据，文件名为方言 ID
-                data = datasets.FileDataset(pandas.Series(
-                    *zip(*[(os.path.join(c, f), os.path.splitext(f)[0]) \
-                        for c, _, fs in os.walk(dts) for f in fs])
-                ))
-                dts = os.path.basename(dts)
-            else:
-                data = pandas.read_csv(dts, dtype=str)
-                dts = os.path.splitext(os.path.basename(dts))[0]
-
-        data = preprocess.transform(
-            data.fillna({'initial': '', 'final': '', 'tone': ''}),
-            index='cid',
-            values=['initial', 'final', 'tone'],
-            aggfunc='first'
+    with _block_inputs(src, dest, metric, mmap) as (block_args, _):
+        tasks = (joblib.delayed(_block_task)(
+            metric.kernel,
+            metric.reduce,
+            *block_args(row, col, blocksize)
+        ) for row, col in blocks)
+
+        for count, ((row, col), values) \
+            in enumerate(zip(blocks, _imap(tasks, parallel)), 1):
+            values = values.astype(src.dtype)
+            if symmetric and row == col:
+                # 对角线上的分块和其转置取平均，消除计算误差导致的不对称
+                values = (values + values.T) / 2
+
+            saved.save(row, col, values)
+            yield from mirror(row, col, values)
+
+            if count % 10 == 0:
+                logging.info(f'finished {count} blocks')
+
+    logging.info(f'done. finished {len(blocks)} blocks')
+
+def _open_output(
+    out: str | os.PathLike | numpy.ndarray | None,
+    shape: tuple[int, int],
+    dtype=numpy.float32
+) -> numpy.ndarray[float]:
+    """
+    准备保存相似度矩阵的输出数组
+
+    Parameters:
+        out: 为 None 时在内存中新建数组；为路径时在该路径创建 .npy 格式的内存映射文件；
+            否则为预先分配的数组或内存映射，形状必须和 `shape` 相同
+        shape: 相似度矩阵的形状
+        dtype: 新建数组的数据类型
+
+    Returns:
+        out: 输出数组，计算完成的分块直接写入其中
+    """
+
+    if out is None:
+        return numpy.empty(shape, dtype=dtype)
+
+    if isinstance(out, str | os.PathLike):
+        return numpy.lib.format.open_memmap(
+            out,
+            mode='w+',
+            dtype=dtype,
+            shape=shape
         )
 
-        for method in methods:
-            # 如果输出文件只有一个，使用指定的路径作为文件名，否则作为输出目录
-            if len(args.dataset) > 1 or len(methods) > 1:
-                output = os.path.join(
-                    os.getcwd() if args.output is None else args.output,
-                    f'{dts}_{method}.csv'
+    if out.shape != shape:
+        raise ValueError(f'output shape {out.shape} does not match {shape}')
+
+    return out
+
+def _compute(
+    src: PreparedFeatures,
+    dest: PreparedFeatures,
+    method: str,
+    blocksize: tuple[int, int],
+    parallel: int,
+    mmap: bool,
+    symmetric: bool,
+    out: str | os.PathLike | numpy.ndarray | None,
+    checkpoint: str | os.PathLike | None
+) -> pandas.DataFrame | numpy.ndarray[float]:
+    """
+    分块计算完整的度量矩阵，每个分块完成后即写入输出
+
+    Parameters:
+        src, dest: 编码后的源方言及目标方言特征
+        method: 度量名称，见 `_METRICS`
+        其余参数同 `_iter_blocks` 及 `_open_output`
+
+    Returns:
+        values: 源方言和目标方言两两之间的度量矩阵，包含方言名称时为 pandas.DataFrame
+    """
+
+    values = _open_output(out, (src.dialect_num, dest.dialect_num), src.dtype)
+    for row, col, v in _timed_iter('compute', _iter_blocks(
+        src,
+        dest,
+        method,
+        blocksize,
+        parallel,
+        mmap,
+        symmetric,
+        checkpoint
+    )):
+        with _timed('output'):
+            values[row:row + v.shape[0], col:col + v.shape[1]] = v
+
+    if isinstance(values, numpy.memmap):
+        with _timed('output'):
+            values.flush()
+
+    return values if src.dialects is None and dest.dialects is None \
+        else pandas.DataFrame(values, index=src.dialects, columns=dest.dialects)
+
+def chi2(
+    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | PreparedFeatures,
+    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] \
+        | PreparedFeatures | None = None,
+    feature_num: int = 3,
+    blocksize: tuple[int, int] = (100, 100),
+    parallel: int = 1,
+    mmap: bool = False,
+    symmetric: bool = True,
+    out: str | os.PathLike | numpy.ndarray | None = None,
+    checkpoint: str | os.PathLike | None = None
+) -> pandas.DataFrame | numpy.ndarray[float]:
+    """
+    使用卡方检验计算方言之间的相似度
+
+    Parameters:
+        src: 源方言数据表，或预先编码的特征 `PreparedFeatures`
+        dest: 目标方言数据表或预先编码的特征，为 None 时和 `src` 相同
+        feature_num: `src` 和 `dest` 中特征数量，当 `src` 为 pandas.DataFrame 时，
+            从 `src` 自动推导
+        blocksize: 指定并行计算时每块数据的大小
+        parallel: 并行计算的并行数
+        mmap: 为真时把编码后的特征以内存映射的方式共享给并行任务，
+            每个任务只接收数据块的范围
+        symmetric: 为真且 `dest` 为 None 时，利用卡方的对称性只计算上三角的分块，
+            下三角由转置得到，此时分块大小取 `blocksize[0]`
+        out: 保存结果的数组、内存映射或 .npy 文件路径，每个分块计算完成后即写入，
+            用于结果矩阵过大、不宜完全放在内存中的情形，见 `_open_output`
+        checkpoint: 保存断点的根目录，每个分块完成后保存在以输入数据及参数指纹命名的运行目录中，
+            中断后以相同的输入和参数重新运行时跳过已完成的分块
+
+    Returns:
+        chi2: 源方言和目标方言两两之间的条件熵矩阵，当 `src` 和 `dest` 为
+            pandas.DataFrame 包含方言名称时，指定 `chi2` 的行列为相应名称
+
+    思路为，如果 A 方言的声母 + 韵母能很大程度预测 B 方言的声母 + 韵母，说明 B 方言接近 A 方言。
+    这种预测能力通过卡方检验来衡量，卡方值越大表示越相似。
+    遍历 A 方言及 B 方言的声母、韵母、声调组合，取平均得到 A、B 方言之间的相似度评分。
+
+    理论上由于自由度不同，卡方值不能直接比较，而应该比较相应的 p-value，但由于统计得出的卡方值非常大，
+    导致计算出的 p-value 下溢为0，不能比较，另一方面由于自由度都比较大，卡方值近似于正态分布，
+    可以把卡方值正则化到标准正态分布后进行比较。
+
+    卡方检验对于 A、B 方言是对称的，即理论上相似度矩阵是对称阵，但由于计算精度的原因可能出现极小的误差导致不对称。
+    可以取相似度矩阵和其转置的平均来强制保证对称性。当 `symmetric` 为真时，结果严格对称，
+    且只需编码一次数据、计算约一半的分块。
+    """
+
+    src, dest = _prepare(src, dest, feature_num)
+    symmetric = symmetric and dest is src
+
+    logging.info(
+        f'compute X2 for {src.dialect_num} x {dest.dialect_num} dialects, '
+        f'characters = {src.character_num}, features = {src.feature_num}, '
+        f'block size = {blocksize}, parallel = {parallel}'
+    )
+
+    return _compute(
+        src,
+        dest,
+        'chi2',
+        blocksize,
+        parallel,
+        mmap,
+        symmetric,
+        out,
+        checkpoint
+    )
+
+def update_chi2(
+    previous: pandas.DataFrame,
+    src: pandas.DataFrame | PreparedFeatures,
+    dest: pandas.DataFrame | PreparedFeatures | None = None,
+    feature_num: int = 3,
+    blocksize: tuple[int, int] = (100, 100),
+    parallel: int = 1
+) -> pandas.DataFrame:
+    """
+    在已有结果的基础上增量计算新增方言的卡方相似度
+
+    Parameters:
+        previous: 之前计算得到的卡方相似度矩阵，行列为方言名称
+        src: 包含新增方言的源方言数据表或编码后的特征，必须包含方言名称
+        dest: 包含新增方言的目标方言数据表或编码后的特征，为 None 时和 `src` 相同
+        feature_num: `src` 和 `dest` 中特征数量，当 `src` 为 pandas.DataFrame 时，
+            从 `src` 自动推导
+        blocksize: 指定并行计算时每块数据的大小
+        parallel: 并行计算的并行数
+
+    Returns:
+        chi2: 更新后的卡方相似度矩阵，行列为 `src` 和 `dest` 中的方言，
+            `previous` 中有而 `src`、`dest` 中没有的方言被删除
+
+    由于特征编码及概率估算都是针对每个方言单独进行的，只需对新增行列涉及的方言编码，
+    计算结果和从头计算在浮点误差范围内相同。新增的行不像 `chi2` 的对称模式那样和转置取平均，
+    因此和从头计算的结果可能有极小的差异。当 `dest` 为 None 时，利用卡方的对称性，
+    只计算新增方言所在的行，再转置得到新增的列。
+    """
+
+    src, dest = _prepare(src, dest, feature_num)
+    if src.dialects is None or dest.dialects is None:
+        raise ValueError(
+            'update_chi2 requires dialect names to match previous results, '
+            'pass pandas.DataFrame or PreparedFeatures built from one'
+        )
+
+    symmetric = dest is src
+
+    index = src.dialects
+    columns = dest.dialects
+    old_rows = index[index.isin(previous.index)]
+    new_rows = index[~index.isin(previous.index)]
+    new_cols = columns[~columns.isin(previous.columns)]
+
+    logging.info(
+        f'update X2 for {new_rows.shape[0]} new sources and '
+        f'{new_cols.shape[0]} new destinations, '
+        f'{old_rows.shape[0]} sources reused'
+    )
+
+    chisq = previous.reindex(index=index, columns=columns)
+
+    # 新增的行，需要计算到所有目标方言的卡方
+    if new_rows.shape[0] > 0:
+        chisq.loc[new_rows] = chi2(
+            src.select(new_rows),
+            dest,
+            blocksize=blocksize,
+            parallel=parallel
+        ).values
+
+    # 已有的行只需计算新增的列
+    if new_cols.shape[0] > 0 and old_rows.shape[0] > 0:
+        if symmetric:
+            chisq.loc[old_rows, new_cols] = chisq.loc[new_cols, old_rows].values.T
+        else:
+            chisq.loc[old_rows, new_cols] = chi2(
+                src.select(old_rows),
+                dest.select(new_cols),
+                blocksize=blocksize,
+                parallel=parallel
+            ).values
+
+    return chisq
+
+def _entropy(
+    features: scipy.sparse.csr_matrix,
+    feature_limits: numpy.ndarray[int],
+    targets: scipy.sparse.csr_matrix,
+    target_limits: numpy.ndarray[int]
+) -> numpy.ndarray[float]:
+    """
+    计算稀疏特征矩阵到目标矩阵的条件熵
+
+    Parameters:
+        features: 源方言编码的特征稀疏矩阵
+        feature_limits: 表明特征矩阵中特征边界的数组
+        targets: 目标方言编码的目标稀疏矩阵
+        target_limits: 表明目标矩阵中目标边界的数组
+
+    Returns:
+        entropy: 每个特征到每个目标的条件熵矩阵
+
+    X 到 Y 的条件熵是条件概率 P(Y|X) 的期望 H(Y|X) = E[-log P(Y|X)]。
+    本函数通过构造 X 和 Y 的共现矩阵来计算 H(Y|X)，因为
+    P(Y|X) * -log P(y|x) = f(x, y) / f(x) * -log f(x, y) / f(x)
+    = (f(x, y) * log f(x) - f(x, y) * log f(x, y)) / f(x)
+    不直接计算 P(Y|X)，而是使用稀疏矩阵计算一些中间值来减少计算量。
+    """
+
+    # 计算共现频次及其对数
+    freq = _as_reduction(scipy.sparse.csr_matrix(features.T @ targets))
+    entropy = freq.copy()
+    entropy.data = numpy.where(
+        entropy.data == 0,
+        0,
+        entropy.data * numpy.log(entropy.data)
+    )
+
+    # 对共现矩阵的列分组求和，把目标不同取值的频次归并在一起
+    target_group = auxiliary.group_indicator(target_limits, freq.dtype)
+    freq = (freq @ target_group).toarray()
+    entropy = (entropy @ target_group).toarray()
+
+    # 计算特征频次的对数，然后减去共现频次的对数
+    feature_entropy = numpy.where(freq == 0, 0, freq * numpy.log(freq))
+    entropy = feature_entropy - entropy
+
+    # 对共现矩阵的行分组求和，把特征不同取值的频次归并在一起
+    feature_group = auxiliary.group_indicator(feature_limits, freq.dtype).T
+    freq = feature_group @ freq
+    entropy = feature_group @ entropy
+
+    # 频次对数除以样本总频次，得到真正的条件熵
+    entropy /= freq
+    invalid = numpy.count_nonzero(~(numpy.isfinite(entropy) & (entropy >= 0)))
+    if invalid > 0:
+        logging.warning(f'{invalid}/{entropy.size} invalid conditional entropy')
+
+    return entropy
+
+def _xlogx(x: numpy.ndarray[float]) -> numpy.ndarray[float]:
+    """计算 x * log(x)，约定 0 * log(0) = 0"""
+
+    return x * numpy.log(numpy.where(x > 0, x, 1))
+
+def _group_max(values: numpy.ndarray[float], limits: numpy.ndarray[int]) \
+    -> numpy.ndarray[float]:
+    """对稠密矩阵的列按分组求最大值，空的分组为0"""
+
+    sizes = numpy.diff(limits)
+    result = numpy.zeros((values.shape[0], sizes.shape[0]), dtype=values.dtype)
+    nonempty = sizes > 0
+    if numpy.any(nonempty):
+        result[:, nonempty] = numpy.maximum.reduceat(
+            values,
+            limits[:-1][nonempty],
+            axis=1
+        )
+
+    return result
+
+class _Contingency:
+    """
+    特征和目标分组两两之间的列联表
+
+    特征矩阵和目标矩阵相乘得到所有特征取值和目标取值的共现频次，为稀疏矩阵，
+    每一对特征组和目标组对应其中一个子矩阵，即一张列联表。
+    只统计特征和目标都不缺失的字，因此同一特征取值在不同目标组中的边缘频次不同。
+    各度量都通过在共现矩阵的非零元素上逐元素计算再按分组归并得到，不需要逐个构造列联表。
+    """
+
+    def __init__(
+        self,
+        features: scipy.sparse.spmatrix,
+        feature_limits: numpy.ndarray[int],
+        targets: scipy.sparse.spmatrix,
+        target_limits: numpy.ndarray[int]
+    ):
+        freq = scipy.sparse.coo_matrix(features.T @ targets, dtype=numpy.float64)
+        freq.eliminate_zeros()
+        self.shape = freq.shape
+        self.rows = freq.row
+        self.cols = freq.col
+        self.freq = freq.data
+
+        self.feature_limits = feature_limits
+        self.target_limits = target_limits
+        self.feature_indicator \
+            = auxiliary.group_indicator(feature_limits, numpy.float64)
+        self.target_indicator \
+            = auxiliary.group_indicator(target_limits, numpy.float64)
+        self.feature_groups = numpy.repeat(
+            numpy.arange(feature_limits.shape[0] - 1),
+            numpy.diff(feature_limits)
+        )
+        self.target_groups = numpy.repeat(
+            numpy.arange(target_limits.shape[0] - 1),
+            numpy.diff(target_limits)
+        )
+
+        # 每个特征取值在每个目标组中的边缘频次，及每个目标取值在每个特征组中的边缘频次
+        freq = freq.tocsr()
+        self.row_margins = (freq @ self.target_indicator).toarray()
+        self.col_margins = (self.feature_indicator.T @ freq).toarray()
+        # 每张列联表的总频次
+        self.total = self.merge_rows(self.row_margins)
+
+    def merge(self, values: numpy.ndarray[float]) -> numpy.ndarray[float]:
+        """把共现矩阵非零元素上的值按特征组和目标组求和"""
+
+        values = scipy.sparse.csr_matrix(
+            (values, (self.rows, self.cols)),
+            shape=self.shape
+        )
+        return (self.feature_indicator.T @ values @ self.target_indicator) \
+            .toarray()
+
+    def merge_rows(self, values: numpy.ndarray[float]) -> numpy.ndarray[float]:
+        """把特征取值 x 目标组的稠密矩阵按特征组求和"""
+
+        return self.feature_indicator.T @ values
+
+    def merge_cols(self, values: numpy.ndarray[float]) -> numpy.ndarray[float]:
+        """把特征组 x 目标取值的稠密矩阵按目标组求和"""
+
+        return numpy.asarray(values @ self.target_indicator)
+
+    def expand(self, values: numpy.ndarray[float]) -> numpy.ndarray[float]:
+        """取特征组 x 目标组的矩阵在共现矩阵每个非零元素对应位置的值"""
+
+        return values[self.feature_groups[self.rows], self.target_groups[self.cols]]
+
+    def row_values(self) -> numpy.ndarray[float]:
+        """共现矩阵每个非零元素对应的特征取值边缘频次"""
+
+        return self.row_margins[self.rows, self.target_groups[self.cols]]
+
+    def col_values(self) -> numpy.ndarray[float]:
+        """共现矩阵每个非零元素对应的目标取值边缘频次"""
+
+        return self.col_margins[self.feature_groups[self.rows], self.cols]
+
+    def entropies(self) -> tuple[
+        numpy.ndarray[float],
+        numpy.ndarray[float],
+        numpy.ndarray[float]
+    ]:
+        """
+        计算每张列联表的熵
+
+        Returns:
+            feature_entropy, target_entropy, joint_entropy: 特征、目标的边缘熵及联合熵，
+                H = log N - sum(f * log f) / N
+        """
+
+        log_total = numpy.log(self.total)
+        return (
+            log_total - self.merge_rows(_xlogx(self.row_margins)) / self.total,
+            log_total - self.merge_cols(_xlogx(self.col_margins)) / self.total,
+            log_total - self.merge(_xlogx(self.freq)) / self.total
+        )
+
+def _mutual_info(*args) -> numpy.ndarray[float]:
+    """
+    计算特征和目标的互信息
+
+    Parameters:
+        args: 同 `_entropy`
+
+    Returns:
+        mi: 每个特征和每个目标的互信息 I(X; Y) = H(X) + H(Y) - H(X, Y)
+    """
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        feature_entropy, target_entropy, joint_entropy \
+            = _Contingency(*args).entropies()
+        return feature_entropy + target_entropy - joint_entropy
+
+def _normalized_mutual_info(*args) -> numpy.ndarray[float]:
+    """
+    计算特征和目标的归一化互信息
+
+    Parameters:
+        args: 同 `_entropy`
+
+    Returns:
+        nmi: I(X; Y) / sqrt(H(X) * H(Y))，取值 [0, 1]，
+            特征或目标只有一个取值时为0
+    """
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        feature_entropy, target_entropy, joint_entropy \
+            = _Contingency(*args).entropies()
+        norm = numpy.sqrt(feature_entropy * target_entropy)
+        return numpy.where(
+            norm > 0,
+            (feature_entropy + target_entropy - joint_entropy) / norm,
+            numpy.where(numpy.isnan(norm), numpy.nan, 0)
+        )
+
+def _cramers_v(*args) -> numpy.ndarray[float]:
+    """
+    计算特征和目标的 Cramér's V
+
+    Parameters:
+        args: 同 `_entropy`
+
+    Returns:
+        v: sqrt(X2 / N / (min(r, c) - 1))，其中 r、c 为列联表中实际出现的特征和目标取值数，
+            取值 [0, 1]，min(r, c) = 1 时为0
+
+    X2 / N = sum(f(x, y)^2 / (f(x) * f(y))) - 1，只需要在共现矩阵的非零元素上求和。
+    """
+
+    table = _Contingency(*args)
+    phi2 = table.merge(
+        numpy.square(table.freq) / (table.row_values() * table.col_values())
+    ) - 1
+    dof = numpy.minimum(
+        table.merge_rows((table.row_margins > 0).astype(numpy.float64)),
+        table.merge_cols((table.col_margins > 0).astype(numpy.float64))
+    ) - 1
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(
+            dof > 0,
+            numpy.sqrt(numpy.maximum(phi2, 0) / dof),
+            numpy.where(table.total > 0, 0, numpy.nan)
+        )
+
+def _goodman_kruskal_lambda(*args) -> numpy.ndarray[float]:
+    """
+    计算由特征预测目标的 Goodman-Kruskal lambda
+
+    Parameters:
+        args: 同 `_entropy`
+
+    Returns:
+        lambda: (sum_x max_y f(x, y) - max_y f(y)) / (N - max_y f(y))，
+            即已知特征后预测目标的错误率下降的比例，取值 [0, 1]，目标只有一个取值时为0
+    """
+
+    table = _Contingency(*args)
+
+    # 每个特征取值在每个目标组中最多的目标取值频次
+    row_max = numpy.zeros_like(table.row_margins)
+    numpy.maximum.at(
+        row_max,
+        (table.rows, table.target_groups[table.cols]),
+        table.freq
+    )
+    col_max = _group_max(table.col_margins, table.target_limits)
+
+    error = table.total - col_max
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(
+            error > 0,
+            (table.merge_rows(row_max) - col_max) / error,
+            numpy.where(table.total > 0, 0, numpy.nan)
+        )
+
+def _jensen_shannon(*args) -> numpy.ndarray[float]:
+    """
+    计算特征和目标联合分布与独立分布之间的 Jensen-Shannon 散度
+
+    Parameters:
+        args: 同 `_entropy`
+
+    Returns:
+        js: JS(P(X, Y) || P(X) P(Y))，以2为底，取值 [0, 1]，特征和目标独立时为0
+
+    记 p = P(x, y)，q = P(x) P(y)，m = (p + q) / 2，则
+    JS = (sum(p * log(p / m)) + sum(q * log(q / m))) / 2。
+    p = 0 的位置每项为 q * log 2，因此只需在共现矩阵的非零元素上计算，
+    剩余部分为 (1 - sum_{p > 0} q) * log 2。
+    """
+
+    table = _Contingency(*args)
+    total = table.expand(table.total)
+    p = table.freq / total
+    q = table.row_values() * table.col_values() / numpy.square(total)
+    m = (p + q) / 2
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return (
+            table.merge(p * numpy.log(p / m) + q * numpy.log(q / m))
+            + (1 - table.merge(q)) * numpy.log(2)
+        ) / (2 * numpy.log(2)) + numpy.where(table.total > 0, 0, numpy.nan)
+
+def _mean_pairs(values: numpy.ndarray[float]) -> numpy.ndarray[float]:
+    """对多组配对的交叉特征取平均"""
+
+    return numpy.mean(values, axis=(1, 3))
+
+def _min_sum(values: numpy.ndarray[float]) -> numpy.ndarray[float]:
+    """取多个特征中的最小值，再对目标求和"""
+
+    return numpy.sum(numpy.min(values, axis=1), axis=-1)
+
+def _max_mean(values: numpy.ndarray[float]) -> numpy.ndarray[float]:
+    """取多个特征中的最大值，再对目标求平均"""
+
+    return numpy.mean(numpy.max(values, axis=1), axis=-1)
+
+# 分块计算的度量，kernel 计算每个特征到每个目标的度量，reduce 把形状为
+# (源方言数, 交叉特征数, 目标方言数, 目标特征数) 的度量归并为源方言数 x 目标方言数，
+# greater_is_better 表示度量越大是否越相似。paired 为真时源方言和目标方言的交叉特征
+# 一一配对计算，此时目标特征数为1，且度量对源方言和目标方言对称
+_Metric = collections.namedtuple(
+    '_Metric',
+    ('kernel', 'reduce', 'greater_is_better', 'paired'),
+    defaults=(False,)
+)
+
+_METRICS = {
+    'chi2': _Metric(_chi2, _mean_pairs, True, True),
+    'entropy': _Metric(_entropy, _min_sum, False),
+    'mi': _Metric(_mutual_info, _max_mean, True),
+    'nmi': _Metric(_normalized_mutual_info, _max_mean, True),
+    'cramers_v': _Metric(_cramers_v, _max_mean, True),
+    'lambda': _Metric(_goodman_kruskal_lambda, _max_mean, True),
+    'js': _Metric(_jensen_shannon, _max_mean, True)
+}
+
+def pairwise(
+    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | PreparedFeatures,
+    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] \
+        | PreparedFeatures | None = None,
+    metric: str = 'mi',
+    feature_num: int = 3,
+    blocksize: tuple[int, int] = (100, 100),
+    parallel: int = 1,
+    mmap: bool = False,
+    out: str | os.PathLike | numpy.ndarray | None = None,
+    checkpoint: str | os.PathLike | None = None
+) -> pandas.DataFrame | numpy.ndarray[float]:
+    """
+    分块计算方言之间的度量
+
+    Parameters:
+        src: 源方言数据表，或预先编码的特征 `PreparedFeatures`
+        dest: 目标方言数据表或预先编码的特征，为 None 时和 `src` 相同
+        metric: 度量名称，可以为
+            - chi2: 标准化卡方，同 `chi2`，但不利用对称性
+            - entropy: 条件熵，越小越相似
+            - mi: 互信息
+            - nmi: 归一化互信息
+            - cramers_v: Cramér's V
+            - lambda: Goodman-Kruskal lambda
+            - js: 联合分布和独立分布之间的 Jensen-Shannon 散度
+            除条件熵外均为越大越相似
+        feature_num: `src` 和 `dest` 中特征数量，当 `src` 为 pandas.DataFrame 时，
+            从 `src` 自动推导
+        blocksize: 指定并行计算时每块数据的大小
+        parallel: 并行计算的并行数
+        mmap: 为真时把编码后的特征及目标以内存映射的方式共享给并行任务，
+            每个任务只接收数据块的范围
+        out: 保存结果的数组、内存映射或 .npy 文件路径，每个分块计算完成后即写入，
+            见 `_open_output`
+        checkpoint: 保存断点的根目录，每个分块完成后保存在以输入数据及参数指纹命名的运行目录中，
+            中断后以相同的输入和参数重新运行时跳过已完成的分块
+
+    Returns:
+        values: 源方言和目标方言两两之间的度量矩阵，当 `src` 和 `dest` 为
+            pandas.DataFrame 包含方言名称时，指定 `values` 的行列为相应名称
+
+    对每个目标方言的每个特征，如声母，取源方言所有交叉特征中预测能力最强的一个，
+    条件熵对目标方言的各特征求和，其他度量取平均。
+    """
+
+    if metric not in _METRICS:
+        raise ValueError(f'unknown metric {metric}')
+
+    src, dest = _prepare(src, dest, feature_num)
+
+    logging.info(
+        f'compute {metric} for {src.dialect_num} sources '
+        f'{dest.dialect_num} destinations, characters = {src.character_num}, '
+        f'features = {src.feature_num}, block size = {blocksize}, '
+        f'parallel = {parallel}'
+    )
+
+    return _compute(
+        src,
+        dest,
+        metric,
+        blocksize,
+        parallel,
+        mmap,
+        False,
+        out,
+        checkpoint
+    )
+
+def entropy(
+    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | PreparedFeatures,
+    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] \
+        | PreparedFeatures | None = None,
+    feature_num: int = 3,
+    blocksize: tuple[int, int] = (100, 100),
+    parallel: int = 1,
+    mmap: bool = False,
+    out: str | os.PathLike | numpy.ndarray | None = None,
+    checkpoint: str | os.PathLike | None = None
+) -> pandas.DataFrame | numpy.ndarray[float]:
+    """
+    计算方言之间的条件熵
+
+    Parameters:
+        src: 源方言数据表，或预先编码的特征 `PreparedFeatures`
+        dest: 目标方言数据表或预先编码的特征，为 None 时和 `src` 相同
+        其余参数同 `pairwise`
+
+    Returns:
+        entropy: 源方言和目标方言两两之间的条件熵矩阵，当 `src` 和 `dest` 为
+            pandas.DataFrame 包含方言名称时，指定 `entropy` 的行列为相应名称
+    """
+
+    return pairwise(
+        src,
+        dest,
+        'entropy',
+        feature_num=feature_num,
+        blocksize=blocksize,
+        parallel=parallel,
+        mmap=mmap,
+        out=out,
+        checkpoint=checkpoint
+    )
+
+def topk(
+    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | PreparedFeatures,
+    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] \
+        | PreparedFeatures | None = None,
+    k: int = 20,
+    method: str = 'chi2',
+    exclude_self: bool = True,
+    feature_num: int = 3,
+    blocksize: tuple[int, int] = (100, 100),
+    parallel: int = 1,
+    mmap: bool = False,
+    checkpoint: str | os.PathLike | None = None
+) -> tuple[pandas.DataFrame, pandas.DataFrame] \
+    | tuple[numpy.ndarray[int], numpy.ndarray[float]]:
+    """
+    查询每个源方言最相似的 k 个目标方言
+
+    Parameters:
+        src: 源方言数据表，或预先编码的特征 `PreparedFeatures`
+        dest: 目标方言数据表或预先编码的特征，为 None 时和 `src` 相同
+        k: 每个源方言返回的最相似目标方言数，超过可选的目标方言数时
+            取可选的目标方言数
+        method: 计算相似度的方法，chi2 或 `pairwise` 支持的度量
+        exclude_self: `dest` 为 None 时，是否从结果中排除源方言自身
+        其余参数同 `chi2` 和 `pairwise`
+
+    Returns:
+        neighbors: 源方言数 x k 的矩阵，每行为按相似度从高到低排列的目标方言，
+            当 `src` 和 `dest` 包含方言名称时为名称，否则为目标方言的下标
+        scores: 和 `neighbors` 对应的卡方或度量值
+
+    逐块计算相似度，每块完成后和每行已有的候选合并，只保留最相似的 k 个，
+    因此内存占用为 O(N·k)，不需要生成完整的相似度矩阵。卡方越大越相似，条件熵越小越相似。
+    """
+
+    if method not in _METRICS:
+        raise ValueError(f'unknown method {method}')
+    if k < 1:
+        raise ValueError(f'k must be at least 1, got {k}')
+
+    src, dest = _prepare(src, dest, feature_num)
+    symmetric = dest is src
+    exclude_self = exclude_self and symmetric
+
+    candidate_num = dest.dialect_num - 1 if exclude_self else dest.dialect_num
+    if k > candidate_num:
+        logging.warning(
+            f'k = {k} is larger than {candidate_num} candidate destinations, '
+            f'use {candidate_num}'
+        )
+        k = candidate_num
+
+    if k < 1:
+        raise ValueError('no candidate destinations')
+
+    logging.info(
+        f'query top {k} of {dest.dialect_num} destinations for '
+        f'{src.dialect_num} sources by {method}, '
+        f'characters = {src.character_num}, features = {src.feature_num}, '
+        f'block size = {blocksize}, parallel = {parallel}'
+    )
+
+    metric = _METRICS[method]
+    blocks = _iter_blocks(
+        src,
+        dest,
+        method,
+        blocksize,
+        parallel,
+        mmap,
+        metric.paired and symmetric,
+        checkpoint
+    )
+    sign = 1 if metric.greater_is_better else -1
+
+    # 统一转换成越大越相似的分数，无效值视为最不相似
+    scores = numpy.full((src.dialect_num, k), -numpy.inf, dtype=src.dtype)
+    neighbors = numpy.full((src.dialect_num, k), -1, dtype=int)
+
+    for row, col, block in blocks:
+        rows = slice(row, row + block.shape[0])
+        block = sign * block
+        if exclude_self:
+            # 源方言自身不作为候选
+            diag = numpy.arange(row, rows.stop)
+            mask = (diag >= col) & (diag < col + block.shape[1])
+            block[diag[mask] - row, diag[mask] - col] = -numpy.inf
+
+        candidate_scores = numpy.concatenate(
+            [scores[rows], numpy.where(numpy.isnan(block), -numpy.inf, block)],
+            axis=1
+        )
+        candidates = numpy.concatenate([
+            neighbors[rows],
+            numpy.broadcast_to(
+                numpy.arange(col, col + block.shape[1]),
+                block.shape
+            )
+        ], axis=1)
+
+        # 每行只保留分数最高的 k 个候选
+        idx = numpy.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+        scores[rows] = numpy.take_along_axis(candidate_scores, idx, axis=1)
+        neighbors[rows] = numpy.take_along_axis(candidates, idx, axis=1)
+
+    order = numpy.argsort(-scores, axis=1, kind='stable')
+    scores = numpy.take_along_axis(scores, order, axis=1) * sign
+    neighbors = numpy.take_along_axis(neighbors, order, axis=1)
+
+    if src.dialects is None or dest.dialects is None:
+        return neighbors, scores
+
+    return (
+        pandas.DataFrame(dest.dialects.values[neighbors], index=src.dialects),
+        pandas.DataFrame(scores, index=src.dialects)
+    )
+
+def _weight_rows(matrix: scipy.sparse.spmatrix, weights: numpy.ndarray[int]) \
+    -> scipy.sparse.csc_matrix:
+    """对稀疏矩阵的每一行乘以权重，即 diag(w) @ matrix"""
+
+    return scipy.sparse.csc_matrix(
+        scipy.sparse.diags(weights.astype(matrix.dtype)) @ matrix
+    )
+
+def _bootstrap_block(
+    kernel: collections.abc.Callable,
+    reduce: collections.abc.Callable,
+    shape: tuple[int, int, int, int],
+    weights: numpy.ndarray[int],
+    batch: int,
+    args: list[tuple]
+) -> numpy.ndarray[float]:
+    """
+    计算一个分块在多次重采样下的度量
+
+    Parameters:
+        kernel, reduce: 度量的计算及归并函数，见 `_METRICS`
+        shape: 归并前度量矩阵的形状，见 `_block_inputs`
+        weights: 重采样次数 x 字数的权重矩阵，每个元素为该字在该次重采样中被抽中的次数
+        batch: 每批同时计算的重采样次数
+        args: 每组度量函数的参数，可以包含延迟切片，见 `_block_inputs`
+
+    Returns:
+        values: 重采样次数 x 源方言数 x 目标方言数的度量
+
+    重采样后的共现频次为 features.T @ diag(w) @ targets。把每批重采样的加权特征矩阵
+    横向拼接成一个大的特征矩阵，一次稀疏矩阵乘法即得到整批重采样的共现频次，无需重新编码。
+    """
+
+    args = [_resolve(a) for a in args]
+    results = []
+    for start in range(0, weights.shape[0], batch):
+        w = weights[start:start + batch]
+        values = []
+        for features, feature_limits, targets, target_limits in args:
+            size = feature_limits[-1]
+            stacked = scipy.sparse.hstack(
+                [_weight_rows(features, r) for r in w],
+                format='csc'
+            )
+            limits = numpy.concatenate(
+                [feature_limits[:-1] + i * size for i in range(w.shape[0])] \
+                    + [[w.shape[0] * size]]
+            )
+            values.append(numpy.split(
+                kernel(stacked, limits, targets, target_limits),
+                w.shape[0]
+            ))
+
+        # 每次重采样的各组度量拼接后归并
+        results.extend(reduce(numpy.stack(v, axis=1).reshape(shape)) \
+            for v in zip(*values))
+
+    return numpy.stack(results)
+
+def _bootstrap_chi2_block(weights: numpy.ndarray[int], args: list[tuple]) \
+    -> numpy.ndarray[float]:
+    """
+    计算一个分块在多次重采样下的卡方
+
+    Parameters:
+        weights: 重采样次数 x 字数的权重矩阵
+        args: 每组交叉特征的 (features, feature_limits, targets, target_limits)，
+            可以包含延迟切片，见 `_block_inputs`
+
+    Returns:
+        chisq: 重采样次数 x 源方言数 x 目标方言数的卡方，已对多组交叉特征取平均
+
+    特征及目标的概率、取值数也根据重采样后的频次重新估算，因此目标也要加权，
+    不能像 `_bootstrap_block` 那样拼接多次重采样一起计算。
+    """
+
+    args = [_resolve(a) for a in args]
+
+    def observed(matrix, limits, freqs):
+        """去掉重采样中没有出现的取值，和对重采样的数据重新编码一致"""
+
+        mask = freqs > 0
+        groups = numpy.repeat(numpy.arange(limits.shape[0] - 1), numpy.diff(limits))
+        categories = numpy.bincount(groups[mask], minlength=limits.shape[0] - 1)
+        return (
+            matrix[:, mask],
+            categories,
+            freq2prob(
+                freqs[mask],
+                numpy.concatenate([[0], numpy.cumsum(categories)])
+            )
+        )
+
+    results = []
+    for w in weights:
+        chisq = 0
+        for features, feature_limits, targets, target_limits in args:
+            features = _weight_rows(features, w)
+            features, feature_categories, feature_probs = observed(
+                features,
+                feature_limits,
+                numpy.asarray(features.sum(axis=0)).ravel()
+            )
+            targets, target_categories, target_probs = observed(
+                targets,
+                target_limits,
+                numpy.asarray(targets.T @ w).ravel()
+            )
+            chisq = chisq + chi2_block(
+                features,
+                feature_categories,
+                feature_probs,
+                targets,
+                target_categories,
+                target_probs
+            )
+
+        results.append(chisq / len(args))
+
+    return numpy.stack(results)
+
+def bootstrap(
+    src: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] | PreparedFeatures,
+    dest: datasets.Dataset | pandas.DataFrame | numpy.ndarray[str] \
+        | PreparedFeatures | None = None,
+    method: str = 'entropy',
+    samples: int = 100,
+    percentiles: collections.abc.Iterable[float] = (2.5, 97.5),
+    seed: int | None = None,
+    batch: int = 10,
+    feature_num: int = 3,
+    blocksize: tuple[int, int] = (100, 100),
+    parallel: int = 1,
+    mmap: bool = False
+) -> tuple[
+    pandas.DataFrame | numpy.ndarray[float],
+    dict[float, pandas.DataFrame | numpy.ndarray[float]]
+]:
+    """
+    对字重采样，估计方言相似度的置信区间
+
+    Parameters:
+        src: 源方言数据表，或预先编码的特征 `PreparedFeatures`
+        dest: 目标方言数据表或预先编码的特征，为 None 时和 `src` 相同
+        method: 计算相似度的方法，chi2 或 `pairwise` 支持的度量
+        samples: 重采样次数
+        percentiles: 需要计算的百分位数，取值 [0, 100]
+        seed: 随机数种子
+        batch: 每批同时计算的重采样次数，越大计算越快，但内存占用越多
+        其余参数同 `chi2` 和 `pairwise`
+
+    Returns:
+        mean: 所有重采样结果的均值
+        percentiles: 百分位数到相应百分位矩阵的字典
+
+    每次重采样有放回地抽取和原数据相同数量的字，表示为每个字被抽中次数的权重，
+    复用原始数据的 one-hot 编码计算加权的共现频次。每个分块计算完所有重采样后即归并为
+    均值及百分位数，不保存所有重采样的结果。
+    """
+
+    if method not in _METRICS:
+        raise ValueError(f'unknown method {method}')
+
+    src, dest = _prepare(src, dest, feature_num)
+    metric = _METRICS[method]
+    percentiles = tuple(percentiles)
+    src_num = src.dialect_num
+    dest_num = dest.dialect_num
+
+    logging.info(
+        f'bootstrap {method} for {src_num} sources {dest_num} destinations, '
+        f'characters = {src.character_num}, samples = {samples}, '
+        f'block size = {blocksize}, parallel = {parallel}'
+    )
+
+    rng = numpy.random.default_rng(seed)
+    weights = rng.multinomial(
+        src.character_num,
+        numpy.full(src.character_num, 1 / src.character_num),
+        size=samples
+    ).astype(numpy.int32)
+
+    blocks = _block_list(src_num, dest_num, blocksize)
+    mean = numpy.empty((src_num, dest_num), dtype=src.dtype)
+    quantiles = numpy.empty(
+        (len(percentiles), src_num, dest_num),
+        dtype=src.dtype
+    )
+
+    # 权重和特征一起共享，共享模式下每个任务只接收引用
+    with _block_inputs(src, dest, metric, mmap, weights=weights) \
+        as (block_args, (weights,)):
+
+        def task(row, col):
+            shape, args = block_args(row, col, blocksize)
+            if method == 'chi2':
+                return joblib.delayed(_bootstrap_chi2_block)(weights, args)
+
+            return joblib.delayed(_bootstrap_block)(
+                metric.kernel,
+                metric.reduce,
+                shape,
+                weights,
+                batch,
+                args
+            )
+
+        tasks = (task(row, col) for row, col in blocks)
+        for count, ((row, col), values) \
+            in enumerate(zip(blocks, _imap(tasks, parallel)), 1):
+            rows = slice(row, row + values.shape[1])
+            cols = slice(col, col + values.shape[2])
+            mean[rows, cols] = numpy.mean(values, axis=0)
+            quantiles[:, rows, cols] = numpy.percentile(values, percentiles, axis=0)
+
+            if count % 10 == 0:
+                logging.info(f'finished {count} blocks')
+
+    logging.info(f'done. finished {len(blocks)} blocks')
+
+    if src.dialects is None and dest.dialects is None:
+        return mean, dict(zip(percentiles, quantiles))
+
+    return (
+        pandas.DataFrame(mean, index=src.dialects, columns=dest.dialects),
+        {p: pandas.DataFrame(q, index=src.dialects, columns=dest.dialects) \
+            for p, q in zip(percentiles, quantiles)}
+    )
+
+def save_labels(
+    path: str | os.PathLike,
+    index: pandas.Index,
+    columns: pandas.Index
+) -> None:
+    """
+    保存二进制相似度矩阵的行列名称
+
+    Parameters:
+        path: 相似度矩阵的 .npy 文件路径，名称保存在同名的 .json 文件中
+        index, columns: 相似度矩阵的行列名称
+    """
+
+    with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump(
+            {'index': index.tolist(), 'columns': columns.tolist()},
+            f,
+            ensure_ascii=False
+        )
+
+def load_matrix(
+    path: str | os.PathLike,
+    mmap_mode: str | None = 'r'
+) -> pandas.DataFrame | numpy.ndarray[float]:
+    """
+    加载以 .npy 格式保存的相似度矩阵
+
+    Parameters:
+        path: 相似度矩阵的 .npy 文件路径
+        mmap_mode: 传给 `numpy.load`，默认以只读内存映射的方式加载
+
+    Returns:
+        sim: 相似度矩阵，如果存在同名的 .json 名称文件，返回以名称为行列的 pandas.DataFrame
+    """
+
+    sim = numpy.load(path, mmap_mode=mmap_mode)
+
+    label_file = os.path.splitext(path)[0] + '.json'
+    if not os.path.isfile(label_file):
+        return sim
+
+    with open(label_file, encoding='utf-8') as f:
+        labels = json.load(f)
+
+    return pandas.DataFrame(
+        sim,
+        index=labels['index'],
+        columns=labels['columns'],
+        copy=False
+    )
+
+def _blocks(num: int, blocksize: int) -> list[slice]:
+    """把 [0, num) 按 `blocksize` 切分为若干区间"""
+
+    return [slice(i, min(i + blocksize, num)) for i in range(0, num, blocksize)]
+
+def _blockwise_output(
+    matrix: numpy.ndarray[float] | pandas.DataFrame,
+    out: str | os.PathLike | numpy.ndarray | pandas.DataFrame | None
+) -> tuple[numpy.ndarray[float], numpy.ndarray[float]]:
+    """
+    为分块转换相似度、距离矩阵准备输入和输出数组
+
+    Parameters:
+        matrix: 输入方阵，可以为内存映射或 pandas.DataFrame
+        out: 输出位置，见 `_open_output`，为 `matrix` 本身时原地修改
+
+    Returns:
+        matrix: 输入方阵底层的数组
+        out: 输出数组，浮点类型的输入保持原数据类型，否则为 float64
+    """
+
+    if isinstance(matrix, pandas.DataFrame):
+        if out is matrix:
+            out = matrix.values
+        matrix = matrix.values
+
+    if isinstance(out, pandas.DataFrame):
+        out = out.values
+
+    dtype = matrix.dtype if numpy.issubdtype(matrix.dtype, numpy.floating) \
+        else numpy.float64
+    return matrix, _open_output(out, matrix.shape, dtype=dtype)
+
+def _wrap_labels(
+    result: numpy.ndarray[float],
+    like: numpy.ndarray[float] | pandas.DataFrame
+) -> numpy.ndarray[float] | pandas.DataFrame:
+    """如果输入为 pandas.DataFrame，输出也使用同样的行列名称"""
+
+    return pandas.DataFrame(
+        result,
+        index=like.index,
+        columns=like.columns,
+        copy=False
+    ) if isinstance(like, pandas.DataFrame) else result
+
+def normalize_sim(
+    sim: numpy.ndarray[float] | pandas.DataFrame,
+    out: str | os.PathLike | numpy.ndarray | pandas.DataFrame | None = None,
+    blocksize: int = 1000
+) -> numpy.ndarray[float] | pandas.DataFrame:
+    """
+    正则化相似度矩阵到取值 [-1, 1] 区间的对称阵
+
+    Parameters:
+        sim: 方阵形式的相似度矩阵，可以为内存映射
+        out: 输出位置，为 None 时新建数组，为路径时创建 .npy 内存映射文件，
+            为 `sim` 本身时原地修改
+        blocksize: 分块大小
+
+    Returns:
+        sim: 正则化后的相似度矩阵
+
+    每次读取对称位置的一对分块，取平均后同时写回两处，因此可以原地修改。
+    除输出外额外占用的内存只有对角线及 2 个 `blocksize` x `blocksize` 的分块。
+    """
+
+    values, result = _blockwise_output(sim, out)
+    # 先复制对角线，原地修改时对角线也会被覆盖
+    diag = numpy.sqrt(numpy.diagonal(values).astype(numpy.float64))
+    overflow = 0
+
+    blocks = _blocks(values.shape[0], blocksize)
+    for i, rows in enumerate(blocks):
+        for cols in blocks[i:]:
+            # 和转置取平均构造对称阵
+            block = (numpy.asarray(values[rows, cols], dtype=numpy.float64) \
+                + numpy.asarray(values[cols, rows], dtype=numpy.float64).T) / 2
+            # 除以对角线元素的平方根缩放到 [-1, 1] 区间，前提是对角线元素的相似度最大
+            block /= diag[rows, None]
+            block /= diag[None, cols]
+
+            # 如果有元素异常超出 [-1, 1] 区间，强制裁剪到 [-1, 1]
+            count = numpy.count_nonzero((block < -1) | (block > 1))
+            overflow += count if rows == cols else 2 * count
+            numpy.clip(block, -1, 1, out=block)
+
+            result[rows, cols] = block
+            result[cols, rows] = block.T
+
+    if overflow > 0:
+        logging.warning(f'{overflow}/{values.size} similarity out of [-1, 1], clip')
+
+    return _wrap_labels(result, sim)
+
+def sim2dist(
+    sim: numpy.ndarray[float] | pandas.DataFrame,
+    out: str | os.PathLike | numpy.ndarray | pandas.DataFrame | None = None,
+    blocksize: int = 1000
+) -> numpy.ndarray[float] | pandas.DataFrame:
+    """
+    相似度矩阵转换成距离矩阵
+
+    Parameters:
+        sim: 方阵形式的相似度矩阵，可以为内存映射
+        out: 输出位置，含义同 `normalize_sim`，为 `sim` 本身时原地修改
+        blocksize: 每次处理的行数
+
+    Returns:
+        dist: 距离矩阵
+
+    假设相似阵的元素是欧氏空间向量的内积 sij = xi * xj，
+    因此 dij^2 = (xi - xj)^2 = xi^2 + xj^2 - 2xi * xj = sii + sjj - 2sij。
+    每个元素只依赖自身及对角线，逐行块计算，额外内存只有对角线及一个行块。
+    """
+
+    values, result = _blockwise_output(sim, out)
+    diag = numpy.diagonal(values).astype(numpy.float64)
+    minus = 0
+
+    for rows in _blocks(values.shape[0], blocksize):
+        d2 = numpy.array(values[rows], dtype=numpy.float64)
+        d2 *= -2
+        d2 += diag[rows, None]
+        d2 += diag[None, :]
+
+        # 有少量元素 < 0 是由于计算相似度的时候取近似导致的，强制为0
+        minus += numpy.count_nonzero(d2 < 0)
+        numpy.maximum(d2, 0, out=d2)
+        result[rows] = numpy.sqrt(d2, out=d2)
+
+    if minus > 0:
+        logging.warning(f'{minus}/{values.size} distance square < 0, clip to 0')
+
+    return _wrap_labels(result, sim)
+
+def dist2sim(
+    dist: numpy.ndarray[float] | pandas.DataFrame,
+    out: str | os.PathLike | numpy.ndarray | pandas.DataFrame | None = None,
+    blocksize: int = 1000
+) -> numpy.ndarray[float] | pandas.DataFrame:
+    """
+    距离矩阵转换成相似度矩阵
+
+    Parameters:
+        dist: 方阵形式的距离矩阵，可以为内存映射
+        out: 输出位置，含义同 `normalize_sim`，为 `dist` 本身时原地修改
+        blocksize: 每次处理的行数
+
+    Returns:
+        sim: 相似度矩阵
+    """
+
+    values, result = _blockwise_output(dist, out)
+    blocks = _blocks(values.shape[0], blocksize)
+
+    # 先逐行块求每列的最大值，再逐行块转换
+    max_sqrt = numpy.full(values.shape[1], -numpy.inf)
+    for rows in blocks:
+        numpy.maximum(max_sqrt, numpy.max(values[rows], axis=0), out=max_sqrt)
+    numpy.sqrt(max_sqrt, out=max_sqrt)
+
+    for rows in blocks:
+        block = numpy.asarray(values[rows], dtype=numpy.float64) \
+            / max_sqrt[rows, None]
+        block /= max_sqrt[None, :]
+        result[rows] = numpy.subtract(1, block, out=block)
+
+    return _wrap_labels(result, dist)
+
+
+def _load_wide(name: str) -> tuple[str, pandas.DataFrame]:
+    """
+    加载方言数据集并转换为宽表
+
+    Parameters:
+        name: 方言数据集名称，或 CSV 数据文件、目录路径
+
+    Returns:
+        name: 数据集的简称，用于输出文件名
+        data: 以字 ID 为行、方言及特征为列的宽表
+    """
+
+    try:
+        data = getattr(datasets, name)
+    except AttributeError:
+        # 如果在数据集不在支持的列表中，视为数据文件或目录路径，文件为 CSV 格式
+        if os.path.isdir(name):
+            # 目录，递归检索目录下的所有文件，视每个文件为一个方言数据，文件名为方言 ID
+            data = datasets.FileDataset(pandas.Series(
+                *zip(*[(os.path.join(c, f), os.path.splitext(f)[0]) \
+                    for c, _, fs in os.walk(name) for f in fs])
+            ))
+            name = os.path.basename(os.path.normpath(name))
+        else:
+            data = pandas.read_csv(name, dtype=str)
+            name = os.path.splitext(os.path.basename(name))[0]
+
+    data = preprocess.transform(
+        data.fillna({'initial': '', 'final': '', 'tone': ''}),
+        index='cid',
+        values=['initial', 'final', 'tone'],
+        aggfunc='first'
+    )
+    return name, data
+
+def _source_fingerprint(name: str, **params) -> str | None:
+    """
+    计算数据来源的指纹，用作编码特征的缓存键
+
+    Parameters:
+        name: 方言数据集名称，或 CSV 数据文件、目录路径
+        params: 其他影响编码结果的参数
+
+    Returns:
+        fingerprint: 十六进制的指纹字符串，无法确定数据来源的文件时为 None
+
+    取数据来源所有文件的绝对路径、修改时间及大小，文件变化后指纹随之改变。
+    内置数据集取其背后的数据文件，如果数据集不基于文件或文件尚未生成，不能判断数据是否变化，
+    返回 None。
+    """
+
+    try:
+        dataset = getattr(datasets, name)
+    except AttributeError:
+        path = os.path.realpath(name)
+        if os.path.isdir(path):
+            files = [os.path.join(c, f) for c, _, fs in os.walk(path) for f in fs]
+        else:
+            files = [path]
+    else:
+        if not isinstance(dataset, datasets.FileDataset):
+            return None
+
+        path = None
+        files = [os.path.realpath(f) for f in dataset.files]
+
+    try:
+        stats = [
+            (f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in sorted(files)
+        ]
+    except OSError:
+        return None
+
+    return _fingerprint(dataset=name, path=path, files=stats, **params)
+
+def _load_prepared(
+    name: str,
+    dtype: numpy.dtype,
+    cache: str | os.PathLike | None = None
+) -> tuple[str, PreparedFeatures]:
+    """
+    加载方言数据集并编码特征，指定缓存目录时优先从缓存加载
+
+    Parameters:
+        name: 方言数据集名称，或 CSV 数据文件、目录路径
+        dtype: one-hot 编码的数据类型
+        cache: 缓存编码后特征的目录，缓存文件以数据集简称、数据类型及数据来源的指纹命名，
+            见 `_source_fingerprint`，无法计算指纹时不使用缓存
+
+    Returns:
+        name: 数据集的简称
+        prepared: 编码后的特征
+    """
+
+    if cache is not None:
+        short = os.path.splitext(os.path.basename(os.path.normpath(name)))[0]
+        dtype_name = numpy.dtype(dtype).name
+        key = _source_fingerprint(name, dtype=dtype_name)
+        if key is not None:
+            path = os.path.join(cache, f'{short}_{dtype_name}_{key[:16]}.features')
+            if os.path.isfile(path):
+                logging.info(f'load prepared features from {path}')
+                return short, PreparedFeatures.load(path)
+
+    source = name
+    name, data = _load_wide(name)
+    prepared = PreparedFeatures(data, dtype=dtype)
+
+    if cache is not None:
+        # 内置数据集的文件可能在加载时才生成，加载后重新计算指纹
+        if key is None:
+            key = _source_fingerprint(source, dtype=dtype_name)
+
+        if key is None:
+            logging.warning(
+                f'cannot fingerprint {source}, prepared features not cached'
+            )
+        else:
+            path = os.path.join(cache, f'{short}_{dtype_name}_{key[:16]}.features')
+            os.makedirs(cache, exist_ok=True)
+            prepared.save(path)
+            logging.info(f'prepared features saved to {path}')
+
+    return name, prepared
+
+def _save_matrix(sim: pandas.DataFrame, path: str, format: str) -> None:
+    """按指定格式保存已计算完成的相似度矩阵，npy 格式在计算过程中已写入"""
+
+    if format == 'npy':
+        save_labels(path, sim.index, sim.columns)
+    elif format == 'parquet':
+        # parquet 要求列名为字符串
+        sim.rename(columns=str).to_parquet(path)
+    else:
+        sim.to_csv(path, lineterminator='\n')
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    命令行入口，根据指定方言数据集计算方言之间的预测相似度
+
+    Parameters:
+        argv: 命令行参数，为 None 时取 `sys.argv`
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='根据指定方言数据集计算方言之间的预测相似度'
+    )
+    parser.add_argument(
+        '-m',
+        '--method',
+        action='append',
+        choices=tuple(_METRICS),
+        help='计算方言间相似度的方法，可以多次指定，如果不指定，计算 chi2 及 entropy'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='输出路径，如果只有一个数据集及一个方法，为输出文件名，否则为输出目录'
+    )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=('csv', 'npy', 'parquet'),
+        default='csv',
+        help='输出格式，npy 为二进制矩阵加同名的 JSON 名称文件，计算过程中直接写入文件'
+    )
+    parser.add_argument(
+        '-j',
+        '--parallel',
+        type=int,
+        default=1,
+        help='并行计算的并行数'
+    )
+    parser.add_argument(
+        '-b',
+        '--blocksize',
+        type=int,
+        default=100,
+        help='分块计算时每块包含的方言数'
+    )
+    parser.add_argument(
+        '--mmap',
+        action='store_true',
+        help='以内存映射的方式把编码后的特征共享给并行任务'
+    )
+    parser.add_argument(
+        '-t',
+        '--dtype',
+        choices=('float32', 'float64', 'int32'),
+        default='float32',
+        help='one-hot 编码的数据类型，见 `reduction_dtype`'
+    )
+    parser.add_argument(
+        '-c',
+        '--cache',
+        help='缓存编码后特征的目录，同一数据集再次运行且数据未变化时跳过加载和编码'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        help='保存分块断点的目录，中断后以相同参数重新运行时跳过已完成的分块'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='统计并输出特征交叉、编码、分块计算及输出各阶段的耗时'
+    )
+    parser.add_argument(
+        'dataset',
+        nargs='*',
+        default=('ccr',),
+        help='方言数据集名称或数据文件或目录路径'
+    )
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    methods = ('chi2', 'entropy') if args.method is None \
+        else tuple(dict.fromkeys(args.method))
+    funcs = {m: chi2 if m == 'chi2' else functools.partial(pairwise, metric=m) \
+        for m in methods}
+
+    with profile() as timings:
+        for dts in args.dataset:
+            with _timed('load'):
+                dts, data = _load_prepared(dts, args.dtype, args.cache)
+
+            # 多种方法共用同一份编码后的特征
+            for method in methods:
+                # 如果输出文件只有一个，使用指定的路径作为文件名，否则作为输出目录
+                if len(args.dataset) > 1 or len(methods) > 1:
+                    output = os.path.join(
+                        os.getcwd() if args.output is None else args.output,
+                        f'{dts}_{method}.{args.format}'
+                    )
+                else:
+                    output = os.path.join(
+                        os.getcwd(),
+                        f'{dts}_{method}.{args.format}'
+                    ) if args.output is None else args.output
+
+                logging.info(f'compute {method} between {dts} dialects -> {output}')
+
+                os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+                sim = funcs[method](
+                    data,
+                    blocksize=(args.blocksize, args.blocksize),
+                    parallel=args.parallel,
+                    mmap=args.mmap,
+                    out=output if args.format == 'npy' else None,
+                    checkpoint=args.checkpoint
                 )
-            else:
-                output = os.path.join(os.getcwd(), f'{dts}_{method}.csv') \
-                    if args.output is None else args.output
+                with _timed('output'):
+                    _save_matrix(sim, output, args.format)
+
+    if args.profile:
+        # 加载阶段包含特征交叉和编码，单独列出时扣除
+        timings['load'] -= timings['cross'] + timings['encode']
+        total = sum(timings.values())
+        for stage in ('load', 'cross', 'encode', 'compute', 'output'):
+            print(
+                f'{stage}: {timings[stage]:.2f} s '
+                f'({timings[stage] / max(total, 1e-9):.1%})',
+                file=sys.stderr
+            )
+        print(f'total: {total:.2f} s', file=sys.stderr)
 
-            print(f'compute {method} between {dts} dialects -> {output}')
 
-            os.makedirs(os.path.dirname(output), exist_ok=True)
-            sim = globals()[method](data, parallel=4)
-            sim.to_csv(output, lineterminator='\n')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""辅助函数的测试."""
+
+import numpy
+import pytest
+import sklearn.feature_extraction.text
+
+from sincomp import auxiliary
+
+
+def _tokenize(s):
+    return s.split(' ')
+
+@pytest.mark.parametrize('parallel', [1, 2])
+def test_vectorizer(parallel):
+    rng = numpy.random.default_rng(0)
+    data = rng.choice(['a', 'b', 'c d', 'd', ''], size=(50, 6)).astype(object)
+
+    # 逐列使用 CountVectorizer 编码的原有方式
+    code, limits = auxiliary.vectorize(
+        data,
+        tokenizer=_tokenize,
+        parallel=parallel
+    )
+    vocabularies = [sklearn.feature_extraction.text.CountVectorizer(
+        lowercase=False,
+        tokenizer=_tokenize,
+        token_pattern=None,
+        stop_words=['']
+    ).fit(data[:, i]).get_feature_names_out() for i in range(data.shape[1])]
+
+    vectorizer = auxiliary.Vectorizer()
+    result = vectorizer.fit_transform(data)
+    numpy.testing.assert_array_equal(result.toarray(), code.toarray())
+    numpy.testing.assert_array_equal(vectorizer.limits_, limits)
+    for v, expected in zip(vectorizer.vocabularies_, vocabularies):
+        assert v.tolist() == expected.tolist()
+
+    # 默认方式和原有方式的编码相同
+    default, default_limits = auxiliary.vectorize(data, parallel=parallel)
+    numpy.testing.assert_array_equal(default.toarray(), code.toarray())
+    numpy.testing.assert_array_equal(default_limits, limits)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""方言比较函数的测试."""
+
+import numpy
+import pandas
+
+from sincomp import compare
+
+
+def _make_data(dialect_num=6, character_num=30, seed=0):
+    """生成随机的方言字音宽表，每个字在每个方言有声韵调3个读音"""
+
+    rng = numpy.random.default_rng(seed)
+    columns = pandas.MultiIndex.from_product(
+        [[f'd{i}' for i in range(dialect_num)], ['initial', 'final', 'tone']]
+    )
+    data = rng.choice(['a', 'b', 'c', ''], size=(character_num, columns.shape[0]))
+    return pandas.DataFrame(
+        data,
+        index=[f'c{i}' for i in range(character_num)],
+        columns=columns
+    )
+
+def _make_rules():
+    """生成语音规则表，其中部分字不在数据中"""
+
+    return pandas.DataFrame({
+        'element': ['initial', 'final', 'tone', 'initial', 'tone'],
+        'cid1': [
+            ['c0', 'c1'],
+            ['c2', 'c3', 'c4'],
+            ['c5'],
+            ['c6', 'x0'],
+            ['c7', 'c8']
+        ],
+        'cid2': [['c9'], ['c10', 'c11'], ['c12', 'c13'], ['c14'], ['x1']],
+    })
+
+def test_rule_set_compliance(tmp_path):
+    data = _make_data()
+    rules = _make_rules()
+    characters = pandas.Series(
+        [f'字{i}' for i in range(30)] + ['甲', '乙'],
+        index=[f'c{i}' for i in range(30)] + ['x0', 'x1']
+    )
+
+    # 编译后的规则集和原始规则表计算的符合度相同
+    fname = str(tmp_path / 'rules.csv')
+    compare.save_rule(rules, fname)
+    expected = compare.compliance(data, compare.load_rule(fname))
+    rule_set = compare.load_rule_set(fname)
+    pandas.testing.assert_frame_equal(compare.compliance(data, rule_set), expected)
+
+    # 保存再加载后符合度不变，重新生成的规则名称和从 CSV 加载时一致
+    path = str(tmp_path / 'rules.pkl')
+    rule_set.save(path)
+    loaded = compare.load_rule_set(path, characters=characters)
+    pandas.testing.assert_frame_equal(compare.compliance(data, loaded), expected)
+
+    named = compare.load_rule(fname, characters=characters)
+    assert loaded.rules['name'].tolist() == named['name'].tolist()
+    assert loaded.rules['char1'].tolist() == named['char1'].tolist()
+    assert loaded.rules['char2'].tolist() == named['char2'].tolist()
+
+def test_iter_compliance():
+    data = _make_data(dialect_num=7)
+    rules = _make_rules()
+    expected = compare.compliance(data, rules)
+
+    # 转换成长表后逐批计算，拼接的结果和一次计算相同
+    long = data.stack(level=0).rename_axis(['cid', 'did']).reset_index()
+    for batch, parallel in ((1, 1), (3, 1), (3, 2)):
+        result = pandas.concat(compare.iter_compliance(
+            long,
+            rules,
+            batch=batch,
+            parallel=parallel
+        ))
+        pandas.testing.assert_frame_equal(
+            result.loc[expected.index],
+            expected,
+            check_names=False
+        )
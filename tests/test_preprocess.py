@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+"""预处理函数的测试."""
+
+import numpy
+import pytest
+
+from sincomp import preprocess
+
+
+def test_contour_roundtrip():
+    tones = numpy.array(['55', '213', '', '3', '0'])
+    contour = preprocess.tone2contour(tones)
+
+    assert contour.tolist() \
+        == [[5, 5, 0], [2, 1, 3], [0, 0, 0], [3, 0, 0], [0, 0, 0]]
+    assert preprocess.contour2tone(contour).tolist() \
+        == ['55', '213', '', '3', '']
+
+def test_contour2tone_superscript():
+    assert preprocess.contour2tone([[2, 1, 4]], superscript=True).tolist() \
+        == ['²¹⁴']
+
+@pytest.mark.parametrize('level', [6, 255, -1])
+def test_contour2tone_invalid_level(level):
+    with pytest.raises(ValueError, match='tone levels'):
+        preprocess.contour2tone([[1, level, 0]])
+
+def test_encode_tags():
+    codes = preprocess.encode_tags([['B-I', 'E-I', 'S-T'], [], ['X', 'O']])
+
+    assert codes.tolist() == [
+        preprocess._TAGS.index('B-I'),
+        preprocess._TAGS.index('E-I'),
+        preprocess._TAGS.index('S-T'),
+        0,
+        0
+    ]
+    assert preprocess.encode_tags([]).shape == (0,)
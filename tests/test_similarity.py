@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""方言相似度计算的测试."""
+
+import numpy
+import pandas
+import pytest
+
+from sincomp import similarity
+
+
+def _make_data(dialect_num=12, character_num=200, seed=0):
+    """生成随机的方言读音宽表，同一个字在各方言的读音相关"""
+
+    rng = numpy.random.default_rng(seed)
+    dialects = [f'd{i:02d}' for i in range(dialect_num)]
+    base = rng.integers(0, 8, size=(character_num, 3))
+    values = numpy.empty((character_num, dialect_num * 3), dtype=object)
+    for i in range(dialect_num):
+        for j, prefix in enumerate('ift'):
+            noise = rng.integers(0, 2 + i % 3, size=character_num)
+            values[:, i * 3 + j] = [f'{prefix}{v}' for v in (base[:, j] + noise) % 9]
+
+    values[rng.random(values.shape) < 0.05] = ''
+    return pandas.DataFrame(
+        values,
+        index=[f'c{i}' for i in range(character_num)],
+        columns=pandas.MultiIndex.from_product((dialects, ['initial', 'final', 'tone']))
+    )
+
+
+def test_cross_codes_missing():
+    data = numpy.array([['a', 'b'], ['a', ''], ['', 'b'], ['', '']], dtype=object)
+    codes, uniques = similarity.factorize_features(data)
+    crossed = similarity.cross_codes(codes, uniques.shape[0], 2)
+
+    # 只有一个特征缺失时交叉特征不缺失，两个都缺失时才缺失
+    assert crossed.shape == (4, 1, 2)
+    assert numpy.all(crossed[:3] >= 0)
+    assert numpy.all(crossed[3] == -1)
+    assert numpy.unique(crossed[:3, 0, 0]).shape[0] == 3
+
+def test_cross_codes_ambiguous_concatenation():
+    # 字符串拼接时 'a' + '' 和 '' + 'a' 都得到 'a'，整数编码应区分二者
+    data = numpy.array([['a', ''], ['', 'a'], ['a', 'a']], dtype=object)
+    concatenated = similarity.cross_features(data, 2)[:, 0, 0]
+    assert concatenated[0] == concatenated[1]
+
+    codes, uniques = similarity.factorize_features(data)
+    crossed = similarity.cross_codes(codes, uniques.shape[0], 2)[:, 0, 0]
+    assert numpy.unique(crossed).shape[0] == 3
+
+def test_prepared_features_distinguish_concatenation():
+    # 方言内不同特征使用相同符号时，交叉特征的取值数按取值组合计算
+    data = numpy.array([['a', ''], ['', 'a'], ['b', 'b']], dtype=object)
+    prepared = similarity.PreparedFeatures(data, feature_num=2)
+    assert prepared.feature_categories[0] == 3
+
+def test_update_chi2():
+    data = _make_data()
+    full = similarity.chi2(data, blocksize=(5, 5))
+
+    # 先计算前几个方言，再增量加入其余方言
+    previous = similarity.chi2(data.iloc[:, :24], blocksize=(5, 5))
+    updated = similarity.update_chi2(previous, data, blocksize=(5, 5))
+    numpy.testing.assert_allclose(updated.values, full.values, rtol=1e-5, atol=1e-4)
+    assert updated.index.equals(full.index) and updated.columns.equals(full.columns)
+
+    # 源方言和目标方言不同
+    dest = data.iloc[:, 6:]
+    full = similarity.chi2(data, dest, blocksize=(5, 5))
+    previous = similarity.chi2(data.iloc[:, :24], dest.iloc[:, :15], blocksize=(5, 5))
+    updated = similarity.update_chi2(previous, data, dest, blocksize=(5, 5))
+    numpy.testing.assert_allclose(updated.values, full.values, rtol=1e-5, atol=1e-4)
+
+def test_update_chi2_requires_names():
+    data = _make_data(dialect_num=4)
+    previous = similarity.chi2(data)
+
+    with pytest.raises(ValueError, match='dialect names'):
+        similarity.update_chi2(previous, data.values)
+
+def test_topk_exclude_self():
+    data = _make_data()
+    sim = similarity.chi2(data)
+    neighbors, scores = similarity.topk(data, k=3, blocksize=(5, 5))
+    assert neighbors.shape == (12, 3)
+    assert not (neighbors.values == neighbors.index.values[:, None]).any()
+
+    # 排除自身后的结果和完整相似度矩阵去掉对角线后的前 k 个相同
+    masked = sim.values.copy()
+    numpy.fill_diagonal(masked, -numpy.inf)
+    expected = numpy.sort(masked, axis=1)[:, ::-1][:, :3]
+    numpy.testing.assert_allclose(scores.values, expected, rtol=1e-5)
+
+    neighbors, _ = similarity.topk(data, k=3, exclude_self=False)
+    assert (neighbors.iloc[:, 0] == neighbors.index).all()
+
+def test_topk_k():
+    data = _make_data(dialect_num=5)
+    with pytest.raises(ValueError):
+        similarity.topk(data, k=0)
+
+    # k 超过可选的目标方言数时截断
+    neighbors, scores = similarity.topk(data, k=10)
+    assert neighbors.shape == scores.shape == (5, 4)
+    neighbors, _ = similarity.topk(data, data.iloc[:, :6], k=10)
+    assert neighbors.shape == (5, 2)
+
+def test_blockwise_inplace_memmap(tmp_path):
+    sim = similarity.chi2(_make_data()).values
+    normalized = similarity.normalize_sim(sim)
+
+    # 在内存映射上分块原地计算，结果应和一次性计算相同
+    mmap = numpy.lib.format.open_memmap(
+        tmp_path / 'sim.npy',
+        mode='w+',
+        dtype=sim.dtype,
+        shape=sim.shape
+    )
+    mmap[:] = sim
+    similarity.normalize_sim(mmap, out=mmap, blocksize=5)
+    numpy.testing.assert_allclose(mmap, normalized, rtol=1e-6)
+    numpy.testing.assert_allclose(mmap, mmap.T)
+
+    dist = similarity.sim2dist(normalized)
+    similarity.sim2dist(mmap, out=mmap, blocksize=5)
+    numpy.testing.assert_allclose(mmap, dist, rtol=1e-6)
+
+    similarity.dist2sim(mmap, out=mmap, blocksize=5)
+    numpy.testing.assert_allclose(
+        mmap,
+        similarity.dist2sim(dist),
+        rtol=1e-6
+    )
+
+@pytest.mark.parametrize('method', ['chi2', 'entropy'])
+def test_bootstrap(method):
+    data = _make_data(dialect_num=8, character_num=100)
+    kwargs = dict(method=method, samples=6, seed=0, batch=4, blocksize=(3, 3))
+
+    # 固定随机数种子时，串行和并行加内存映射的结果相同
+    mean, percentiles = similarity.bootstrap(data, **kwargs)
+    parallel_mean, parallel_percentiles = similarity.bootstrap(
+        data,
+        parallel=2,
+        mmap=True,
+        **kwargs
+    )
+    assert mean.shape == (8, 8)
+    assert set(percentiles) == {2.5, 97.5}
+    numpy.testing.assert_allclose(parallel_mean.values, mean.values, rtol=1e-6)
+    for p in percentiles:
+        numpy.testing.assert_allclose(
+            parallel_percentiles[p].values,
+            percentiles[p].values,
+            rtol=1e-6
+        )
+
+    # 源方言和目标方言不同
+    mean, percentiles = similarity.bootstrap(data, data.iloc[:, 6:], **kwargs)
+    assert mean.shape == (8, 6)
+    assert all(m.shape == (8, 6) for m in percentiles.values())
+    assert mean.columns.equals(data.columns.get_level_values(0).unique()[2:])